@@ -1,52 +1,148 @@
 '''
 App.py provides a RESTful web service for managing users and devices in an IoT platform by performing basic 
 CRUD (Create, Read, Update, Delete) operations on a catalog file (Catalog.json).
+The catalog is served from memory by CatalogStore: lookups use its username and userID indexes, and changes are
+journaled and folded into Catalog.json by atomic snapshots, so concurrent requests never race on the file.
+The other services read the catalog through the /catalog endpoints (see CatalogClient.py): the responses are
+serialized once per catalog version and carry an ETag, so a client that is up to date gets a 304 without body,
+and /catalog/changes is a long-poll feed of the changes made after the version a client has.
+The password hashes and the ThingSpeak write API keys are left out of these responses and of the change feed, except
+for the catalog requests sending the service token of SMARTHEALTH_SERVICE_TOKEN as "Authorization: Bearer <token>",
+which is how the other services read them (the token must be the same for App.py and for them).
+Passwords are stored as scrypt hashes (see Credentials.py): the plain text ones are hashed when the service starts,
+and the checks run in the bounded pool of a CredentialVerifier, which remembers them for the CherryPy session.
+CherryPy answers a request from the thread that received it, so a request checking a password still waits for its
+hash; the trade-off is to bound that wait: at most MAX_PENDING_CHECKS requests wait for a hash at once, for at most
+CHECK_TIMEOUT seconds, and the next ones are refused at once with a 503 and a Retry-After instead of queueing, which
+keeps most server threads free for the catalog during a burst of logins. Old hashes are replaced from the pool, after
+the answer.
+Every request of /user and /catalog is timed per endpoint, and /metrics serves these metrics together with the ones
+exported by the other services (see Metrics.py) in the Prometheus text format.
 '''
 
 import cherrypy
+import hmac
 import json
 import os
-from datetime import datetime
+import threading
+import time
+from CatalogStore import CatalogStore
+from concurrent.futures import TimeoutError
+from functools import partial
+from Credentials import CredentialVerifier, VerifierBusy, migrate_store, needs_rehash
+import Metrics
 
 catalog_file = 'Catalog.json'
+MAX_POLL_TIMEOUT = 60  # seconds a change feed request may wait, every waiting request holds a server thread
+MAX_PENDING_CHECKS = 8  # password hashes waited for at once, each by a server thread, out of its 30 threads
+CHECK_TIMEOUT = 5  # seconds a request waits for its password check
+RETRY_AFTER = 1  # seconds a refused login is told to wait
+SERVICE_TOKEN = os.environ.get('SMARTHEALTH_SERVICE_TOKEN')  # lets the services read the fields below
+SECRET_FIELDS = ('password', 'thingSpeakWriteAPIKey')
 
+REQUEST_LATENCY = Metrics.histogram('smarthealth_http_request_seconds', "Seconds to answer a request of App.py",
+                                    ('service', 'endpoint', 'status'))
 
-def load_catalog():
-    with open(catalog_file, 'r') as f:
-        return json.load(f)
 
+class RequestMetrics(cherrypy.Tool):
+    """Tool timing the requests of a mounted service, enabled with tools.metrics.on and tools.metrics.service."""
+    def __init__(self):
+        cherrypy.Tool.__init__(self, 'on_start_resource', self.start_timer, priority=10)
 
-def save_catalog(catalog):
-    with open(catalog_file, 'w') as f:
-        json.dump(catalog, f, indent=4)
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        # Before the other tools (json_out, encoding) wrap the page handler
+        cherrypy.request.hooks.attach('before_handler', self.find_endpoint, priority=10)
+        cherrypy.request.hooks.attach('on_end_request', self.observe, priority=90)
+
+    def start_timer(self, service='app'):
+        cherrypy.request.metrics = [time.perf_counter(), service, 'not_found']
+
+    def find_endpoint(self):
+        # The name of the exposed method, not the path, e.g. /catalog/users/3 is "users"
+        handler = getattr(cherrypy.request.handler, 'callable', None)
+        cherrypy.request.metrics[2] = getattr(handler, '__name__', 'unknown')
+
+    def observe(self):
+        metrics = getattr(cherrypy.request, 'metrics', None)
+        if metrics is None:
+            return
+        start, service, endpoint = metrics
+        status = str(cherrypy.response.status).split()[0]
+        REQUEST_LATENCY.labels(service, endpoint, status).observe(time.perf_counter() - start)
+
+
+cherrypy.tools.metrics = RequestMetrics()
+
+
+def public_user(user):
+    # The user without the password hash and the write API key
+    return {key: value for key, value in user.items() if key not in SECRET_FIELDS}
+
+
+def public_change(change):
+    # A journal entry of the change feed, the added user and the changes of an update are stripped the same way
+    change = dict(change)
+    for key in ('user', 'changes'):
+        if isinstance(change.get(key), dict):
+            change[key] = public_user(change[key])
+    return change
 
 
 class UserService(object):
+    def __init__(self, store, verifier):
+        self.store = store
+        self.verifier = verifier
+
+    def authenticate(self, username, password):
+        # Return the user if the password is right, None otherwise
+        user = self.store.get_user(username)
+        if not user:
+            return None
+        try:
+            valid = self.verifier.verify(cherrypy.session.id, username, password, user['password'], CHECK_TIMEOUT)
+        except TimeoutError:
+            raise VerifierBusy("The password check took too long, please try again in a moment")
+        if not valid:
+            return None
+        if needs_rehash(user['password']):
+            # The answer does not wait for the new hash, a full pool leaves it to the next login
+            self.verifier.rehash(password, partial(self.store_rehash, user['userID'], user['password']))
+        return user
+
+    def store_rehash(self, user_id, old, new):
+        # From the pool of the verifier, unless the password was changed meanwhile
+        user = self.store.get_user_by_id(user_id)
+        if user and user['password'] == old:
+            self.store.update_user(user_id, {'password': new})
+
+    def busy(self, error):
+        # Refused at once rather than queued behind the hashes of the other logins
+        cherrypy.response.status = 503
+        cherrypy.response.headers['Retry-After'] = str(RETRY_AFTER)
+        return {"error": str(error)}
+
     @cherrypy.expose
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
     def add_user(self):
         data = cherrypy.request.json
         try:
-            catalog = load_catalog()
-            users = catalog['users']
-            new_user_id = max(user['userID'] for user in users) + 1
             new_user = {
-                "userID": new_user_id,
                 "name": data['name'],
                 "surname": data['surname'],
                 "username": data['username'],
-                "password": data['password'],
+                "password": self.verifier.hash(data['password']),
                 "latitude": data['latitude'],
                 "longitude": data['longitude'],
                 "csvFile": f"{data['username']}.csv",
                 "thingSpeakChannelID": data['thingSpeakChannelID'],
                 "thingSpeakWriteAPIKey": data['thingSpeakWriteAPIKey']
             }
-            users.append(new_user)
-            catalog['lastUpdate'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            save_catalog(catalog)
+            self.store.add_user(new_user)
             return {"message": "User added successfully"}
+        except VerifierBusy as e:
+            return self.busy(e)
         except Exception as e:
             return {"error": str(e)}
 
@@ -56,21 +152,22 @@ class UserService(object):
     def update_user(self):
         data = cherrypy.request.json
         try:
-            catalog = load_catalog()
-            users = catalog['users']
-            user = next((user for user in users if user['username'] == data['username'] and user['password'] == data['password']), None)
-
+            user = self.authenticate(data['username'], data['password'])
             if not user:
                 return {"error": "Invalid username or password"}
 
             # Update fields if provided
+            changes = {}
             for key in ['name', 'surname', 'new_username', 'new_password', 'latitude', 'longitude', 'thingSpeakChannelID', 'thingSpeakWriteAPIKey']:
                 if key in data and data[key]:
-                    user[key.split("new_")[-1]] = data[key]
+                    changes[key.split("new_")[-1]] = data[key]
+            if 'password' in changes:
+                changes['password'] = self.verifier.hash(changes['password'])
 
-            catalog['lastUpdate'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            save_catalog(catalog)
+            self.store.update_user(user['userID'], changes)
             return {"message": "User updated successfully"}
+        except VerifierBusy as e:
+            return self.busy(e)
         except Exception as e:
             return {"error": str(e)}
 
@@ -80,17 +177,15 @@ class UserService(object):
     def delete_user(self):
         data = cherrypy.request.json
         try:
-            catalog = load_catalog()
-            users = catalog['users']
-            user = next((user for user in users if user['username'] == data['username'] and user['password'] == data['password']), None)
-
+            user = self.authenticate(data['username'], data['password'])
             if not user:
                 return {"error": "Invalid username or password"}
 
-            users.remove(user)
-            catalog['lastUpdate'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            save_catalog(catalog)
+            self.store.delete_user(user['userID'])
+            self.verifier.forget(cherrypy.session.id)
             return {"message": "User deleted successfully"}
+        except VerifierBusy as e:
+            return self.busy(e)
         except Exception as e:
             return {"error": str(e)}
 
@@ -100,21 +195,110 @@ class UserService(object):
     def read_user(self):
         data = cherrypy.request.json
         try:
-            catalog = load_catalog()
-            user = next((user for user in catalog['users'] if user['username'] == data['username']), None)
+            user = self.store.get_user(data['username'])
             if not user:
                 return {"error": "User not found"}
-            return user
+            return {key: value for key, value in user.items() if key != 'password'}
         except Exception as e:
             return {"error": str(e)}
 
 
+class CatalogService(object):
+    """Class to serve the catalog read-only with cached responses, ETags and a change feed."""
+    def __init__(self, store, service_token=SERVICE_TOKEN):
+        self.store = store
+        self.service_token = service_token
+        self._lock = threading.Lock()
+        self._tag = None
+        self._catalog = None
+        self._public_catalog = None  # self._catalog without the SECRET_FIELDS of the users, built on first use
+        self._bodies = {}  # (service, resource) -> serialized response, for the catalog version of self._tag
+
+    def _is_service(self):
+        if not self.service_token:
+            return False
+        authorization = cherrypy.request.headers.get('Authorization', '')
+        return hmac.compare_digest(authorization.encode(), f"Bearer {self.service_token}".encode())
+
+    def _respond(self, resource, build):
+        # Serve a resource from the cache of the current catalog version, building it on first use
+        service = self._is_service()
+        with self._lock:
+            if self._tag != self.store.tag():
+                self._tag, self._catalog = self.store.versioned_catalog()
+                self._public_catalog = None
+                self._bodies = {}
+            tag, catalog = self._tag, self._catalog
+            if not service:
+                if self._public_catalog is None:
+                    self._public_catalog = dict(catalog, users=[public_user(user) for user in catalog['users']])
+                catalog = self._public_catalog
+            body = self._bodies.get((service, resource))
+            if body is None:
+                data = build(catalog)
+                if data is None:
+                    raise cherrypy.HTTPError(404, f"{resource} not found")
+                body = self._bodies[(service, resource)] = json.dumps(data).encode()
+        etag = f'"{tag}"'
+        cherrypy.response.headers['ETag'] = etag
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        cherrypy.response.headers['Vary'] = 'Authorization'
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        if etag in cherrypy.request.headers.get('If-None-Match', ''):
+            cherrypy.response.status = 304
+            return b''
+        return body
+
+    @cherrypy.expose
+    def index(self):
+        return self._respond('catalog', lambda catalog: catalog)
+
+    @cherrypy.expose
+    def users(self, user_id=None):
+        if user_id is None:
+            return self._respond('users', lambda catalog: catalog['users'])
+        return self._respond(f"user {user_id}", lambda catalog: next(
+            (user for user in catalog['users'] if str(user['userID']) == user_id), None))
+
+    @cherrypy.expose
+    def devices(self, device_id=None):
+        if device_id is None:
+            return self._respond('devicesList', lambda catalog: catalog.get('devicesList', []))
+        return self._respond(f"device {device_id}", lambda catalog: next(
+            (device for device in catalog.get('devicesList', []) if str(device['deviceID']) == device_id), None))
+
+    @cherrypy.expose
+    def devicesList(self):
+        return self.devices()
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def changes(self, since=None, timeout=30):
+        """Long poll: answer as soon as the catalog is newer than the version since, or after timeout seconds."""
+        try:
+            timeout = min(float(timeout), MAX_POLL_TIMEOUT)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "timeout must be a number of seconds")
+        tag, changes = self.store.changes_since(since, timeout)
+        if changes is None:
+            # Unknown or too old version, the client has to GET the whole catalog again
+            return {"version": tag, "reset": True}
+        # The services only use the feed to know when to GET the catalog again
+        return {"version": tag, "changes": [public_change(change) for change in changes]}
+
+
 class Root(object):
     @cherrypy.expose
     def index(self):
         with open('index.html') as f:
             return f.read()
 
+    @cherrypy.expose
+    def metrics(self):
+        # Metrics of App.py and of the services that exported theirs recently
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return Metrics.collect(component='app').encode()
+
 
 if __name__ == '__main__':
     conf = {
@@ -130,11 +314,22 @@ if __name__ == '__main__':
     cherrypy.config.update({
         'server.socket_host': '0.0.0.0',
         'server.socket_port': 8080,
-        'log.screen': True
+        'log.screen': True,
+        'server.thread_pool': 30  # the change feed keeps one thread per waiting service
     })
 
+    store = CatalogStore(catalog_file)
+    migrate_store(store)
+    verifier = CredentialVerifier(max_pending=MAX_PENDING_CHECKS)
+    cherrypy.engine.subscribe('start', store.start)
+    cherrypy.engine.subscribe('stop', store.stop)
+    cherrypy.engine.subscribe('stop', verifier.stop)
+
     cherrypy.tree.mount(Root(), '/', conf)
-    cherrypy.tree.mount(UserService(), '/user')
+    cherrypy.tree.mount(UserService(store, verifier), '/user', {'/': {
+        'tools.sessions.on': True, 'tools.metrics.on': True, 'tools.metrics.service': 'user'}})
+    cherrypy.tree.mount(CatalogService(store), '/catalog', {'/': {
+        'tools.metrics.on': True, 'tools.metrics.service': 'catalog'}})
 
     cherrypy.engine.start()
     cherrypy.engine.block()
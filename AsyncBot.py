@@ -0,0 +1,182 @@
+'''
+AsyncBot.py runs the Telegram bot of SmartHealthTelegram.py on a single asyncio event loop, which owns the whole
+state of the bot: the chat contexts, the watchers and the latest values are only read and written by the handlers
+of Bot running on the loop, one at a time, so the lock of Bot is uncontended and thousands of caregiver chats cost
+no thread.
+- The Telegram updates are received by long polling the Bot API with aiohttp (or, without aiohttp, from a thread of
+  the default executor) and the callback queries are answered the same way; the messages still go through the
+  TelegramOutbox, which keeps their priorities, bursts merging and rate limits.
+- The catalog changes and the password checks arrive on the threads of the catalog client and of the verifier,
+  which only post the handler to the loop. The MQTT messages arrive on the thread of paho, which waits for their
+  handler on the loop: a message is logged as processed and acknowledged to the broker only once handled, so the
+  durable session still gets every message processed at least once. The MQTT client only starts once the loop runs,
+  and paho waits at most DELIVER_TIMEOUT seconds for a handler, well within the keepalive of the connection.
+- The history is read and written by a thread of its own, in order, its disk writes never stall the loop.
+- The patients of the logins are replayed on the shared timeline of the wearable device, whose few workers publish
+  for all of them (see WearableDevice.add_replay), at most one replay per patient.
+- The GPS tracks are also read by the outbox worker drawing the maps, under the index lock of Bot.
+- On Ctrl-C the loop keeps running while the services of the bot stop, the events already posted are handled.
+
+    python AsyncBot.py
+'''
+
+import asyncio
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from functools import partial
+from MyMQTT import broker_address
+from SmartHealthTelegram import Bot, TOKEN
+import Metrics
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+TELEGRAM_API = 'https://api.telegram.org'
+POLL_TIMEOUT = 30  # seconds a getUpdates long poll waits for an update
+RETRY_DELAY = 5  # seconds before polling again after an error
+DELIVER_TIMEOUT = 10  # seconds the MQTT thread waits for the handler of a message on the loop
+
+
+class AsyncBot(Bot):
+    """Class to run the handlers of the Telegram bot on an asyncio event loop."""
+    def __init__(self, token, mqtt_broker, mqtt_port, durable=True):
+        self.token = token
+        # Created first, the catalog events of the constructor wait in it until the loop runs
+        self.loop = asyncio.new_event_loop()
+        # One thread, the samples of a series are appended in order and a query sees the samples appended before it
+        self._history_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history')
+        self._tasks = set()
+        self._session = None
+        super().__init__(token, mqtt_broker, mqtt_port, durable)
+
+    def start_mqtt(self):
+        # Started by main(), once the loop runs the handlers of the messages
+        pass
+
+    def post(self, handler, *args, **kwargs):
+        # From any thread, the handler runs on the loop
+        if self.loop.is_closed():
+            return  # a late password check of a stopped bot
+        self.loop.call_soon_threadsafe(partial(self._call, handler, args, kwargs))
+
+    def deliver(self, handler, *args, **kwargs):
+        # From the MQTT thread, which waits until the handler has run on the loop
+        done = Future()
+        self.loop.call_soon_threadsafe(partial(self._call, handler, args, kwargs, done))
+        try:
+            done.result(DELIVER_TIMEOUT)
+        except TimeoutError:
+            # Still handled later on the loop, only a crash meanwhile would lose it
+            logging.warning(f"Message not handled within {DELIVER_TIMEOUT}s, acknowledged before its handler ran")
+
+    def _call(self, handler, args, kwargs, done=None):
+        try:
+            handler(*args, **kwargs)
+        except Exception as e:
+            logging.error(f"Handler {getattr(handler, '__name__', handler)} failed: {e}")
+        finally:
+            if done is not None:
+                done.set_result(None)
+
+    def with_history(self, method, *args, then=None):
+        future = self._history_pool.submit(method, *args)
+        future.add_done_callback(partial(self._history_done, method, then))
+
+    def _history_done(self, method, then, future):
+        if future.exception():
+            logging.error(f"History {method.__name__} failed: {future.exception()}")
+        elif then is not None:
+            self.post(then, future.result())
+
+    def spawn(self, coroutine):
+        # Keep a reference to the task until it is done, the loop only holds a weak one
+        task = self.loop.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logging.error(f"Task failed: {task.exception()}")
+
+    def start_replay(self, username):
+        # The file is read off the loop, then the shared timeline publishes it; a patient already replaying is not
+        # replayed twice, the new chat gets the same messages
+        self.loop.run_in_executor(None, self.wearable_device.add_replay, username)
+
+    def answer_callback(self, query_id, text):
+        self.spawn(self.api('answerCallbackQuery', callback_query_id=query_id, text=text))
+
+    async def api(self, method, **params):
+        """Call a method of the Telegram Bot API and return its result."""
+        params = {key: value for key, value in params.items() if value is not None}
+        if aiohttp is None:
+            # telepot blocks a thread of the default executor, not the loop
+            return await self.loop.run_in_executor(None, partial(getattr(self.bot, method), **params))
+        async with self._session.post(f"{TELEGRAM_API}/bot{self.token}/{method}", json=params) as response:
+            data = await response.json()
+        if not data.get('ok'):
+            raise RuntimeError(f"{method} failed: {data.get('description')}")
+        return data['result']
+
+    def handle_update(self, update):
+        if 'message' in update:
+            self._call(self.on_chat_message, (update['message'],), {})
+        elif 'callback_query' in update:
+            self._call(self.on_callback_msg, (update['callback_query'],), {})
+
+    async def poll_updates(self):
+        offset = None
+        while True:
+            try:
+                updates = await self.api('getUpdates', offset=offset, timeout=POLL_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Failed to get the Telegram updates: {e}")
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            for update in updates:
+                offset = update['update_id'] + 1
+                self.handle_update(update)
+
+    async def main(self):
+        await self.loop.run_in_executor(None, self.mqtt_client.start)
+        if aiohttp is not None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=POLL_TIMEOUT + 10))
+        print('Bot is listening ...')
+        try:
+            await self.poll_updates()
+        finally:
+            if self._session is not None:
+                await self._session.close()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        main = self.loop.create_task(self.main())
+        try:
+            self.loop.run_until_complete(main)
+        except KeyboardInterrupt:
+            main.cancel()
+            for task in list(self._tasks):
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(main, *self._tasks, return_exceptions=True))
+        finally:
+            # The loop runs while the bot stops, the messages being delivered are handled before it closes
+            self.loop.run_until_complete(self.loop.run_in_executor(None, self.stop))
+            self.loop.close()
+
+    def stop_history(self):
+        # The appends of the last messages are written before the history closes
+        self._history_pool.shutdown()
+        super().stop_history()
+
+
+if __name__ == "__main__":
+    mqtt_broker, mqtt_port = broker_address()
+    bot = AsyncBot(TOKEN, mqtt_broker, mqtt_port)
+    Metrics.TextfileExporter('telegram_bot').start()
+    bot.run()
@@ -0,0 +1,128 @@
+'''
+CatalogClient.py is the REST consumer of the catalog shared by the Wearable Device, the ThingSpeak Adaptor and the
+Telegram bot. The catalog is fetched from the /catalog endpoint of App.py and kept in a local cache for ttl seconds;
+after that the client revalidates it with If-None-Match, which costs a 304 without body while the catalog is
+unchanged. watch() follows the change feed of App.py in a thread and calls back the service as soon as the catalog
+changes. When App.py cannot be reached the last catalog received is used, or Catalog.json if there is none yet, so
+the services still start without the web service. SMARTHEALTH_CATALOG_URL changes the default address of App.py.
+The passwords and the write API keys of the users are only sent by App.py to the clients with its service token,
+taken from SMARTHEALTH_SERVICE_TOKEN.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+import requests
+
+DEFAULT_URL = os.environ.get('SMARTHEALTH_CATALOG_URL', 'http://localhost:8080')
+SERVICE_TOKEN = os.environ.get('SMARTHEALTH_SERVICE_TOKEN')
+
+
+class CatalogClient:
+    """Class to read the catalog through REST with a local TTL cache and follow its changes."""
+    def __init__(self, base_url=DEFAULT_URL, ttl=5, timeout=5, fallback_file='Catalog.json', token=SERVICE_TOKEN):
+        self.base_url = base_url.rstrip('/')
+        self.ttl = ttl  # seconds the cached catalog is used without asking App.py
+        self.timeout = timeout
+        self.fallback_file = fallback_file
+        self.session = requests.Session()
+        if token:
+            self.session.headers['Authorization'] = f"Bearer {token}"
+        self.etag = None
+        self._catalog = None
+        self._users_by_name = {}
+        self._users_by_id = {}
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._watcher = None
+
+    def catalog(self):
+        """Return the catalog, from the cache while it is fresh. The result is shared, it must not be modified."""
+        with self._lock:
+            if self._catalog is None or time.monotonic() - self._fetched_at >= self.ttl:
+                self._fetch()
+            return self._catalog
+
+    def users(self):
+        self.catalog()
+        return list(self._users_by_id.values())
+
+    def user(self, username):
+        self.catalog()
+        return self._users_by_name.get(username)
+
+    def user_by_id(self, user_id):
+        self.catalog()
+        return self._users_by_id.get(int(user_id))
+
+    def devices(self):
+        return self.catalog().get('devicesList', [])
+
+    def invalidate(self):
+        with self._lock:
+            self._fetched_at = 0
+
+    def _fetch(self):
+        # Called with the lock held
+        headers = {'If-None-Match': self.etag} if self.etag and self._catalog is not None else {}
+        try:
+            response = self.session.get(f"{self.base_url}/catalog", headers=headers, timeout=self.timeout)
+            if response.status_code == 304:
+                self._fetched_at = time.monotonic()
+                return
+            response.raise_for_status()
+            self._set_catalog(response.json(), response.headers.get('ETag'))
+        except Exception as e:
+            if self._catalog is None:
+                logging.warning(f"Catalog service unavailable ({e}), reading {self.fallback_file}")
+                with open(self.fallback_file, 'r') as f:
+                    self._set_catalog(json.load(f), None)
+            else:
+                logging.warning(f"Catalog service unavailable ({e}), using the cached catalog")
+                self._fetched_at = time.monotonic()
+
+    def _set_catalog(self, catalog, etag):
+        self._catalog = catalog
+        self._users_by_name = {user['username']: user for user in catalog.get('users', [])}
+        self._users_by_id = {user['userID']: user for user in catalog.get('users', [])}
+        self.etag = etag
+        self._fetched_at = time.monotonic()
+
+    def watch(self, callback, poll_timeout=30):
+        """Call callback(catalog) from a thread every time the catalog changes, until stop()."""
+        self._stop_event.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(callback, poll_timeout), name='catalog-feed',
+                                         daemon=True)
+        self._watcher.start()
+
+    def _watch(self, callback, poll_timeout):
+        while not self._stop_event.is_set():
+            self.catalog()
+            since = (self.etag or '').strip('"')
+            try:
+                response = self.session.get(f"{self.base_url}/catalog/changes",
+                                            params={'since': since, 'timeout': poll_timeout},
+                                            timeout=poll_timeout + self.timeout)
+                response.raise_for_status()
+                feed = response.json()
+            except Exception as e:
+                logging.warning(f"Catalog change feed unavailable: {e}")
+                self._stop_event.wait(self.ttl)
+                continue
+            if feed.get('reset') or feed.get('changes'):
+                # The changes are not merged locally, one conditional GET brings the whole new version
+                self.invalidate()
+                try:
+                    callback(self.catalog())
+                except Exception as e:
+                    logging.error(f"Error handling catalog change: {e}")
+
+    def stop(self):
+        self._stop_event.set()
+        if self._watcher:
+            self._watcher.join(self.timeout)
+            self._watcher = None
+        self.session.close()
@@ -0,0 +1,265 @@
+'''
+CatalogStore.py keeps the catalog in memory behind App.py. The users are indexed by username and by userID, reads
+share a readers-writer lock and never touch the disk, and every change is appended to a journal file (one JSON line
+per operation, flushed and synced) before it is applied. The journal is folded into Catalog.json by atomic
+snapshots: the whole catalog is written to a temporary file which then replaces Catalog.json, so the other services
+reading the file never see a half written catalog. On start the snapshot is loaded and the journal replayed.
+Every change also bumps a version counter, which gives the REST API its ETags, and is kept in a short in-memory
+change log that the change feed of App.py hands out to the services waiting on it.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+
+
+class RWLock:
+    """Readers-writer lock, waiting writers go before new readers."""
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class CatalogStore:
+    """Class to serve the catalog from memory and persist its changes through a journal and snapshots."""
+    def __init__(self, path='Catalog.json', snapshot_every=100, snapshot_interval=2, changes_kept=1000):
+        self.path = path
+        self.journal_path = os.path.splitext(path)[0] + '.journal'
+        self.snapshot_every = snapshot_every  # journal entries that trigger a snapshot right away
+        self.snapshot_interval = snapshot_interval  # seconds after which pending entries are snapshotted anyway
+        self._lock = RWLock()
+        self._catalog = {}
+        self._users_by_id = {}  # userID -> user, in catalog order
+        self._users_by_name = {}  # username -> user
+        self._next_id = 1
+        self._pending = 0  # journal entries not in the snapshot yet
+        # The version restarts at every start of the store, the epoch tells the clients that it did
+        self.epoch = str(int(time.time()))
+        self.version = 0
+        self._changes = deque(maxlen=changes_kept)  # (version, journal entry) of the latest changes
+        self._changed = threading.Condition()
+        self._journal = None
+        self._stop_event = threading.Event()
+        self._snapshotter = None
+        self.load()
+
+    def load(self):
+        with self._lock.write():
+            with open(self.path, 'r') as f:
+                self._catalog = json.load(f)
+            users = self._catalog.setdefault('users', [])  # the key keeps its place in the snapshots
+            self._users_by_id = {user['userID']: user for user in users}
+            self._users_by_name = {user['username']: user for user in users}
+            self._next_id = max(self._users_by_id, default=0) + 1
+            replayed = 0
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'r') as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            # A line cut by a crash in the middle of an append, it was never acknowledged
+                            logging.warning(f"Ignoring a truncated entry at the end of {self.journal_path}")
+                            break
+                        self._apply(entry)
+                        replayed += 1
+            self._pending = replayed
+            self._journal = open(self.journal_path, 'a')
+            if replayed:
+                logging.info(f"Replayed {replayed} catalog journal entries")
+                self._snapshot()
+
+    def start(self):
+        self._stop_event.clear()
+        self._snapshotter = threading.Thread(target=self._snapshot_loop, name='catalog-snapshots', daemon=True)
+        self._snapshotter.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._snapshotter:
+            self._snapshotter.join()
+            self._snapshotter = None
+        with self._lock.write():
+            if self._pending:
+                self._snapshot()
+            self._journal.close()
+
+    # Reads, served from memory
+
+    def get_user(self, username):
+        with self._lock.read():
+            user = self._users_by_name.get(username)
+            return dict(user) if user else None
+
+    def get_user_by_id(self, user_id):
+        with self._lock.read():
+            user = self._users_by_id.get(user_id)
+            return dict(user) if user else None
+
+    def users(self):
+        with self._lock.read():
+            return [dict(user) for user in self._users_by_id.values()]
+
+    def catalog(self):
+        """Return a copy of the whole catalog in the format of Catalog.json."""
+        with self._lock.read():
+            return self._as_dict()
+
+    def versioned_catalog(self):
+        """Return the tag of the current version with a copy of the catalog at that version."""
+        with self._lock.read():
+            return self.tag(), self._as_dict()
+
+    def tag(self, version=None):
+        return f"{self.epoch}.{self.version if version is None else version}"
+
+    def changes_since(self, tag, timeout=30):
+        """Wait until the catalog is newer than tag and return (tag, changes).
+
+        changes is the list of journal entries applied after tag, [] if nothing changed before the timeout, and None
+        if tag is from another start of the store or older than the change log: the caller must reload the catalog.
+        """
+        epoch, _, version = (tag or '').partition('.')
+        with self._changed:
+            if epoch != self.epoch or not version.isdigit() or int(version) > self.version:
+                return self.tag(), None
+            version = int(version)
+            self._changed.wait_for(lambda: self.version > version, timeout)
+            if self.version == version:
+                return self.tag(), []
+            if version < self.version - len(self._changes):
+                return self.tag(), None
+            return self.tag(), [entry for entry_version, entry in self._changes if entry_version > version]
+
+    # Writes, journaled before they are applied
+
+    def add_user(self, user):
+        """Add a user and return it with its new userID, raises ValueError if the username is taken."""
+        with self._lock.write():
+            if user['username'] in self._users_by_name:
+                raise ValueError(f"Username {user['username']} already exists")
+            user = dict(user, userID=self._next_id)
+            self._write({"op": "add_user", "user": user})
+            return dict(user)
+
+    def update_user(self, user_id, changes):
+        with self._lock.write():
+            if user_id not in self._users_by_id:
+                raise KeyError(f"User {user_id} not found")
+            username = changes.get('username')
+            if username and username != self._users_by_id[user_id]['username'] and username in self._users_by_name:
+                raise ValueError(f"Username {username} already exists")
+            self._write({"op": "update_user", "userID": user_id, "changes": changes})
+            return dict(self._users_by_id[user_id])
+
+    def delete_user(self, user_id):
+        with self._lock.write():
+            if user_id not in self._users_by_id:
+                raise KeyError(f"User {user_id} not found")
+            self._write({"op": "delete_user", "userID": user_id})
+
+    def _write(self, entry):
+        # Called with the write lock held
+        entry["lastUpdate"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self._journal.write(json.dumps(entry) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._apply(entry)
+        self._pending += 1
+        with self._changed:
+            self.version += 1
+            self._changes.append((self.version, entry))
+            self._changed.notify_all()
+        if self._pending >= self.snapshot_every:
+            self._snapshot()
+
+    def _apply(self, entry):
+        op = entry["op"]
+        # Replaying a journal already folded into the snapshot must not fail: a crash between the replacement of
+        # Catalog.json and the new journal replays entries of users the snapshot has changed or removed since
+        if op == "add_user":
+            user = dict(entry["user"])
+            known = self._users_by_id.get(user['userID'])
+            if known:
+                self._users_by_name.pop(known['username'], None)
+            self._users_by_id[user['userID']] = user
+            self._users_by_name[user['username']] = user
+            self._next_id = max(self._next_id, user['userID'] + 1)
+        elif op == "update_user":
+            user = self._users_by_id.get(entry["userID"])
+            if user:
+                old_username = user['username']
+                user.update(entry["changes"])
+                if user['username'] != old_username:
+                    self._users_by_name.pop(old_username, None)
+                    self._users_by_name[user['username']] = user
+        elif op == "delete_user":
+            user = self._users_by_id.pop(entry["userID"], None)
+            if user:
+                del self._users_by_name[user['username']]
+        self._catalog['lastUpdate'] = entry["lastUpdate"]
+
+    def _as_dict(self):
+        catalog = dict(self._catalog)
+        catalog['users'] = [dict(user) for user in self._users_by_id.values()]
+        return catalog
+
+    def _snapshot(self):
+        # Called with the write lock held: replace Catalog.json atomically, then start a new journal
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._as_dict(), f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if self._journal:
+            self._journal.close()
+        self._journal = open(self.journal_path, 'w')
+        self._pending = 0
+
+    def _snapshot_loop(self):
+        while not self._stop_event.wait(self.snapshot_interval):
+            if not self._pending:
+                continue
+            try:
+                with self._lock.write():
+                    if self._pending:
+                        self._snapshot()
+            except Exception as e:
+                logging.error(f"Failed to snapshot the catalog: {e}")
@@ -0,0 +1,189 @@
+'''
+Credentials.py stores the passwords of the catalog as salted scrypt hashes ("scrypt$n$r$p$salt$hash") and checks
+the logins of App.py and of the Telegram bot. A slow hash is what makes a stolen catalog useless, but it costs tens of
+milliseconds of CPU per check, so the checks run in a small bounded worker pool: a burst of logins queues there
+instead of taking every CherryPy or telepot thread, and is refused once the queue is full. A successful check is
+remembered for a few minutes per session (the CherryPy session or the Telegram chat), so the next operations of the
+same caregiver with the same password do not hash again. Passwords still stored in plain text are accepted and
+reported as needing a rehash, which is how the existing catalog entries are migrated.
+'''
+
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+SCHEME = 'scrypt'
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+
+class VerifierBusy(Exception):
+    """Raised when too many password checks are already waiting."""
+
+
+def _b64(data):
+    return base64.b64encode(data).decode()
+
+
+def hash_password(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    salt = os.urandom(SALT_BYTES)
+    key = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=KEY_BYTES)
+    return f"{SCHEME}${n}${r}${p}${_b64(salt)}${_b64(key)}"
+
+
+def is_hashed(stored):
+    return isinstance(stored, str) and stored.startswith(SCHEME + '$')
+
+
+def needs_rehash(stored):
+    """True for plain text passwords and for hashes made with other parameters than the current ones."""
+    if not is_hashed(stored):
+        return True
+    _, n, r, p, _, _ = stored.split('$')
+    return (int(n), int(r), int(p)) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
+
+
+def check_password(password, stored):
+    """Compare a password with a stored hash, or with a plain text password not migrated yet."""
+    if not isinstance(password, str) or not isinstance(stored, str):
+        return False
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode(), stored.encode())
+    try:
+        _, n, r, p, salt, key = stored.split('$')
+        key = base64.b64decode(key)
+        candidate = hashlib.scrypt(password.encode(), salt=base64.b64decode(salt), n=int(n), r=int(r), p=int(p),
+                                   dklen=len(key))
+    except ValueError as e:
+        logging.error(f"Malformed password hash: {e}")
+        return False
+    return hmac.compare_digest(candidate, key)
+
+
+def migrate_store(store):
+    """Hash the plain text passwords of a CatalogStore, returns the number of users migrated."""
+    migrated = 0
+    for user in store.users():
+        if not is_hashed(user.get('password')):
+            store.update_user(user['userID'], {'password': hash_password(user['password'])})
+            migrated += 1
+    if migrated:
+        logging.info(f"Hashed the plain text passwords of {migrated} users")
+    return migrated
+
+
+class CredentialVerifier:
+    """Class to check passwords in a bounded worker pool and cache the successful checks per session."""
+    def __init__(self, workers=2, max_pending=32, cache_ttl=300):
+        self.cache_ttl = cache_ttl  # seconds a successful check is reused by the same session
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='credentials')
+        self._slots = threading.BoundedSemaphore(max_pending)  # checks running or queued
+        self._cache = {}  # (session, username, stored hash, password digest) -> expiry time
+        self._cache_lock = threading.Lock()
+        # The cache never holds passwords, only a keyed digest that is worthless outside this process
+        self._secret = os.urandom(32)
+
+    def _cache_key(self, session, username, password, stored):
+        digest = hmac.new(self._secret, str(password).encode(), hashlib.sha256).digest()
+        return session, username, stored, digest
+
+    def cached(self, session, username, password, stored):
+        key = self._cache_key(session, username, password, stored)
+        with self._cache_lock:
+            expiry = self._cache.get(key)
+            if expiry is None:
+                return False
+            if expiry < time.monotonic():
+                del self._cache[key]
+                return False
+            return True
+
+    def submit(self, session, username, password, stored):
+        """Start a check and return a Future of its result, raises VerifierBusy when the pool is full."""
+        if self.cached(session, username, password, stored):
+            future = Future()
+            future.set_result(True)
+            return future
+        if not self._slots.acquire(blocking=False):
+            raise VerifierBusy("Too many logins in progress, please try again in a moment")
+        try:
+            return self._pool.submit(self._check, session, username, password, stored)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def verify(self, session, username, password, stored, timeout=10):
+        """Check a password and wait for the result, for the callers that answer in the same request."""
+        if self.cached(session, username, password, stored):
+            return True
+        return self.submit(session, username, password, stored).result(timeout)
+
+    def hash(self, password, timeout=10):
+        """Hash a new password in the pool, raises VerifierBusy when the pool is full."""
+        if not self._slots.acquire(blocking=False):
+            raise VerifierBusy("Too many logins in progress, please try again in a moment")
+        try:
+            future = self._pool.submit(self._hash, password)
+        except Exception:
+            self._slots.release()
+            raise
+        return future.result(timeout)
+
+    def rehash(self, password, then):
+        """Hash a password again in the pool and call then(new hash) from it, without waiting for it.
+
+        Returns False when the pool is full, the rehash is then left to a later login.
+        """
+        if not self._slots.acquire(blocking=False):
+            return False
+        try:
+            future = self._pool.submit(self._hash, password)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(partial(self._rehashed, then))
+        return True
+
+    def _rehashed(self, then, future):
+        try:
+            then(future.result())
+        except Exception as e:
+            logging.error(f"Failed to store a new password hash: {e}")
+
+    def _hash(self, password):
+        try:
+            return hash_password(password)
+        finally:
+            self._slots.release()
+
+    def _check(self, session, username, password, stored):
+        try:
+            valid = check_password(password, stored)
+        finally:
+            self._slots.release()
+        if valid:
+            now = time.monotonic()
+            key = self._cache_key(session, username, password, stored)
+            with self._cache_lock:
+                # Drop the expired entries now and then, the cache stays as small as the active sessions
+                if len(self._cache) > 1024:
+                    self._cache = {k: expiry for k, expiry in self._cache.items() if expiry >= now}
+                self._cache[key] = now + self.cache_ttl
+        return valid
+
+    def forget(self, session):
+        """Drop the cached checks of a session, e.g. on logout."""
+        with self._cache_lock:
+            self._cache = {key: expiry for key, expiry in self._cache.items() if key[0] != session}
+
+    def stop(self):
+        self._pool.shutdown(wait=False)
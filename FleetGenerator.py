@@ -0,0 +1,290 @@
+'''
+FleetGenerator.py creates synthetic patients to test the platform far beyond the three sample files. Every patient
+has a home scattered around the city and, like the sample files, one row per minute with:
+- a heart rate around a baseline of its own, lower at night, with a beat to beat variability (a first order
+  autoregressive process) and a few bursts of activity a day, the strongest ones above the normal range;
+- a blood oxygen around 96% with short dips, the deepest ones below 90%;
+- a GPS position every 20 minutes wandering around the home, with now and then an excursion beyond the 500 meters
+  of the home zone.
+The patients are generated by blocks with NumPy, every block from its own generator seeded with (seed, block), so the
+same seed gives the same fleet and a fleet of 10000 patients over 24 hours takes seconds. A fleet is either streamed
+(patients() yields the catalog entry and the columns of every patient, and the LazyBlocks of lazy_blocks() generate
+their patients at the first access, which is how WearableDevice.replay_fleet replays them without any file) or
+written in bulk with its Catalog.json, as CSV files or as "{username}.patient" directories of PatientData, which the
+Wearable Device reads without parsing anything.
+
+    python FleetGenerator.py --patients 10000 --hours 24 [--format patient|csv] [--seed 0] [--output fleet]
+    cd fleet && python ../WearableDevice.py --speedup 0
+'''
+
+import argparse
+import json
+import logging
+import math
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+import PatientData
+
+# Setup basic logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+CITY_CENTER = (45.0703, 7.6869)  # Turin, where the sample patients live
+CITY_RADIUS = 6000  # meters around the center where the homes are
+METERS_PER_DEGREE = 111320  # of latitude, and of longitude at the equator
+SAMPLE_PERIOD = 60  # seconds between two rows, as in the sample files
+GPS_EVERY = 20  # rows between two GPS positions, as in the sample files
+FLEET_START = '2017-10-01 00:00'  # time of the first row in the CSV files
+BLOCK_PATIENTS = 500  # patients generated at once
+FIRST_USER_ID = 1000
+FIRST_CHANNEL_ID = 900000
+USERS_PER_CHANNEL = 4  # two fields per patient in the eight of a ThingSpeak channel
+PASSWORD = 'fleet'  # in plain text, hashed at the first login like the other catalog entries
+
+# Heart rate: baseline, variability (autoregressive, per minute) and activity bursts
+HEART_RATE_BASELINE = (76, 6)  # mean and standard deviation of the baselines, bpm
+HEART_RATE_PHI = 0.7
+HEART_RATE_SIGMA = 5
+ACTIVITIES_PER_DAY = 3
+ACTIVITY_ROWS = (10, 45)
+ACTIVITY_BOOST = (10, 35)  # bpm at the top of a burst
+# Blood oxygen: baseline, noise and dips
+BLOOD_OXYGEN_BASELINE = (0.965, 0.008)
+BLOOD_OXYGEN_NOISE = 0.007
+DIPS_PER_DAY = 6  # on average, some patients have many more than others
+DIP_ROWS = (2, 12)
+DIP_DEPTH = (0.02, 0.09)
+# GPS: wander around the home (autoregressive, per position) and excursions away from it
+WANDER_PHI = 0.8
+WANDER_SIGMA = 70  # meters
+EXCURSIONS_PER_DAY = 0.5
+EXCURSION_POSITIONS = (2, 9)
+EXCURSION_DISTANCE = (600, 3000)  # meters
+
+
+def episodes(rng, counts, rows, lengths):
+    """Random episodes, counts[i] of them for patient i, each lasting a number of rows in the lengths range.
+
+    Returns, for every row covered by an episode, the index of the episode, its patient, the row and the progress of
+    the episode on that row, in [0, 1).
+    """
+    patient = np.repeat(np.arange(len(counts)), counts)
+    start = rng.integers(0, rows, len(patient))
+    length = rng.integers(lengths[0], lengths[1] + 1, len(patient))
+    step = np.arange(lengths[1])
+    episode, offset = np.nonzero((step < length[:, None]) & (start[:, None] + step < rows))
+    return episode, patient[episode], start[episode] + offset, offset / length[episode]
+
+
+def autoregressive(rng, rows, patients, phi, sigma):
+    """A first order autoregressive process per patient, as a (rows, patients) array."""
+    values = rng.normal(0, sigma, (rows, patients))
+    # Only the recursion over the rows is a loop, every step is vectorized over the patients
+    for row in range(1, rows):
+        values[row] += phi * values[row - 1]
+    return values
+
+
+class SyntheticPatient(PatientData.PatientFile):
+    """Columns of a generated patient held in memory, read like a PatientFile."""
+    def __init__(self, columns, offsets):
+        self.directory = None
+        self.rows = len(offsets)
+        self.integer_columns = {"Heart Rate"}
+        self.columns = dict(columns, Offset=offsets)
+
+
+class LazyBlock:
+    """Block of patients of a fleet, generated when one of its patients is first asked for, from any thread."""
+    def __init__(self, fleet, first, count):
+        self.fleet = fleet
+        self.first = first
+        self.count = count
+        self._columns = None
+        self._lock = threading.Lock()
+
+    def patient(self, index):
+        """(catalog entry, SyntheticPatient) of the index-th patient of the fleet, which must be in the block."""
+        with self._lock:
+            if self._columns is None:
+                self._columns = self.fleet.generate_block(self.first, self.count)
+        row = index - self.first
+        return self.fleet.user(index), SyntheticPatient(
+            {name: values[row] for name, values in self._columns.items()}, self.fleet.offsets)
+
+
+class FleetGenerator:
+    """Class to generate a seeded fleet of synthetic patients."""
+    def __init__(self, patients, hours=24, seed=0, first_user_id=FIRST_USER_ID, center=CITY_CENTER,
+                 radius=CITY_RADIUS, block_patients=BLOCK_PATIENTS):
+        self.count = patients
+        self.hours = hours
+        self.seed = seed
+        self.first_user_id = first_user_id
+        self.center = center
+        self.radius = radius
+        self.block_patients = block_patients
+        self.rows = int(hours * 3600 // SAMPLE_PERIOD)
+        self.offsets = np.arange(self.rows, dtype=np.int64) * SAMPLE_PERIOD
+        self.latitudes, self.longitudes = self._homes()
+
+    def _homes(self):
+        rng = np.random.default_rng([self.seed, 0])
+        # Uniform in the disc of the city
+        distance = self.radius * np.sqrt(rng.random(self.count))
+        angle = rng.uniform(0, 2 * np.pi, self.count)
+        latitude = self.center[0] + distance * np.cos(angle) / METERS_PER_DEGREE
+        longitude = self.center[1] + distance * np.sin(angle) / (
+            METERS_PER_DEGREE * math.cos(math.radians(self.center[0])))
+        return latitude, longitude
+
+    def user(self, index):
+        """The catalog entry of the index-th patient of the fleet."""
+        user_id = self.first_user_id + index
+        channel = index // USERS_PER_CHANNEL
+        return {
+            "userID": user_id,
+            "name": "Patient",
+            "surname": str(user_id),
+            "username": f"patient{user_id}",
+            "password": PASSWORD,
+            "latitude": round(float(self.latitudes[index]), 8),
+            "longitude": round(float(self.longitudes[index]), 8),
+            "csvFile": f"patient{user_id}.csv",
+            "thingSpeakChannelID": str(FIRST_CHANNEL_ID + channel),
+            "thingSpeakWriteAPIKey": f"FLEET{channel:011d}"
+        }
+
+    def users(self):
+        return [self.user(index) for index in range(self.count)]
+
+    def catalog(self, template=None):
+        """A catalog of the fleet, with the devices of template (the Catalog.json of the platform by default)."""
+        template = template or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Catalog.json')
+        catalog = {"projectName": "Synthetic fleet", "devicesList": []}
+        if os.path.exists(template):
+            with open(template, 'r') as f:
+                catalog = json.load(f)
+        catalog["lastUpdate"] = time.strftime('%Y-%m-%d %H:%M')
+        catalog["users"] = self.users()
+        return catalog
+
+    def blocks(self):
+        """Yield (index of the first patient, columns) per block, the columns being (patients, rows) arrays."""
+        for first in range(0, self.count, self.block_patients):
+            yield first, self.generate_block(first, min(self.block_patients, self.count - first))
+
+    def lazy_blocks(self):
+        """Return the LazyBlocks of the fleet, nothing is generated yet."""
+        return [LazyBlock(self, first, min(self.block_patients, self.count - first))
+                for first in range(0, self.count, self.block_patients)]
+
+    def patients(self):
+        """Yield (catalog entry, SyntheticPatient) for every patient, generated block by block."""
+        for first, columns in self.blocks():
+            for index in range(len(columns["Heart Rate"])):
+                patient = SyntheticPatient({name: values[index] for name, values in columns.items()}, self.offsets)
+                yield self.user(first + index), patient
+
+    def generate_block(self, first, count):
+        rng = np.random.default_rng([self.seed, 1, first])
+        latitude, longitude = self._positions(rng, first, count)
+        return {
+            "Heart Rate": self._heart_rate(rng, count),
+            "Blood Oxygen": self._blood_oxygen(rng, count),
+            "Latitude": latitude,
+            "Longitude": longitude
+        }
+
+    def _heart_rate(self, rng, count):
+        baseline = rng.normal(*HEART_RATE_BASELINE, count).clip(60, 92)
+        amplitude = rng.uniform(3, 9, count)
+        hour_of_day = self.offsets / 3600 % 24
+        # Lowest around 4 in the morning
+        circadian = -amplitude[:, None] * np.cos(2 * np.pi * (hour_of_day - 4) / 24)
+        values = baseline[:, None] + circadian + autoregressive(rng, self.rows, count, HEART_RATE_PHI,
+                                                                HEART_RATE_SIGMA).T
+        counts = rng.poisson(ACTIVITIES_PER_DAY * self.hours / 24, count)
+        episode, patient, row, progress = episodes(rng, counts, self.rows, ACTIVITY_ROWS)
+        boost = rng.uniform(*ACTIVITY_BOOST, counts.sum())
+        np.add.at(values, (patient, row), boost[episode] * np.sin(np.pi * progress))
+        # Whole numbers like the sample files
+        return np.rint(values).clip(40, 180)
+
+    def _blood_oxygen(self, rng, count):
+        baseline = rng.normal(*BLOOD_OXYGEN_BASELINE, count).clip(0.94, 0.99)
+        values = baseline[:, None] + rng.normal(0, BLOOD_OXYGEN_NOISE, (count, self.rows))
+        # Some patients dip much more often than others
+        counts = rng.poisson(rng.gamma(2.0, DIPS_PER_DAY / 2, count) * self.hours / 24)
+        episode, patient, row, progress = episodes(rng, counts, self.rows, DIP_ROWS)
+        depth = rng.uniform(*DIP_DEPTH, counts.sum())
+        np.subtract.at(values, (patient, row), depth[episode] * np.sin(np.pi * progress))
+        return np.round(values, 2).clip(0.80, 1.0)
+
+    def _positions(self, rng, first, count):
+        fixes = len(range(0, self.rows, GPS_EVERY))
+        north = autoregressive(rng, fixes, count, WANDER_PHI, WANDER_SIGMA).T
+        east = autoregressive(rng, fixes, count, WANDER_PHI, WANDER_SIGMA).T
+        counts = rng.poisson(EXCURSIONS_PER_DAY * self.hours / 24, count)
+        episode, patient, fix, progress = episodes(rng, counts, fixes, EXCURSION_POSITIONS)
+        excursions = counts.sum()
+        distance = rng.uniform(*EXCURSION_DISTANCE, excursions)
+        angle = rng.uniform(0, 2 * np.pi, excursions)
+        # Excursions of a patient can overlap, np.add.at sums them where += would keep only one
+        np.add.at(north, (patient, fix), distance[episode] * np.cos(angle[episode]))
+        np.add.at(east, (patient, fix), distance[episode] * np.sin(angle[episode]))
+
+        homes = slice(first, first + count)
+        latitude = np.full((count, self.rows), np.nan)
+        longitude = np.full((count, self.rows), np.nan)
+        latitude[:, ::GPS_EVERY] = self.latitudes[homes, None] + north / METERS_PER_DEGREE
+        longitude[:, ::GPS_EVERY] = self.longitudes[homes, None] + east / (
+            METERS_PER_DEGREE * np.cos(np.radians(self.latitudes[homes, None])))
+        return latitude, longitude
+
+    def write(self, directory, file_format='patient', template=None):
+        """Write every patient and the Catalog.json of the fleet into directory, returns the catalog."""
+        if file_format not in ('patient', 'csv'):
+            raise ValueError(f"Unknown format {file_format}")
+        os.makedirs(directory, exist_ok=True)
+        if file_format == 'csv':
+            timeline = pd.Timestamp(FLEET_START) + pd.to_timedelta(self.offsets, unit='s')
+            ids = timeline.strftime('%m/%d/%Y %H:%M')
+            # The time of the position on the rows with GPS, as in the sample files
+            times = np.where(np.arange(self.rows) % GPS_EVERY == 0, timeline.strftime('%H:%M:%S'), '')
+        for user, patient in self.patients():
+            if file_format == 'csv':
+                pd.DataFrame({
+                    "ID": ids,
+                    "Heart Rate": patient["Heart Rate"].astype(np.int64),
+                    "Blood Oxygen": patient["Blood Oxygen"],
+                    "Time": times,
+                    "Latitude": patient["Latitude"],
+                    "Longitude": patient["Longitude"]
+                }).to_csv(os.path.join(directory, user['csvFile']), index=False, float_format='%.10g')
+            else:
+                PatientData.write(os.path.join(directory, user['username'] + PatientData.DIRECTORY_SUFFIX),
+                                  patient.columns, self.offsets, patient.integer_columns, source=user['csvFile'])
+        catalog = self.catalog(template)
+        with open(os.path.join(directory, 'Catalog.json'), 'w') as f:
+            json.dump(catalog, f, indent=4)
+        return catalog
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a fleet of synthetic patients and their catalog.")
+    parser.add_argument('--patients', type=int, default=100, help="number of patients")
+    parser.add_argument('--hours', type=float, default=24, help="hours of data per patient, one row per minute")
+    parser.add_argument('--seed', type=int, default=0, help="seed, the same seed gives the same fleet")
+    parser.add_argument('--first-user-id', type=int, default=FIRST_USER_ID, help="userID of the first patient")
+    parser.add_argument('--format', choices=['patient', 'csv'], default='patient',
+                        help="normalized patient directories (fast) or CSV files like the sample ones")
+    parser.add_argument('--output', default='fleet', help="directory of the files and of the Catalog.json")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    fleet = FleetGenerator(args.patients, args.hours, args.seed, args.first_user_id)
+    fleet.write(args.output, args.format)
+    logging.info(f"Generated {args.patients} patients x {fleet.rows} rows into {args.output} "
+                 f"in {time.perf_counter() - start:.1f}s")
@@ -3,13 +3,262 @@ GPS_Tracker.py is used to monitor patients’ location and check if they are get
 In this IoT platform we are using ”folium” library of Python to demonstrate the location of users on the map. 
 It consists of functions for calculating distance and creating html file and it is used in Telegram bot 
 through Object-Oriented Programming (OOP). 
+The alert maps of the bot are made by MapRenderer: the Leaflet page is a template compiled once, every map only
+substitutes its coordinates, home marker, safe zone circle and recent track into it, and the HTML is returned as bytes
+without building a folium map or writing a file. The page is kept in an LRU cache keyed by the user and the rounded
+positions, and the recent track, which changes with every GPS sample, is inserted into the cached page at every call.
+GeofenceEngine checks positions against several safe zones per patient (circles, such as the home, and polygons).
+The zones are projected once on a local plane in meters, the positions are evaluated as NumPy arrays, a grid index
+limits the zones tested when a patient has many of them, and the enter/exit transitions have a hysteresis margin so
+that a patient walking along the boundary does not raise an alert at every sample.
 '''
 
 import folium
 import pandas as pd
 import math
+import json
+import threading
+from collections import OrderedDict
+from string import Template
+import numpy as np
+
+# Same Leaflet release and tiles as the folium maps, in a page compiled once
+MAP_TEMPLATE = Template('''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>User $user_id location</title>
+<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.css"/>
+<script src="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js"></script>
+<style>html, body, #map {width: 100%; height: 100%; margin: 0; padding: 0;}</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+var data = $data;
+var track = $track;
+var map = L.map("map").setView(data.position, 15);
+L.tileLayer("https://tile.openstreetmap.org/{z}/{x}/{y}.png", {
+    maxZoom: 19, attribution: "&copy; OpenStreetMap contributors"
+}).addTo(map);
+L.marker(data.position).bindPopup(data.label).addTo(map);
+if (data.home) {
+    L.marker(data.home, {opacity: 0.7}).bindPopup("Home").addTo(map);
+    if (data.radius) {
+        L.circle(data.home, {radius: data.radius, color: "green", fillOpacity: 0.1}).addTo(map);
+    }
+}
+if (track.length > 1) {
+    L.polyline(track, {color: "red", weight: 3}).addTo(map);
+}
+</script>
+</body>
+</html>
+''')
+
+
+TRACK_SLOT = b'$track'  # left in the cached pages, replaced by the track of every map
+
+
+class MapRenderer:
+    """Class to render the location maps from a precompiled template, with an LRU cache of the pages."""
+    def __init__(self, cache_size=256, precision=5):
+        self.cache_size = cache_size
+        self.precision = precision  # decimals kept in the coordinates, 5 is about one meter
+        self._cache = OrderedDict()  # key -> HTML bytes before and after the track, least recently used first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _point(self, latitude, longitude):
+        return round(float(latitude), self.precision), round(float(longitude), self.precision)
+
+    def render(self, user_id, latitude, longitude, home=None, radius=None, track=()):
+        """Return the HTML page of the map as bytes, home is (latitude, longitude) and track a list of points."""
+        position = self._point(latitude, longitude)
+        home = self._point(*home) if home else None
+        # Only numbers, no value can close the script element
+        track = json.dumps([self._point(*point) for point in track]).encode()
+        key = (user_id, position, home, radius)
+        with self._lock:
+            parts = self._cache.get(key)
+            if parts is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return parts[0] + track + parts[1]
+            self.misses += 1
+        data = {"position": position, "label": f"User {user_id} Location", "home": home, "radius": radius}
+        # "</" is escaped so that no value can close the script element
+        page = MAP_TEMPLATE.substitute(user_id=int(user_id), data=json.dumps(data).replace('</', '<\\/'),
+                                       track=TRACK_SLOT.decode()).encode()
+        parts = page.split(TRACK_SLOT, 1)
+        with self._lock:
+            self._cache[key] = parts
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return parts[0] + track + parts[1]
+
+EARTH_RADIUS = 6371e3  # meters
+
+
+class GeofenceEngine:
+    """Class to evaluate arrays of positions against the safe zones of the patients."""
+    def __init__(self, hysteresis=25.0, cell_size=500.0, index_threshold=8):
+        self.hysteresis = hysteresis  # meters beyond the zones before a patient is reported out of zone
+        self.cell_size = cell_size  # meters, side of the cells of the grid index
+        self.index_threshold = index_threshold  # zones from which a patient gets a grid index
+        self._zones = {}  # user ID -> compiled zones
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def zones_of(user, radius):
+        """Zones of a catalog user: the home circle of the GPS rule radius and the optional "safeZones".
+
+        A safe zone is {"name", "latitude", "longitude", "radius"} for a circle or {"name", "polygon": [[lat, lon],
+        ...]} for a polygon.
+        """
+        zones = [{"name": "home", "latitude": user['latitude'], "longitude": user['longitude'], "radius": radius}]
+        return zones + list(user.get('safeZones', []))
+
+    def set_zones(self, user_id, zones):
+        compiled = self._compile(zones)
+        with self._lock:
+            self._zones[user_id] = compiled
+
+    def has_zones(self, user_id):
+        with self._lock:
+            return user_id in self._zones
+
+    def _compile(self, zones):
+        # Local equirectangular projection around the first zone, accurate to well under a meter at city scale
+        first = zones[0]
+        lat0, lon0 = (first['latitude'], first['longitude']) if 'radius' in first else first['polygon'][0]
+        compiled = {"origin": (math.radians(lat0), math.radians(lon0)), "names": [],
+                    "circles": [], "polygons": [], "bounds": []}
+        centers, radii = [], []
+        for zone in zones:
+            if 'radius' in zone:
+                x, y = self._project(compiled, zone['latitude'], zone['longitude'])
+                centers.append((float(x), float(y)))
+                radii.append(float(zone['radius']))
+                compiled["circles"].append(len(compiled["names"]))
+                compiled["bounds"].append((x - zone['radius'], y - zone['radius'], x + zone['radius'],
+                                           y + zone['radius']))
+            else:
+                points = np.asarray(zone['polygon'], dtype=float)
+                x, y = self._project(compiled, points[:, 0], points[:, 1])
+                vertices = np.column_stack([x, y])
+                compiled["polygons"].append((len(compiled["names"]), vertices))
+                compiled["bounds"].append((x.min(), y.min(), x.max(), y.max()))
+            compiled["names"].append(zone.get('name', f"zone {len(compiled['names']) + 1}"))
+        compiled["centers"] = np.asarray(centers, dtype=float).reshape(-1, 2)
+        compiled["radii"] = np.asarray(radii, dtype=float)
+        compiled["grid"] = self._build_grid(compiled) if len(zones) >= self.index_threshold else None
+        return compiled
+
+    def _project(self, compiled, latitudes, longitudes):
+        lat0, lon0 = compiled["origin"]
+        x = EARTH_RADIUS * (np.radians(longitudes) - lon0) * math.cos(lat0)
+        y = EARTH_RADIUS * (np.radians(latitudes) - lat0)
+        return x, y
+
+    def _build_grid(self, compiled):
+        # Every zone is registered in the cells its bounding box touches, grown by the hysteresis margin
+        grid = {}
+        margin = self.hysteresis
+        for zone, (x0, y0, x1, y1) in enumerate(compiled["bounds"]):
+            for cx in range(int(math.floor((x0 - margin) / self.cell_size)),
+                            int(math.floor((x1 + margin) / self.cell_size)) + 1):
+                for cy in range(int(math.floor((y0 - margin) / self.cell_size)),
+                                int(math.floor((y1 + margin) / self.cell_size)) + 1):
+                    grid.setdefault((cx, cy), []).append(zone)
+        return grid
+
+    def outside_distances(self, user_id, latitudes, longitudes):
+        """Meters from every position to the nearest zone, 0 inside a zone and NaN for missing positions.
+
+        With a grid index the positions farther than the hysteresis margin from every zone may get inf instead of
+        their distance.
+        """
+        with self._lock:
+            compiled = self._zones[user_id]
+        x, y = self._project(compiled, np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float))
+        x, y = np.atleast_1d(x), np.atleast_1d(y)
+        if compiled["grid"] is None:
+            distances = self._distances(compiled, x, y, range(len(compiled["names"])))
+        else:
+            distances = np.full(len(x), np.inf)
+            valid = ~(np.isnan(x) | np.isnan(y))
+            cells = np.floor(np.column_stack([x[valid], y[valid]]) / self.cell_size).astype(np.int64)
+            indexes = np.flatnonzero(valid)
+            if len(cells):
+                keys, inverse = np.unique(cells, axis=0, return_inverse=True)
+                inverse = inverse.reshape(-1)
+                for group, (cx, cy) in enumerate(keys.tolist()):
+                    zones = compiled["grid"].get((cx, cy))
+                    if zones:
+                        members = indexes[inverse == group]
+                        distances[members] = self._distances(compiled, x[members], y[members], zones)
+        distances[np.isnan(x) | np.isnan(y)] = np.nan
+        return distances
+
+    def _distances(self, compiled, x, y, zones):
+        distances = np.full(len(x), np.inf)
+        zones = set(zones)
+        circles = [i for i, zone in enumerate(compiled["circles"]) if zone in zones]
+        if circles:
+            centers = compiled["centers"][circles]
+            gaps = np.hypot(x[:, None] - centers[:, 0], y[:, None] - centers[:, 1]) - compiled["radii"][circles]
+            distances = np.minimum(distances, np.maximum(gaps, 0).min(axis=1))
+        for zone, vertices in compiled["polygons"]:
+            if zone in zones:
+                distances = np.minimum(distances, self._polygon_distances(vertices, x, y))
+        return distances
+
+    def _polygon_distances(self, vertices, x, y):
+        # Ray casting for the inside test and point to segment distances to the edges, positions x edges at once
+        start = vertices
+        end = np.roll(vertices, -1, axis=0)
+        px, py = x[:, None], y[:, None]
+        crosses = (start[:, 1] > py) != (end[:, 1] > py)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            at_x = start[:, 0] + (py - start[:, 1]) * (end[:, 0] - start[:, 0]) / (end[:, 1] - start[:, 1])
+        inside = (crosses & (px < at_x)).sum(axis=1) % 2 == 1
+        edge = end - start
+        length = (edge ** 2).sum(axis=1)
+        length[length == 0] = 1
+        t = np.clip(((px - start[:, 0]) * edge[:, 0] + (py - start[:, 1]) * edge[:, 1]) / length, 0, 1)
+        distances = np.hypot(px - (start[:, 0] + t * edge[:, 0]), py - (start[:, 1] + t * edge[:, 1])).min(axis=1)
+        return np.where(inside, 0, distances)
+
+    def evaluate(self, user_id, latitudes, longitudes, state):
+        """Return the out of zone mask of the positions and their transitions, in order.
+
+        state is a dict kept by the caller between two calls for the same stream of positions. A patient inside goes
+        out when farther than the hysteresis margin from every zone and comes back when inside a zone again, the
+        positions in between keep the current state. The transitions are (index, "exit" or "enter", distance).
+        """
+        distances = self.outside_distances(user_id, latitudes, longitudes)
+        outside_before = state.get("outside", False)
+        # -1 keeps the state, 1 exits and 0 enters, carried forward to the next event
+        events = np.where(distances > self.hysteresis, 1, np.where(distances <= 0, 0, -1))
+        positions = np.where(events >= 0, np.arange(len(events)), -1)
+        last = np.maximum.accumulate(positions) if len(positions) else positions
+        outside = np.where(last >= 0, events[np.maximum(last, 0)] == 1, outside_before)
+        previous = np.concatenate([[outside_before], outside[:-1]])
+        transitions = [(index, "exit" if outside[index] else "enter", float(distances[index]))
+                       for index in np.flatnonzero(outside != previous).tolist()]
+        if len(outside):
+            state["outside"] = bool(outside[-1])
+        return outside, transitions
+
 
 class GPSTracker:
+    def __init__(self):
+        self.renderer = MapRenderer()
+        self.geofences = GeofenceEngine()
 
     def create_html_map(self, latitude, longitude, user_id):
         # Create a map centered around the given latitude and longitude
@@ -24,6 +273,10 @@ class GPSTracker:
 
         return html_file_path
 
+    def render_map(self, latitude, longitude, user_id, home=None, radius=None, track=()):
+        # In-memory alternative to create_html_map, the page is cached and never written to disk
+        return self.renderer.render(user_id, latitude, longitude, home, radius, track)
+
     def distance(self, lat1, lon1, lat2, lon2):
         # Haversine formula
         R = 6371e3  # Radius of Earth in meters
@@ -35,3 +288,17 @@ class GPSTracker:
         c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
 
         return R * c
+
+    def distances(self, lat, lon, latitudes, longitudes):
+        # Vectorized haversine from one point to arrays of points, NaN coordinates give NaN distances
+        R = 6371e3  # Radius of Earth in meters
+        latitudes = np.asarray(latitudes, dtype=float)
+        longitudes = np.asarray(longitudes, dtype=float)
+        phi1, phi2 = math.radians(lat), np.radians(latitudes)
+        delta_phi = phi2 - phi1
+        delta_lambda = np.radians(longitudes - lon)
+
+        a = np.sin(delta_phi / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin(delta_lambda / 2) ** 2
+        c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+        return R * c
@@ -0,0 +1,480 @@
+'''
+LocalBroker.py is a small MQTT 3.1.1 broker to run the platform without the public broker, on a laptop without
+network or in the benchmarks. It implements what the services of the platform use: CONNECT with clean or persistent
+sessions and last will, PUBLISH with QoS 0, 1 and 2 (the QoS 2 handshake with the publisher is done, the subscribers
+are granted at most QoS 1 as the protocol allows), retained messages, SUBSCRIBE and UNSUBSCRIBE with the + and #
+wildcards, PINGREQ and DISCONNECT. The subscriptions are matched with the TopicTrie of MyMQTT. Every connection has a
+reader thread and a writer thread, so a slow subscriber never holds up the publishers.
+The subscriptions of a persistent session (clean session flag not set) are kept when its client disconnects, with
+its QoS 1 messages: the unacknowledged ones are sent again with the DUP flag when the client comes back, followed by
+the ones published meanwhile (at most PARKED_MESSAGES, the oldest are dropped). The sessions are kept in memory only.
+Point the services to it with SMARTHEALTH_MQTT_BROKER=localhost (and SMARTHEALTH_MQTT_PORT if not 1883).
+
+    python LocalBroker.py [--host 127.0.0.1] [--port 1883]
+'''
+
+import argparse
+import collections
+import itertools
+import logging
+import queue
+import socket
+import struct
+import threading
+import time
+from MyMQTT import TopicTrie
+
+# Setup basic logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+MAX_QOS = 1  # highest QoS granted to the subscribers
+WRITE_BATCH = 64  # packets joined into a single send
+PARKED_MESSAGES = 10000  # messages kept for a disconnected persistent session
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def packet(packet_type, body=b'', flags=0):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+def encode_string(text):
+    data = text.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+def read_string(body, offset):
+    length, = struct.unpack_from('!H', body, offset)
+    start = offset + 2
+    if start + length > len(body):
+        raise ProtocolError("string longer than its packet")
+    return body[start:start + length].decode('utf-8'), start + length
+
+
+def valid_filter(topic_filter):
+    levels = topic_filter.split('/')
+    for index, level in enumerate(levels):
+        if ('#' in level and (level != '#' or index != len(levels) - 1)) or ('+' in level and level != '+'):
+            return False
+        # Named levels are a MyMQTT pattern, not an MQTT filter
+        if level.startswith('{') and level.endswith('}'):
+            return False
+    return bool(topic_filter)
+
+
+class Session:
+    """One client connection, with its reader and writer threads."""
+    def __init__(self, broker, sock, address):
+        self.broker = broker
+        self.sock = sock
+        self.address = address
+        self.client_id = None
+        self.clean = True
+        self.subscriptions = {}  # filter -> granted QoS
+        self.inflight = {}  # packet ID -> (topic, payload, qos) of the unacknowledged messages of a persistent session
+        self.will = None  # (topic, payload, qos, retain) published if the connection is lost
+        self.awaiting_release = set()  # ids of the QoS 2 messages received and not released yet
+        self._outgoing = queue.SimpleQueue()
+        self._packet_ids = itertools.cycle(range(1, 65536))
+        self._id_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._reader = self._file = None
+
+    def start(self):
+        self._reader = threading.Thread(target=self._read_loop, name=f'broker-read-{self.address[1]}', daemon=True)
+        self._reader.start()
+        threading.Thread(target=self._write_loop, name=f'broker-write-{self.address[1]}', daemon=True).start()
+
+    def send(self, data):
+        if not self._closed.is_set():
+            self._outgoing.put(data)
+
+    def deliver(self, topic, payload, qos, retain=False, packet_id=None):
+        # packet_id is given for a message sent again to a resumed session, it gets the DUP flag
+        flags = qos << 1 | int(retain)
+        body = encode_string(topic)
+        if qos:
+            with self._id_lock:
+                if packet_id is None:
+                    packet_id = next(self._packet_ids)
+                else:
+                    flags |= 0x08
+                if not self.clean:
+                    self.inflight[packet_id] = (topic, payload, qos)
+            body += struct.pack('!H', packet_id)
+        self.send(packet(PUBLISH, body + payload, flags))
+
+    def acknowledged(self, packet_id):
+        if not self.clean:
+            with self._id_lock:
+                self.inflight.pop(packet_id, None)
+
+    def unacknowledged(self):
+        with self._id_lock:
+            return [(topic, payload, qos, packet_id) for packet_id, (topic, payload, qos) in self.inflight.items()]
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._outgoing.put(None)
+        # The reader wakes up, the writer sends what is queued and closes the socket
+        try:
+            self.sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        try:
+            while True:
+                data = self._outgoing.get()
+                if data is None:
+                    break
+                chunks = [data]
+                # Join what is already queued, a burst of messages costs a few system calls
+                while len(chunks) < WRITE_BATCH:
+                    try:
+                        data = self._outgoing.get_nowait()
+                    except queue.Empty:
+                        break
+                    if data is None:
+                        self._outgoing.put(None)
+                        break
+                    chunks.append(data)
+                self.sock.sendall(b''.join(chunks))
+        except OSError as e:
+            logging.debug(f"Write to {self.client_id} failed: {e}")
+            self.close()
+        finally:
+            self.sock.close()
+
+    def _read_exact(self, count):
+        data = self._file.read(count)
+        if len(data) < count:
+            raise ConnectionError("connection closed")
+        return data
+
+    def _read_packet(self):
+        first = self._read_exact(1)[0]
+        length, multiplier = 0, 1
+        for _ in range(4):
+            byte = self._read_exact(1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        else:
+            raise ProtocolError("malformed remaining length")
+        return first >> 4, first & 0x0F, self._read_exact(length) if length else b''
+
+    def _read_loop(self):
+        clean = False
+        self._file = self.sock.makefile('rb')
+        try:
+            packet_type, flags, body = self._read_packet()
+            if packet_type != CONNECT or not self._connect(body):
+                return
+            while not self._closed.is_set():
+                packet_type, flags, body = self._read_packet()
+                if packet_type == PUBLISH:
+                    self._publish(flags, body)
+                elif packet_type == PUBREL:
+                    self.awaiting_release.discard(struct.unpack_from('!H', body)[0])
+                    self.send(packet(PUBCOMP, body[:2]))
+                elif packet_type == SUBSCRIBE:
+                    self._subscribe(body)
+                elif packet_type == UNSUBSCRIBE:
+                    self._unsubscribe(body)
+                elif packet_type == PINGREQ:
+                    self.send(packet(PINGRESP))
+                elif packet_type == DISCONNECT:
+                    clean = True
+                    return
+                elif packet_type in (PUBACK, PUBREC, PUBCOMP):
+                    # Acknowledgements of our deliveries, nothing is resent on this connection
+                    if packet_type == PUBREC:
+                        self.send(packet(PUBREL, body[:2], 0x02))
+                    else:
+                        self.acknowledged(struct.unpack_from('!H', body)[0])
+                else:
+                    raise ProtocolError(f"unexpected packet type {packet_type}")
+        except (OSError, ProtocolError, struct.error, UnicodeDecodeError) as e:
+            if not self._closed.is_set():
+                logging.debug(f"Connection of {self.client_id or self.address} lost: {e}")
+        finally:
+            self.broker.disconnect(self, clean)
+
+    def _connect(self, body):
+        protocol, offset = read_string(body, 0)
+        level, flags, keepalive = struct.unpack_from('!BBH', body, offset)
+        offset += 4
+        if protocol not in ('MQTT', 'MQIsdp') or level not in (3, 4):
+            self.send(packet(CONNACK, b'\x00\x01'))  # unacceptable protocol version
+            return False
+        client_id, offset = read_string(body, offset)
+        will = None
+        if flags & 0x04:
+            will_topic, offset = read_string(body, offset)
+            length, = struct.unpack_from('!H', body, offset)
+            will_payload = body[offset + 2:offset + 2 + length]
+            will = (will_topic, will_payload, min((flags >> 3) & 0x03, 2), bool(flags & 0x20))
+        if not client_id:
+            if not flags & 0x02:
+                self.send(packet(CONNACK, b'\x00\x02'))  # identifier rejected
+                return False
+            client_id = f"local-{self.address[0]}-{self.address[1]}"
+        # Only the will of an accepted connection is published when it drops
+        self.will = will
+        self.client_id = client_id
+        self.clean = bool(flags & 0x02)
+        if keepalive:
+            # The client is gone after one and a half keep alive periods without a packet
+            self.sock.settimeout(keepalive * 1.5)
+        # Sends the CONNACK, followed by the messages kept for a persistent session
+        self.broker.register(self)
+        return True
+
+    def _publish(self, flags, body):
+        qos = (flags >> 1) & 0x03
+        retain = bool(flags & 0x01)
+        topic, offset = read_string(body, 0)
+        if qos == 3 or '+' in topic or '#' in topic:
+            raise ProtocolError(f"invalid PUBLISH to {topic}")
+        packet_id = None
+        if qos:
+            packet_id, = struct.unpack_from('!H', body, offset)
+            offset += 2
+        payload = body[offset:]
+        if qos == 1:
+            self.send(packet(PUBACK, struct.pack('!H', packet_id)))
+        elif qos == 2:
+            self.send(packet(PUBREC, struct.pack('!H', packet_id)))
+            if packet_id in self.awaiting_release:
+                return  # a resent message already routed
+            self.awaiting_release.add(packet_id)
+        self.broker.route(topic, payload, qos, retain)
+
+    def _subscribe(self, body):
+        packet_id, = struct.unpack_from('!H', body)
+        offset = 2
+        granted = bytearray()
+        subscribed = []
+        while offset < len(body):
+            topic_filter, offset = read_string(body, offset)
+            qos = body[offset] & 0x03
+            offset += 1
+            if not valid_filter(topic_filter) or qos == 3:
+                granted.append(0x80)
+                continue
+            qos = min(qos, MAX_QOS)
+            granted.append(qos)
+            subscribed.append((topic_filter, qos))
+        self.broker.subscribe(self, subscribed)
+        self.send(packet(SUBACK, struct.pack('!H', packet_id) + bytes(granted)))
+        self.broker.send_retained(self, subscribed)
+
+    def _unsubscribe(self, body):
+        packet_id, = struct.unpack_from('!H', body)
+        offset = 2
+        filters = []
+        while offset < len(body):
+            topic_filter, offset = read_string(body, offset)
+            filters.append(topic_filter)
+        self.broker.unsubscribe(self, filters)
+        self.send(packet(UNSUBACK, struct.pack('!H', packet_id)))
+
+
+class ParkedSession:
+    """The subscriptions and pending messages of a persistent session while its client is disconnected."""
+    def __init__(self, client_id, pending=()):
+        self.client_id = client_id
+        self.subscriptions = {}
+        self.pending = collections.deque(pending, maxlen=PARKED_MESSAGES)  # (topic, payload, qos, packet ID)
+
+    def deliver(self, topic, payload, qos, retain=False, packet_id=None):
+        # QoS 0 messages are not kept for a disconnected client
+        if qos:
+            self.pending.append((topic, payload, qos, packet_id))
+
+
+class LocalBroker:
+    """Class to run a minimal MQTT 3.1.1 broker on a local socket."""
+    def __init__(self, host='127.0.0.1', port=1883):
+        self.host = host
+        self.port = port  # 0 picks a free port, the actual one is set by start()
+        self._trie = TopicTrie()  # filter -> {Session: granted QoS}
+        self._subscribers = {}
+        self._sessions = {}  # client ID -> Session
+        self._parked = {}  # client ID -> ParkedSession of the persistent sessions without connection
+        self._retained = {}  # topic -> (payload, qos)
+        self._lock = threading.RLock()
+        self._server = None
+        self._thread = None
+        self.stats = {"connections": 0, "received": 0, "delivered": 0}
+
+    def start(self):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind((self.host, self.port))
+        self._server.listen(128)
+        self.port = self._server.getsockname()[1]
+        self._thread = threading.Thread(target=self._accept_loop, name='broker-accept', daemon=True)
+        self._thread.start()
+        logging.info(f"Local MQTT broker listening on {self.host}:{self.port}")
+
+    def stop(self):
+        if self._server:
+            # close() alone does not wake up accept() on every platform
+            try:
+                self._server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._server.close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self._server = None
+        with self._lock:
+            sessions = list(self._sessions.values())
+        for session in sessions:
+            session.close()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, address = self._server.accept()
+            except OSError:
+                return  # stopped
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Session(self, sock, address).start()
+
+    def register(self, session):
+        with self._lock:
+            previous = self._sessions.get(session.client_id)
+            self._sessions[session.client_id] = session
+            self.stats["connections"] += 1
+            parked = self._parked.pop(session.client_id, None)
+            if previous and not previous.clean:
+                parked = self._park(previous)
+            if parked and session.clean:
+                # A clean session discards the persistent one
+                self.unsubscribe(parked, list(parked.subscriptions))
+                parked = None
+            if parked:
+                self._move_subscriptions(parked, session)
+            # Under the lock, the messages kept for the session go out before the new ones and in order
+            session.send(packet(CONNACK, b'\x01\x00' if parked else b'\x00\x00'))
+            for topic, payload, qos, packet_id in parked.pending if parked else ():
+                session.deliver(topic, payload, qos, packet_id=packet_id)
+        if previous:
+            # A second connection with the same client ID takes the session over
+            logging.warning(f"Client {session.client_id} connected again, closing its previous connection")
+            previous.close()
+        logging.debug(f"Client {session.client_id} connected from {session.address[0]}:{session.address[1]}")
+
+    def disconnect(self, session, clean):
+        session.close()
+        with self._lock:
+            filters = list(session.subscriptions)
+            if self._sessions.get(session.client_id) is session:
+                del self._sessions[session.client_id]
+                if not session.clean:
+                    self._parked[session.client_id] = self._park(session)
+                    filters = []
+        self.unsubscribe(session, filters)
+        if not clean and session.will:
+            topic, payload, qos, retain = session.will
+            self.route(topic, payload, qos, retain)
+
+    def _park(self, session):
+        # Called with the lock held, the unacknowledged messages are sent again first
+        parked = ParkedSession(session.client_id, session.unacknowledged())
+        self._move_subscriptions(session, parked)
+        return parked
+
+    def _move_subscriptions(self, source, target):
+        # Called with the lock held
+        subscriptions = list(source.subscriptions.items())
+        self.unsubscribe(source, [topic_filter for topic_filter, qos in subscriptions])
+        self.subscribe(target, subscriptions)
+
+    def subscribe(self, session, subscriptions):
+        with self._lock:
+            for topic_filter, qos in subscriptions:
+                session.subscriptions[topic_filter] = qos
+                subscribers = self._subscribers.get(topic_filter)
+                if subscribers is None:
+                    subscribers = self._subscribers[topic_filter] = {}
+                    self._trie.add(topic_filter, subscribers)
+                subscribers[session] = qos
+
+    def unsubscribe(self, session, filters):
+        with self._lock:
+            for topic_filter in filters:
+                session.subscriptions.pop(topic_filter, None)
+                subscribers = self._subscribers.get(topic_filter)
+                if subscribers is None:
+                    continue
+                subscribers.pop(session, None)
+                if not subscribers:
+                    del self._subscribers[topic_filter]
+                    self._trie.remove(topic_filter)
+
+    def route(self, topic, payload, qos, retain=False):
+        """Deliver a message to every matching subscription, once per client with its highest granted QoS."""
+        with self._lock:
+            self.stats["received"] += 1
+            if retain:
+                # An empty retained message removes the one of the topic
+                if payload:
+                    self._retained[topic] = (payload, qos)
+                else:
+                    self._retained.pop(topic, None)
+            targets = {}
+            for subscribers, params in self._trie.match(topic):
+                for session, granted in subscribers.items():
+                    targets[session] = max(targets.get(session, 0), granted)
+            self.stats["delivered"] += len(targets)
+            # Under the lock, a session parked or resumed meanwhile does not miss the message
+            for session, granted in targets.items():
+                session.deliver(topic, payload, min(qos, granted))
+
+    def send_retained(self, session, subscriptions):
+        if not subscriptions:
+            return
+        trie = TopicTrie()
+        for topic_filter, qos in subscriptions:
+            trie.add(topic_filter, qos)
+        with self._lock:
+            retained = list(self._retained.items())
+        for topic, (payload, qos) in retained:
+            granted = [handler for handler, params in trie.match(topic)]
+            if granted:
+                session.deliver(topic, payload, min(qos, max(granted)), retain=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local MQTT 3.1.1 broker for the platform.")
+    parser.add_argument('--host', default='127.0.0.1', help="address to listen on, 0.0.0.0 for every interface")
+    parser.add_argument('--port', type=int, default=1883, help="port to listen on")
+    args = parser.parse_args()
+    broker = LocalBroker(args.host, args.port)
+    broker.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        broker.stop()
@@ -0,0 +1,316 @@
+'''
+Metrics.py is the metrics layer of the platform: counters, gauges and histograms with labels, cheap enough for the
+hot paths (a child of a metric is looked up once and then costs a lock and an addition per update), rendered in the
+Prometheus text format. Every service registers its metrics in the registry of its process; the services that do
+not serve HTTP write them every few seconds to "metrics/{service}.prom" (the textfile export of the node exporter)
+and App.py serves its own metrics merged with these files on /metrics, so a single scrape covers the platform.
+ThrottledLog replaces the INFO lines written per message: it logs a line at most once per interval and per key,
+with the number of similar lines left out.
+'''
+
+import bisect
+import glob
+import logging
+import os
+import threading
+import time
+
+METRICS_DIRECTORY = os.environ.get('SMARTHEALTH_METRICS_DIR', 'metrics')
+EXPORT_INTERVAL = 10  # seconds between two writes of a textfile
+STALE_AFTER = 60  # seconds after which the textfile of a service is not served anymore
+# Seconds, from a local broker round trip to a slow HTTP request
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(extra) + list(zip(names, values))
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class _Value:
+    """Child of a counter or gauge for one set of label values."""
+    __slots__ = ('value', 'function', '_lock')
+
+    def __init__(self):
+        self.value = 0.0
+        self.function = None
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def set_function(self, function):
+        # The value is read from function() when the metrics are rendered, e.g. the length of a queue
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            try:
+                return self.function()
+            except Exception:
+                return float('nan')
+        return self.value
+
+
+class _Histogram:
+    """Child of a histogram for one set of label values."""
+    __slots__ = ('bounds', 'counts', 'sum', '_lock')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class _Timer:
+    """Context manager observing the seconds spent in its block."""
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+    """A metric family: its name, help, type and a child per set of label values."""
+    def __init__(self, name, documentation, kind, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind  # counter, gauge or histogram
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def labels(self, *values):
+        """Return the child of these label values, to keep and update in a hot path."""
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} has the labels {self.labelnames}, got {values}")
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = _Histogram(self.buckets) if self.kind == 'histogram' else _Value()
+                    self._children[values] = child
+        return child
+
+    def remove(self, *values):
+        with self._lock:
+            self._children.pop(tuple(str(value) for value in values), None)
+
+    # Shortcuts for the metrics without labels
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def render(self, extra_labels=()):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            if self.kind != 'histogram':
+                lines.append(f"{self.name}{_format_labels(self.labelnames, values, extra_labels)} "
+                             f"{_format_value(child.get())}")
+                continue
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames + ('le',), values + (_format_value(float(bound)),),
+                                        extra_labels)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values, extra_labels)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """The metrics of a process, by name."""
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, documentation, kind, labelnames=(), buckets=DEFAULT_BUCKETS):
+        # A module imported twice or a class instantiated twice gets the metric registered the first time
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = Metric(name, documentation, kind, labelnames, buckets)
+            elif metric.kind != kind or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind} {metric.labelnames}")
+            return metric
+
+    def render(self, extra_labels=()):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines += metric.render(extra_labels)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(name, documentation, 'counter', labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(name, documentation, 'gauge', labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(name, documentation, 'histogram', labelnames, buckets)
+
+
+def merge(texts):
+    """Merge several Prometheus texts, the samples of a family found in many texts go under one HELP and TYPE."""
+    families = {}
+    for text in texts:
+        name = None
+        for line in text.splitlines():
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                name = line.split(' ', 3)[2]
+                family = families.setdefault(name, {"help": None, "type": None, "samples": []})
+                family["help" if line.startswith('# HELP ') else "type"] = line
+            elif line and not line.startswith('#') and name is not None:
+                families[name]["samples"].append(line)
+    lines = []
+    for family in families.values():
+        lines += [line for line in (family["help"], family["type"]) if line] + family["samples"]
+    return '\n'.join(lines) + '\n'
+
+
+def collect(directory=METRICS_DIRECTORY, component=None):
+    """The metrics of this process merged with the textfiles of the other services still running."""
+    texts = [REGISTRY.render((('component', component),) if component else ())]
+    now = time.time()
+    for path in sorted(glob.glob(os.path.join(directory, '*.prom'))):
+        try:
+            if now - os.path.getmtime(path) > STALE_AFTER:
+                continue
+            with open(path, 'r') as f:
+                texts.append(f.read())
+        except OSError:
+            continue  # removed by its service meanwhile
+    return merge(texts)
+
+
+class TextfileExporter:
+    """Class to write the metrics of this process to {directory}/{service}.prom every interval seconds."""
+    def __init__(self, service, directory=METRICS_DIRECTORY, interval=EXPORT_INTERVAL):
+        self.service = service
+        self.path = os.path.join(directory, f"{service}.prom")
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='metrics-export', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def write(self):
+        # Written aside and renamed, App.py never reads half a file
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path + '.tmp', 'w') as f:
+            f.write(REGISTRY.render((('component', self.service),)))
+        os.replace(self.path + '.tmp', self.path)
+
+    def _run(self):
+        while True:
+            try:
+                self.write()
+            except Exception as e:
+                logging.error(f"Failed to export the metrics of {self.service}: {e}")
+            if self._stop_event.wait(self.interval):
+                return
+
+
+class ThrottledLog:
+    """Logs a message at most once per interval seconds and per key, counting the ones left out."""
+    def __init__(self, interval=10, level=logging.INFO):
+        self.interval = interval
+        self.level = level
+        self._last = {}  # key -> [monotonic time of the last line, messages left out since]
+        self._lock = threading.Lock()
+
+    def log(self, key, message, level=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._last.get(key)
+            if entry and now - entry[0] < self.interval:
+                entry[1] += 1
+                return
+            skipped = entry[1] if entry else 0
+            self._last[key] = [now, 0]
+        if skipped:
+            message = f"{message} (and {skipped} similar in the last {round(now - entry[0])}s)"
+        logging.log(self.level if level is None else level, message)
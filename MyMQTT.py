@@ -1,65 +1,677 @@
 '''
 This is a class that is made based on paho.mqtt in order to provide a simple interface for publishers and subscribers.
+The QoS of a publish is chosen per topic (QoS 2 only for the danger topics by default), the number of messages
+waiting for an acknowledgement is bounded, and publishes made while the broker is unreachable are kept in a bounded
+on-disk queue that is drained as soon as the connection comes back.
+The payloads go through a codec chosen per client (JSON, msgpack or CBOR-encoded SenML as in RFC 8428). The content
+type travels either as an extra last topic level ("SmartHealth/1/heart_rate/~cbor") or, with MQTT v5, as the
+ContentType property, and the messages are decoded here so the notifier always receives the decoded message
+whatever codec the publisher used.
+Subscriptions can use wildcards and named levels ("SmartHealth/{user_id}/danger/{data_type}" subscribes to
+"SmartHealth/+/danger/+"). They are kept in a registry, renewed on every reconnection, and the received messages
+are routed to the handler of every matching pattern through a topic trie, together with the values of the named
+levels.
+A durable client (durable=True, with a stable client ID) keeps its session on the broker: the broker holds the
+messages published while it is away and sends them when it reconnects. Its processed messages are written to a small
+on-disk log, so a message sent again after a restart (with the DUP flag) that was already processed is skipped:
+every message is processed at least once, and in practice once.
+The broker of every service is mqtt.eclipseprojects.io:1883 unless the SMARTHEALTH_MQTT_BROKER and
+SMARTHEALTH_MQTT_PORT environment variables give another one, e.g. the LocalBroker of LocalBroker.py.
 '''
 
 import paho.mqtt.client as PahoMQTT
+import hashlib
 import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from SenML import TIME_FORMAT
+import Metrics
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# (topic filter, QoS) pairs, the first filter matching a topic wins
+DEFAULT_QOS_POLICY = [("SmartHealth/+/danger/#", 2)]
+DEFAULT_BROKER = 'mqtt.eclipseprojects.io'
+DEFAULT_PORT = 1883
+SESSION_EXPIRY = 3600  # seconds a broker keeps the session of a durable MQTT v5 client after it disconnects
+DRAIN_BACKOFF = 0.5  # seconds before sending again a queued message refused while connected, doubled every time
+DRAIN_MAX_BACKOFF = 30  # seconds, longest wait between two tries
+
+PUBLISHED = Metrics.counter('smarthealth_mqtt_published_total', "Messages handed to the broker", ('client',))
+ACK_LATENCY = Metrics.histogram('smarthealth_mqtt_ack_latency_seconds',
+                                "Seconds from the publish of a message to its acknowledgement", ('client',))
+QUEUED = Metrics.counter('smarthealth_mqtt_queued_total', "Messages put in the offline queue", ('client',))
+DROPPED = Metrics.counter('smarthealth_mqtt_dropped_total', "Messages evicted from the full offline queue",
+                          ('client',))
+RECEIVED = Metrics.counter('smarthealth_mqtt_received_total', "Messages received from the broker", ('client',))
+INFLIGHT = Metrics.gauge('smarthealth_mqtt_inflight', "Messages waiting for their acknowledgement", ('client',))
+OFFLINE_QUEUE = Metrics.gauge('smarthealth_mqtt_offline_queue', "Messages in the offline queue", ('client',))
+DUPLICATES = Metrics.counter('smarthealth_mqtt_duplicates_total', "Messages sent again and already processed",
+                             ('client',))
+
+
+def broker_address(broker=None, port=None):
+    """Return the (broker, port) to use: the given ones, else the environment, else the public broker."""
+    broker = broker or os.environ.get('SMARTHEALTH_MQTT_BROKER') or DEFAULT_BROKER
+    port = int(port or os.environ.get('SMARTHEALTH_MQTT_PORT') or DEFAULT_PORT)
+    return broker, port
+
+
+class JSONCodec:
+    """Plain JSON, the default and the format understood by every consumer."""
+    name = 'json'
+    content_type = 'application/senml+json'
+
+    def encode(self, msg):
+        return json.dumps(msg)
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class MsgpackCodec:
+    """Same structure as JSON, encoded with msgpack."""
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("The msgpack codec needs the msgpack package")
+
+    def encode(self, msg):
+        return msgpack.packb(msg, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+class CBORCodec:
+    """SenML packs as an array of records with the integer labels of RFC 8428, other messages as plain CBOR.
+
+    Every value keeps the label of its key: "vs", "vb" and "vd" get their own labels, and "v" stays under the label of
+    "v" even when it is not a number, as the GPS positions published as "lat,lon" strings.
+    """
+    name = 'cbor'
+    content_type = 'application/senml+cbor'
+    # RFC 8428 labels
+    BN, BT, BU, N, U, V, VS, VB, T, VD = -2, -3, -4, 0, 1, 2, 3, 4, 6, 8
+    VALUES = {'v': V, 'vs': VS, 'vb': VB, 'vd': VD}
+
+    def __init__(self):
+        if cbor2 is None:
+            raise RuntimeError("The cbor codec needs the cbor2 package")
+
+    def encode(self, msg):
+        if not isinstance(msg, dict) or 'e' not in msg:
+            return cbor2.dumps(msg)
+        pack = []
+        for entry in msg['e']:
+            record = {}
+            if 'n' in entry:
+                record[self.N] = entry['n']
+            if 'u' in entry:
+                record[self.U] = entry['u']
+            t = entry.get('t')
+            if isinstance(t, str):
+                # SenML times are numbers, the formatted local time becomes seconds since the epoch
+                t = time.mktime(time.strptime(t, TIME_FORMAT))
+            if t is not None:
+                record[self.T] = t
+            for key, label in self.VALUES.items():
+                if key in entry:
+                    record[label] = entry[key]
+            pack.append(record)
+        if pack:
+            if 'bn' in msg:
+                pack[0][self.BN] = msg['bn']
+            if 'bt' in msg:
+                pack[0][self.BT] = msg['bt']
+            if 'bu' in msg:
+                pack[0][self.BU] = msg['bu']
+        return cbor2.dumps(pack)
+
+    def decode(self, payload):
+        pack = cbor2.loads(payload)
+        if not isinstance(pack, list):
+            return pack
+        msg = {"e": []}
+        labels = {self.BN: 'bn', self.BT: 'bt', self.BU: 'bu'}
+        for record in pack:
+            for label, key in labels.items():
+                if label in record:
+                    msg[key] = record[label]
+            entry = {}
+            if self.N in record:
+                entry['n'] = record[self.N]
+            if self.U in record:
+                entry['u'] = record[self.U]
+            if self.T in record:
+                entry['t'] = record[self.T]
+            for key, label in self.VALUES.items():
+                if label in record:
+                    entry[key] = record[label]
+            msg['e'].append(entry)
+        return msg
+
+
+CODECS = {codec.name: codec for codec in (JSONCodec, MsgpackCodec, CBORCodec)}
+CONTENT_TYPES = {codec.content_type: codec.name for codec in CODECS.values()}
+CODEC_SUFFIX = '~'  # last topic level "~{codec name}" marks a payload that is not JSON
+
+
+class TopicTrie:
+    """Trie of subscription patterns, used to route a received topic to the handlers of all matching patterns."""
+    class Node:
+        __slots__ = ('children', 'plus', 'hash', 'handlers')
+
+        def __init__(self):
+            self.children = {}  # exact level -> Node
+            self.plus = None  # Node of the single level wildcard
+            self.hash = {}  # pattern -> (handler, params) of the patterns ending with '#' here
+            self.handlers = {}  # pattern -> (handler, params) of the patterns ending here
+
+    def __init__(self):
+        self._root = self.Node()
+
+    @staticmethod
+    def parse(pattern):
+        """Return the MQTT filter of a pattern and the (level index, name) of its named levels."""
+        levels = pattern.split('/')
+        params = []
+        for index, level in enumerate(levels):
+            if level.startswith('{') and level.endswith('}'):
+                params.append((index, level[1:-1]))
+                levels[index] = '+'
+        return '/'.join(levels), params
+
+    def add(self, pattern, handler):
+        topic_filter, params = self.parse(pattern)
+        node = self._root
+        levels = topic_filter.split('/')
+        for level in levels:
+            if level == '#':
+                node.hash[pattern] = (handler, params)
+                return topic_filter
+            if level == '+':
+                if node.plus is None:
+                    node.plus = self.Node()
+                node = node.plus
+            else:
+                node = node.children.setdefault(level, self.Node())
+        node.handlers[pattern] = (handler, params)
+        return topic_filter
+
+    def remove(self, pattern):
+        topic_filter, params = self.parse(pattern)
+        node = self._root
+        for level in topic_filter.split('/'):
+            if level == '#':
+                node.hash.pop(pattern, None)
+                return
+            node = node.plus if level == '+' else node.children.get(level)
+            if node is None:
+                return
+        node.handlers.pop(pattern, None)
+
+    def match(self, topic):
+        """Return the (handler, parameters) of every pattern matching the topic."""
+        levels = topic.split('/')
+        found = []
+        stack = [(self._root, 0)]
+        while stack:
+            node, depth = stack.pop()
+            # '#' also matches the parent level, "a/#" matches "a"
+            found.extend(node.hash.values())
+            if depth == len(levels):
+                found.extend(node.handlers.values())
+                continue
+            child = node.children.get(levels[depth])
+            if child is not None:
+                stack.append((child, depth + 1))
+            if node.plus is not None:
+                stack.append((node.plus, depth + 1))
+        return [(handler, {name: levels[index] for index, name in params}) for handler, params in found]
+
+
+class OfflineQueue:
+    """Bounded on-disk FIFO of the messages published while the broker is unreachable."""
+    def __init__(self, path, max_messages=10000, policy='drop_routine_first'):
+        if policy not in ('drop_oldest', 'drop_routine_first'):
+            raise ValueError(f"Unknown eviction policy {policy}")
+        self.max_messages = max_messages
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY AUTOINCREMENT, topic TEXT, "
+                         "payload BLOB, qos INTEGER, routine INTEGER, retain INTEGER DEFAULT 0)")
+        if 'retain' not in [column[1] for column in self._db.execute("PRAGMA table_info(queue)")]:
+            # A queue file written before the retained messages
+            self._db.execute("ALTER TABLE queue ADD COLUMN retain INTEGER DEFAULT 0")
+        self._size = self._db.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+    def __len__(self):
+        return self._size
+
+    def put(self, topic, payload, qos, routine, retain=False):
+        # Returns the number of messages evicted to make room for this one
+        with self._lock:
+            self._db.execute("INSERT INTO queue (topic, payload, qos, routine, retain) VALUES (?, ?, ?, ?, ?)",
+                             (topic, payload, qos, int(routine), int(retain)))
+            self._size += 1
+            dropped = 0
+            while self._size > self.max_messages:
+                self._evict()
+                dropped += 1
+            return dropped
+
+    def _evict(self):
+        row = None
+        if self.policy == 'drop_routine_first':
+            row = self._db.execute("SELECT MIN(id) FROM queue WHERE routine = 1").fetchone()
+        if row is None or row[0] is None:
+            row = self._db.execute("SELECT MIN(id) FROM queue").fetchone()
+        self._db.execute("DELETE FROM queue WHERE id = ?", (row[0],))
+        self._size -= 1
+
+    def peek(self, count):
+        with self._lock:
+            return self._db.execute("SELECT id, topic, payload, qos, retain FROM queue ORDER BY id LIMIT ?",
+                                    (count,)).fetchall()
+
+    def remove(self, row_id):
+        with self._lock:
+            if self._db.execute("DELETE FROM queue WHERE id = ?", (row_id,)).rowcount:
+                self._size -= 1
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ProcessedLog:
+    """On-disk log of the messages processed by a durable client, by packet ID and digest."""
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # One row per packet ID, so the log never holds more than 65535 messages
+        self._db.execute("CREATE TABLE IF NOT EXISTS processed (mid INTEGER PRIMARY KEY, digest BLOB)")
+
+    @staticmethod
+    def digest(topic, payload):
+        return hashlib.blake2b(topic.encode() + b'\0' + payload, digest_size=16).digest()
+
+    def seen(self, mid, digest):
+        with self._lock:
+            row = self._db.execute("SELECT digest FROM processed WHERE mid = ?", (mid,)).fetchone()
+        return row is not None and row[0] == digest
+
+    def add(self, mid, digest):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO processed (mid, digest) VALUES (?, ?)", (mid, digest))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
 class MyMQTT:
     # Notifier is only for the subscriber
-    def __init__(self, clientID, broker, port, notifier=None):
+    def __init__(self, clientID, broker, port, notifier=None, qos_policy=None, default_qos=1, max_inflight=100,
+                 inflight_timeout=5, queue_file=None, queue_size=10000, queue_policy='drop_routine_first',
+                 codec='json', negotiation='suffix', protocol=PahoMQTT.MQTTv311, accept_codecs=None, durable=False,
+                 session_expiry=SESSION_EXPIRY, processed_file=None):
         self.broker = broker
         self.port = port
         self.notifier = notifier
         self.clientID = clientID
-        self._topic = ""
-        self._isSubscriber = False
+        self._subscriptions = {}  # pattern -> (MQTT filter, QoS)
+        self._trie = TopicTrie()
+        # QoS of the routine messages, the topics of qos_policy override it
+        self.qos_policy = DEFAULT_QOS_POLICY if qos_policy is None else qos_policy
+        self.default_qos = default_qos
+        self._qos_cache = {}
+        # At most max_inflight messages wait for their acknowledgement, myPublish blocks up to inflight_timeout
+        # seconds for a free slot before the message goes to the offline queue
+        self.inflight_timeout = inflight_timeout
+        self._inflight = threading.BoundedSemaphore(max_inflight)
+        self._pending = {}  # mid -> (publish time, qos)
+        self._early_acks = set()  # mids acknowledged before publish() returned
+        self._lock = threading.RLock()
+        self._connected = threading.Event()
+        self._draining = False
+        self._queue = OfflineQueue(queue_file or f"mqtt_queue_{clientID}.db", queue_size, queue_policy)
+        # A durable client keeps its session and subscriptions on the broker between two connections
+        self.durable = durable
+        self.session_expiry = session_expiry
+        self._processed = ProcessedLog(processed_file or f"mqtt_processed_{clientID}.db") if durable else None
+        self.stats = {"published": 0, "acked": 0, "queued": 0, "dropped": 0,
+                      "ack_latency_sum": 0.0, "ack_latency_max": 0.0}
+        # Children of the metrics of this client, looked up once for the hot paths
+        self._published = PUBLISHED.labels(clientID)
+        self._ack_latency = ACK_LATENCY.labels(clientID)
+        self._queued = QUEUED.labels(clientID)
+        self._dropped = DROPPED.labels(clientID)
+        self._received = RECEIVED.labels(clientID)
+        self._duplicates = DUPLICATES.labels(clientID)
+        INFLIGHT.labels(clientID).set_function(lambda: len(self._pending))
+        OFFLINE_QUEUE.labels(clientID).set_function(lambda: len(self._queue))
+        # Payload codec of the published messages, negotiation is 'suffix' (extra topic level) or 'property' (MQTT v5)
+        if negotiation == 'property' and protocol != PahoMQTT.MQTTv5:
+            raise ValueError("Content type negotiation through properties needs MQTT v5")
+        self.codec = self._get_codec(codec)
+        self.negotiation = negotiation
+        # Codecs whose suffixed topics are subscribed too, all of them by default
+        self.accept_codecs = [name for name in (accept_codecs or CODECS) if name != JSONCodec.name]
+        self._decoders = {}
+        self._publish_properties = None
+        if negotiation == 'property' and self.codec.name != JSONCodec.name:
+            self._publish_properties = Properties(PacketTypes.PUBLISH)
+            self._publish_properties.ContentType = self.codec.content_type
         # create an instance of paho.mqtt.client
-        self._paho_mqtt = PahoMQTT.Client(clientID,True)  
+        self.protocol = protocol
+        if protocol == PahoMQTT.MQTTv5:
+            self._paho_mqtt = PahoMQTT.Client(clientID, protocol=protocol)
+        else:
+            self._paho_mqtt = PahoMQTT.Client(clientID, not durable)
+        self._paho_mqtt.max_inflight_messages_set(max_inflight)
         # register the callback
         self._paho_mqtt.on_connect = self.myOnConnect
+        self._paho_mqtt.on_disconnect = self.myOnDisconnect
         self._paho_mqtt.on_message = self.myOnMessageReceived
- 
- 
-    def myOnConnect (self, paho_mqtt, userdata, flags, rc):
-        print ("Connected to %s with result code: %d" % (self.broker, rc))
+        self._paho_mqtt.on_publish = self.myOnPublish
+
+
+    def myOnConnect (self, paho_mqtt, userdata, flags, rc, properties=None):
+        print ("Connected to %s with result code: %s" % (self.broker, rc))
+        if rc == 0:
+            self._connected.set()
+            if self.durable:
+                resumed = flags.get('session present')
+                logging.info(f"{self.clientID} {'resumed its' if resumed else 'opened a new'} session on {self.broker}")
+            # The broker forgets the subscriptions of a clean session, renew all of them in one SUBSCRIBE
+            filters = self._broker_filters(list(self._subscriptions.values()))
+            if filters:
+                self._paho_mqtt.subscribe(filters)
+            with self._lock:
+                self._start_drain()
+
+    def myOnDisconnect (self, paho_mqtt, userdata, rc, properties=None):
+        self._connected.clear()
+        if rc != 0:
+            logging.warning(f"Unexpected disconnection of {self.clientID} from {self.broker}, result code {rc}")
+        # QoS 0 messages that were not written yet are lost, give their in-flight slots back
+        with self._lock:
+            for mid, (start, qos) in list(self._pending.items()):
+                if qos == 0:
+                    del self._pending[mid]
+                    self._inflight.release()
 
     def myOnMessageReceived (self, paho_mqtt , userdata, msg):
         # A new message is received
-        if callable(self.notifier):
-            self.notifier(msg.topic, msg.payload)
+        self._received.inc()
+        key = None
+        if self._processed is not None and msg.qos:
+            key = (msg.mid, self._processed.digest(msg.topic, msg.payload))
+            # Only a message sent again can have been processed already
+            if msg.dup and self._processed.seen(*key):
+                self._duplicates.inc()
+                return
+        topic, message = self.decode(msg)
+        if topic is None:
+            return
+        notify = False
+        for handler, params in self._trie.match(topic):
+            if handler is None:
+                notify = True
+                continue
+            try:
+                handler(topic, message, params)
+            except Exception as e:
+                logging.error(f"Handler failed on message from topic {topic}: {e}")
+        if notify and callable(self.notifier):
+            self.notifier(topic, message)
+        if key is not None:
+            # Written once processed: a crash before this line gets the message processed again, not lost
+            self._processed.add(*key)
 
+    def decode(self, msg):
+        """Return the topic without codec suffix and the decoded payload of a received message."""
+        topic = msg.topic
+        codec_name = JSONCodec.name
+        properties = getattr(msg, 'properties', None)
+        content_type = getattr(properties, 'ContentType', None) if properties else None
+        if content_type:
+            codec_name = CONTENT_TYPES.get(content_type, codec_name)
+        else:
+            prefix, _, last = topic.rpartition('/')
+            if last.startswith(CODEC_SUFFIX) and last[1:] in CODECS:
+                topic, codec_name = prefix, last[1:]
+        try:
+            decoder = self._decoders.get(codec_name)
+            if decoder is None:
+                decoder = self._decoders[codec_name] = self._get_codec(codec_name)
+            return topic, decoder.decode(msg.payload)
+        except Exception as e:
+            logging.error(f"Failed to decode {codec_name} payload from topic {msg.topic}: {e}")
+            return None, None
 
- 
-    def myPublish (self, topic, msg):
-        # publish a message with a certain topic
-        self._paho_mqtt.publish(topic, json.dumps(msg), 2)
+    def _get_codec(self, name):
+        if name not in CODECS:
+            raise ValueError(f"Unknown codec {name}")
+        return CODECS[name]()
 
- 
-    def mySubscribe (self, topic):
-        
-        # subscribe for a topic
-        self._paho_mqtt.subscribe(topic, 2) 
-        # just to remember that it works also as a subscriber
-        self._isSubscriber = True
-        self._topic = topic
+    def publish_topic(self, topic):
+        # Topic on which a message is actually sent, with the codec suffix if needed
+        if self.negotiation == 'suffix' and self.codec.name != JSONCodec.name:
+            return f"{topic}/{CODEC_SUFFIX}{self.codec.name}"
+        return topic
+
+    def myOnPublish (self, paho_mqtt, userdata, mid):
+        with self._lock:
+            entry = self._pending.pop(mid, None)
+            if entry is None:
+                self._early_acks.add(mid)
+                return
+            self._record_ack(time.monotonic() - entry[0])
+        self._inflight.release()
+
+    def _record_ack(self, latency):
+        self._ack_latency.observe(latency)
+        self.stats["acked"] += 1
+        self.stats["ack_latency_sum"] += latency
+        self.stats["ack_latency_max"] = max(self.stats["ack_latency_max"], latency)
+
+    def qos_for(self, topic):
+        qos = self._qos_cache.get(topic)
+        if qos is None:
+            qos = next((policy_qos for topic_filter, policy_qos in self.qos_policy
+                        if PahoMQTT.topic_matches_sub(topic_filter, topic)), self.default_qos)
+            self._qos_cache[topic] = qos
+        return qos
+
+    def myPublish (self, topic, msg, retain=False):
+        # publish a message with a certain topic, a retained one is kept by the broker for the next subscribers
+        payload = self.codec.encode(msg)
+        qos = self.qos_for(topic)
+        topic = self.publish_topic(topic)
+        with self._lock:
+            # While the offline queue is not empty new messages go behind it to keep the order
+            if self._draining or len(self._queue) or not self._connected.is_set():
+                self._enqueue(topic, payload, qos, retain)
+                return None
+        if not self._inflight.acquire(timeout=self.inflight_timeout):
+            logging.warning(f"No free in-flight slot after {self.inflight_timeout}s, queueing message to {topic}")
+            with self._lock:
+                self._enqueue(topic, payload, qos, retain)
+            return None
+        info = self._send(topic, payload, qos, retain)
+        if info is None:
+            with self._lock:
+                self._enqueue(topic, payload, qos, retain)
+        return info
+
+    def _send(self, topic, payload, qos, retain=False):
+        # The caller holds an in-flight slot, it is released here if the message could not be handed to paho.
+        # paho is called without our lock, its network thread holds its own locks while calling myOnPublish.
+        info = self._paho_mqtt.publish(topic, payload, qos, retain, properties=self._publish_properties)
+        if info.rc != PahoMQTT.MQTT_ERR_SUCCESS and (qos == 0 or info.rc != PahoMQTT.MQTT_ERR_NO_CONN):
+            # paho keeps QoS 1/2 messages published without a connection and sends them on reconnect
+            self._inflight.release()
+            return None
+        self._published.inc()
+        with self._lock:
+            self.stats["published"] += 1
+            if info.mid in self._early_acks:
+                self._early_acks.discard(info.mid)
+                self._record_ack(0.0)
+                early = True
+            else:
+                self._pending[info.mid] = (time.monotonic(), qos)
+                early = False
+        if early:
+            self._inflight.release()
+        return info
+
+    def _enqueue(self, topic, payload, qos, retain=False):
+        # Called with the lock held
+        dropped = self._queue.put(topic, payload, qos, routine=qos < 2, retain=retain)
+        self.stats["queued"] += 1
+        self._queued.inc()
+        if dropped:
+            self.stats["dropped"] += dropped
+            self._dropped.inc(dropped)
+            logging.warning(f"Offline queue of {self.clientID} is full, dropped {dropped} message(s)")
+        self._start_drain()
+
+    def _start_drain(self):
+        # Called with the lock held
+        if not self._draining and len(self._queue) and self._connected.is_set():
+            self._draining = True
+            threading.Thread(target=self._drain, name=f"{self.clientID}-drain", daemon=True).start()
+
+    def _drain(self):
+        stopped = False
+        refusals = 0
+        try:
+            while True:
+                with self._lock:
+                    batch = self._queue.peek(100)
+                    if not batch or not self._connected.is_set():
+                        # Checked and reset under the lock, a message queued meanwhile starts a new drain
+                        self._draining = False
+                        stopped = True
+                        return
+                for row_id, topic, payload, qos, retain in batch:
+                    while not self._inflight.acquire(timeout=self.inflight_timeout):
+                        if not self._connected.is_set():
+                            return  # disconnected again, the rest of the queue waits for the next connection
+                    try:
+                        info = self._send(topic, payload, qos, bool(retain))
+                    except ValueError as e:
+                        # paho rejects the topic or the payload for good, the message would block the queue
+                        self._inflight.release()
+                        logging.error(f"Dropping a queued message to {topic} that cannot be published: {e}")
+                        self._queue.remove(row_id)
+                        continue
+                    if info is not None:
+                        self._queue.remove(row_id)
+                        refusals = 0
+                        continue
+                    if not self._connected.is_set():
+                        return
+                    # Refused while connected, e.g. paho's own queue is full: the head is sent again after a wait,
+                    # the drain stays running so the messages queued meanwhile do not retry it at once
+                    wait = min(DRAIN_BACKOFF * 2 ** refusals, DRAIN_MAX_BACKOFF)
+                    refusals += 1
+                    logging.warning(f"Queued message to {topic} refused by {self.clientID}, retrying in {wait}s")
+                    time.sleep(wait)
+                    break
+        except Exception as e:
+            logging.error(f"Failed to drain the offline queue of {self.clientID}: {e}")
+        finally:
+            if not stopped:
+                # Whatever stopped the drain, the next connection or queued message starts a new one
+                with self._lock:
+                    self._draining = False
+
+    def publish_stats(self):
+        """Counters of the publishes and their acknowledgement latency in seconds."""
+        with self._lock:
+            stats = dict(self.stats)
+            stats["inflight"] = len(self._pending)
+            stats["queue_length"] = len(self._queue)
+        stats["ack_latency_avg"] = stats["ack_latency_sum"] / stats["acked"] if stats["acked"] else 0.0
+        return stats
+
+
+    def mySubscribe (self, topic, handler=None, qos=2):
+        # subscribe for a topic, a pattern with wildcards or named levels such as "SmartHealth/{user_id}/heart_rate".
+        # The messages go to handler(topic, message, params) or, without handler, to the notifier.
+        topic_filter = self._trie.add(topic, handler)
+        self._subscriptions[topic] = (topic_filter, qos)
+        if self._connected.is_set():
+            self._paho_mqtt.subscribe(self._broker_filters([(topic_filter, qos)]))
         print ("subscribed to %s" % (topic))
- 
+
+    def _broker_filters(self, subscriptions):
+        filters = []
+        for topic_filter, qos in subscriptions:
+            filters.append((topic_filter, qos))
+            if self.negotiation == 'suffix' and not topic_filter.endswith('#'):
+                # the same topics published with another codec than JSON, an exact last level never overlaps with
+                # the other subscriptions so the broker does not deliver a message twice
+                filters.extend((f"{topic_filter}/{CODEC_SUFFIX}{name}", qos) for name in self.accept_codecs)
+        return filters
+
+    def subscriptions(self):
+        return dict(self._subscriptions)
+
     def start(self):
         #manage connection to broker
-        self._paho_mqtt.connect(self.broker , self.port)
+        if self.durable and self.protocol == PahoMQTT.MQTTv5:
+            # MQTT v5 keeps the session session_expiry seconds after a disconnection, not forever
+            properties = Properties(PacketTypes.CONNECT)
+            properties.SessionExpiryInterval = self.session_expiry
+            self._paho_mqtt.connect(self.broker, self.port, clean_start=False, properties=properties)
+        else:
+            self._paho_mqtt.connect(self.broker , self.port)
         self._paho_mqtt.loop_start()
 
     def unsubscribe(self,topic):
-        if (self._isSubscriber):
-            # remember to unsuscribe if it is working also as subscriber 
-            self._paho_mqtt.unsubscribe(topic)
-            
+        subscription = self._subscriptions.pop(topic, None)
+        if subscription:
+            self._trie.remove(topic)
+            # Another pattern may use the same filter, e.g. "SmartHealth/{user_id}/gps" and "SmartHealth/+/gps"
+            if all(other[0] != subscription[0] for other in self._subscriptions.values()):
+                self._paho_mqtt.unsubscribe([topic_filter for topic_filter, qos in self._broker_filters([subscription])])
+
     def stop (self):
-        if (self._isSubscriber):
+        # The subscriptions of a durable session stay on the broker, which keeps the messages until the restart
+        if self._subscriptions and not self.durable:
             # remember to unsuscribe if it is working also as subscriber 
-            self._paho_mqtt.unsubscribe(self._topic)
+            filters = {topic_filter for topic_filter, qos in self._broker_filters(self._subscriptions.values())}
+            self._paho_mqtt.unsubscribe(list(filters))
  
         self._paho_mqtt.loop_stop()
         self._paho_mqtt.disconnect()
-
-
+        self._queue.close()
+        if self._processed is not None:
+            self._processed.close()
+        INFLIGHT.remove(self.clientID)
+        OFFLINE_QUEUE.remove(self.clientID)
@@ -0,0 +1,197 @@
+'''
+PatientData.py is the ingestion stage of the patient files replayed by the Wearable Device. A CSV file is read once,
+in chunks so that its size does not matter, and normalized into a typed binary cache: the UTF-8 BOM of some files
+is dropped, the two formats of the "ID" column ("10/1/2017 0:00" and "12:00:00 AM") become an int64 offset in
+seconds from the first row, and the sparse GPS columns are float64 with NaN on the rows without a position. Every
+column is a raw little-endian file of the cache directory, described by a small JSON file and opened as a read-only
+memory map, so a replay starts at once and only touches the pages of the rows it publishes. The cache is keyed by the
+size and modification time of the CSV file and rebuilt when the file changes.
+Columns that are already normalized, such as the synthetic patients of FleetGenerator.py, are written with write()
+into a "{username}.patient" directory of the same format, which load() opens directly.
+'''
+
+import json
+import logging
+import os
+import shutil
+import threading
+import numpy as np
+import pandas as pd
+
+CACHE_DIRECTORY = '.patient_cache'
+DIRECTORY_SUFFIX = '.patient'  # normalized patient directory used instead of a CSV file, "{username}.patient"
+CHUNK_ROWS = 100000  # CSV rows parsed at once
+FORMAT_VERSION = 1
+# CSV column -> dtype of its cache file
+COLUMNS = {
+    "Heart Rate": '<f8',
+    "Blood Oxygen": '<f8',
+    "Latitude": '<f8',
+    "Longitude": '<f8'
+}
+DATE_FORMATS = ('%m/%d/%Y %H:%M', '%I:%M:%S %p')
+
+_lock = threading.Lock()  # the replays of the same file may start together
+
+
+class PatientFile:
+    """Read-only columns of a normalized patient file, indexed like a DataFrame by CSV column name."""
+    def __init__(self, directory, meta):
+        self.directory = directory
+        self.rows = meta['rows']
+        self.integer_columns = set(meta['integer_columns'])  # columns with only whole numbers in the CSV
+        self.columns = {}
+        for name, dtype in meta['columns'].items():
+            path = os.path.join(directory, meta['files'][name])
+            if self.rows:
+                self.columns[name] = np.memmap(path, dtype=np.dtype(dtype), mode='r', shape=(self.rows,))
+            else:
+                self.columns[name] = np.empty(0, dtype=np.dtype(dtype))
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __len__(self):
+        return self.rows
+
+
+class _Offsets:
+    """Turns the ID column into seconds from the first row, across the chunks of a file."""
+    def __init__(self):
+        self.origin = None
+        self.day = 0  # days added to the times of day, which wrap at midnight
+        self.previous = None
+
+    def convert(self, ids):
+        ids = ids.astype(str).str.strip()
+        parsed = pd.to_datetime(ids, format=DATE_FORMATS[0], errors='coerce')
+        seconds = (parsed - pd.Timestamp('1970-01-01')) // pd.Timedelta(seconds=1)
+        missing = parsed.isna().to_numpy()
+        if missing.any():
+            times = pd.to_datetime(ids[missing], format=DATE_FORMATS[1], errors='coerce')
+            of_day = (times.dt.hour * 3600 + times.dt.minute * 60 + times.dt.second).to_numpy(dtype=float)
+            # A time of day smaller than the previous one is on the next day
+            result = np.full(len(of_day), np.nan)
+            for index, value in enumerate(of_day.tolist()):
+                if value != value:
+                    continue
+                if self.previous is not None and value < self.previous:
+                    self.day += 1
+                self.previous = value
+                result[index] = value + self.day * 86400
+            seconds = seconds.to_numpy(dtype=float, copy=True)
+            seconds[missing] = result
+        else:
+            seconds = seconds.to_numpy(dtype=float)
+        if self.origin is None:
+            valid = seconds[~np.isnan(seconds)]
+            if len(valid):
+                self.origin = valid[0]
+        offsets = seconds - (self.origin if self.origin is not None else 0)
+        # Rows with an unreadable ID get -1
+        return np.where(np.isnan(offsets), -1, offsets).astype(np.int64)
+
+
+def cache_key(csv_path):
+    stat = os.stat(csv_path)
+    return f"{stat.st_size}-{stat.st_mtime_ns}"
+
+
+def _file_names():
+    return {name: name.lower().replace(' ', '_') + '.bin' for name in list(COLUMNS) + ["Offset"]}
+
+
+def _write_meta(directory, source, rows, files, integer_columns):
+    meta = {
+        "version": FORMAT_VERSION,
+        "source": source,
+        "rows": rows,
+        "columns": dict(COLUMNS, Offset='<i8'),
+        "files": files,
+        "integer_columns": sorted(integer_columns)
+    }
+    # The description is written last, a directory without it is incomplete and built again
+    with open(os.path.join(directory, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f, indent=4)
+    os.replace(os.path.join(directory, 'meta.json.tmp'), os.path.join(directory, 'meta.json'))
+    return meta
+
+
+def normalize(csv_path, directory):
+    """Convert a patient CSV file into the column files of directory and return its description."""
+    os.makedirs(directory, exist_ok=True)
+    files = _file_names()
+    handles = {name: open(os.path.join(directory, file), 'wb') for name, file in files.items()}
+    offsets = _Offsets()
+    rows = 0
+    integer_columns = set(COLUMNS)
+    try:
+        # utf-8-sig drops the BOM, so the first header is "ID" in every file
+        for chunk in pd.read_csv(csv_path, encoding='utf-8-sig', chunksize=CHUNK_ROWS):
+            chunk.columns = [column.strip() for column in chunk.columns]
+            missing = [name for name in COLUMNS if name not in chunk.columns]
+            if missing:
+                raise ValueError(f"{csv_path} has no column {', '.join(missing)}")
+            for name, dtype in COLUMNS.items():
+                values = pd.to_numeric(chunk[name], errors='coerce').to_numpy(dtype=float)
+                present = values[~np.isnan(values)]
+                if name in integer_columns and (len(present) < len(values) or (present % 1).any()):
+                    integer_columns.discard(name)
+                handles[name].write(values.astype(dtype).tobytes())
+            ids = chunk['ID'] if 'ID' in chunk.columns else pd.Series([''] * len(chunk))
+            handles["Offset"].write(offsets.convert(ids).astype('<i8').tobytes())
+            rows += len(chunk)
+    finally:
+        for handle in handles.values():
+            handle.close()
+    return _write_meta(directory, os.path.basename(csv_path), rows, files, integer_columns)
+
+
+def write(directory, columns, offsets, integer_columns=(), source=None):
+    """Write columns already normalized (arrays by CSV column name) and their offsets as a patient directory."""
+    os.makedirs(directory, exist_ok=True)
+    files = _file_names()
+    for name, dtype in COLUMNS.items():
+        np.asarray(columns[name], dtype=dtype).tofile(os.path.join(directory, files[name]))
+    np.asarray(offsets, dtype='<i8').tofile(os.path.join(directory, files["Offset"]))
+    return _write_meta(directory, source, len(offsets), files, integer_columns)
+
+
+def open_directory(directory):
+    """Return the PatientFile of a directory written by write() or normalize()."""
+    with open(os.path.join(directory, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    if meta.get('version') != FORMAT_VERSION:
+        raise ValueError(f"{directory} has the format version {meta.get('version')}, not {FORMAT_VERSION}")
+    return PatientFile(directory, meta)
+
+
+def load(csv_path, cache_directory=CACHE_DIRECTORY):
+    """Return the PatientFile of a CSV file, normalizing it first if its cache is missing or out of date.
+
+    A patient directory (see write) is opened as it is.
+    """
+    if os.path.isdir(csv_path):
+        return open_directory(csv_path)
+    stem = os.path.splitext(os.path.basename(csv_path))[0]
+    directory = os.path.join(cache_directory, f"{stem}-{cache_key(csv_path)}")
+    meta_path = os.path.join(directory, 'meta.json')
+    with _lock:
+        meta = None
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta.get('version') != FORMAT_VERSION:
+                meta = None
+        if meta is None:
+            logging.info(f"Normalizing {csv_path} into {directory}")
+            # Caches of older versions of the same file are not used anymore
+            if os.path.isdir(cache_directory):
+                for entry in os.listdir(cache_directory):
+                    if entry.startswith(f"{stem}-") and entry[len(stem) + 1:].split('-')[0].isdigit():
+                        shutil.rmtree(os.path.join(cache_directory, entry), ignore_errors=True)
+            meta = normalize(csv_path, directory)
+    return PatientFile(directory, meta)
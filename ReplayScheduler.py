@@ -0,0 +1,116 @@
+'''
+ReplayScheduler.py replays the recorded data of many patients concurrently on one shared timeline. Every source
+(one per patient) advances by one row per tick, so the n-th row of every patient is published at the same moment
+instead of one patient after the other. A speed-up factor compresses the timeline (1x is real time, 60x turns a
+minute into a second and 0 or None replays as fast as possible), which makes it possible to load-test the rest of
+the platform with hundreds of simulated wearables from a single process. A scheduler can also keep running and take
+new sources while it runs, e.g. the patients of the caregivers logging in to the Telegram bot: they join the timeline
+at the next tick and share its few workers, however many there are.
+'''
+
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ReplayScheduler:
+    """Class to replay several row sources concurrently on a shared timeline."""
+    def __init__(self, interval=1.0, speedup=1.0, workers=4):
+        self.interval = interval  # seconds between two rows of the same source at 1x
+        self.speedup = speedup
+        self.workers = max(1, int(workers))
+        self._sources = []
+        self._stop_event = threading.Event()
+        self._cond = threading.Condition()
+        self._heaps = None  # one heap of sources per worker while running
+        self._sequence = 0
+        self._start = None
+
+    def tick_period(self):
+        # Wall-clock seconds between two ticks, 0 means as fast as possible
+        if not self.speedup:
+            return 0
+        return self.interval / self.speedup
+
+    def add_source(self, name, rows, handler, start=0):
+        # handler is called with every row of the source, in order, the first one at tick start. While the scheduler
+        # runs, start counts from the current tick and the source goes to the worker with the fewest sources
+        with self._cond:
+            if self._heaps is None:
+                self._sources.append((name, iter(rows), handler, start))
+                return
+            period = self.tick_period()
+            heap = min(self._heaps, key=len)
+            if period:
+                start += int((time.monotonic() - self._start) / period) + 1
+            elif heap:
+                start += heap[0][0]
+            self._sequence += 1
+            heapq.heappush(heap, (start, self._sequence, name, iter(rows), handler, start))
+            self._cond.notify_all()
+
+    def run(self, keep_running=False):
+        """Replay all sources and block until every one of them is exhausted or stop() is called.
+
+        With keep_running the workers wait for the sources added later instead of returning, until stop().
+        """
+        self._stop_event.clear()
+        with self._cond:
+            # Sources are split round-robin between the workers, each worker keeps the order of its own sources
+            workers = self.workers if keep_running else min(self.workers, len(self._sources))
+            if not workers:
+                return
+            # (tick, sequence, name, rows, handler, start): the sequence number keeps the heap from comparing
+            # iterators
+            self._heaps = [[] for _ in range(workers)]
+            for seq, (name, rows, handler, start) in enumerate(self._sources):
+                self._heaps[seq % workers].append((start, seq, name, rows, handler, start))
+            for heap in self._heaps:
+                heapq.heapify(heap)
+            self._sequence = len(self._sources)
+            self._sources = []
+            self._start = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='replay') as pool:
+                futures = [pool.submit(self._replay_partition, heap, keep_running) for heap in self._heaps]
+                for future in futures:
+                    future.result()
+        finally:
+            with self._cond:
+                self._heaps = None
+
+    def stop(self):
+        with self._cond:
+            self._stop_event.set()
+            self._cond.notify_all()
+
+    def _replay_partition(self, heap, keep_running):
+        period = self.tick_period()
+        while not self._stop_event.is_set():
+            with self._cond:
+                if not heap:
+                    if not keep_running:
+                        break
+                    self._cond.wait()
+                    continue
+                tick, seq, name, rows, handler, start_tick = heapq.heappop(heap)
+            if period:
+                delay = self._start + tick * period - time.monotonic()
+                if delay > 0 and self._stop_event.wait(delay):
+                    break
+            try:
+                row = next(rows)
+            except StopIteration:
+                logging.info(f"Finished replaying {name} after {tick - start_tick} rows")
+                continue
+            except Exception as e:
+                logging.error(f"Failed to read the next row of {name}: {e}")
+                continue
+            try:
+                handler(row)
+            except Exception as e:
+                logging.error(f"Failed to replay row {tick - start_tick} of {name}: {e}")
+            with self._cond:
+                heapq.heappush(heap, (tick + 1, seq, name, rows, handler, start_tick))
@@ -0,0 +1,168 @@
+'''
+RuleEngine.py turns the normal ranges of the catalog into compiled rules. The default range of each measurement comes
+from the "normalRange" of the device in "devicesList" that measures it, and a user can override it with an optional
+"normalRanges" entry, e.g. "normalRanges": {"heart_rate": [50, 110], "gps": 800}. Every rule is compiled once into a
+scalar check and a vectorized NumPy mask, and the rules are reloaded as soon as the "lastUpdate" of the catalog
+changes so that a running publisher picks up new clinical limits without a restart. The catalog is read through a
+CatalogClient when one is given, and from the catalog file otherwise. A service following the change feed of the
+catalog can also hand the new catalog to update() from the thread of the feed, so its hot path never waits for it.
+'''
+
+import json
+import logging
+import os
+import threading
+import time
+import numpy as np
+
+# measureType of the catalog devices -> data type used in the MQTT topics
+MEASURE_TYPES = {
+    "Heart Rate": "heart_rate",
+    "Blood Oxygen": "blood_oxygen",
+    "GPS": "gps"
+}
+
+
+class Rule:
+    """Compiled normal range of one measurement, values outside of it are dangerous."""
+    def __init__(self, data_type, normal_range, exclusive=False):
+        self.data_type = data_type
+        if isinstance(normal_range, (list, tuple)):
+            self.low, self.high = normal_range
+        else:
+            # A single number is an upper bound, as the 500 meters radius of the GPS
+            self.low, self.high = None, normal_range
+        self.exclusive = exclusive
+        self.is_danger = self._compile_scalar()
+
+    def _compile_scalar(self):
+        low, high = self.low, self.high
+        if self.exclusive:
+            if low is None:
+                return lambda value: not value < high
+            return lambda value: not low < value < high
+        if low is None:
+            return lambda value: not value <= high
+        return lambda value: not low <= value <= high
+
+    def danger_mask(self, values):
+        # NaN never satisfies the comparisons, so missing values are reported as dangerous like in the scalar check
+        values = np.asarray(values, dtype=float)
+        if self.exclusive:
+            normal = values < self.high
+            if self.low is not None:
+                normal &= values > self.low
+        else:
+            normal = values <= self.high
+            if self.low is not None:
+                normal &= values >= self.low
+        return ~normal
+
+    def __repr__(self):
+        return f"Rule({self.data_type!r}, low={self.low}, high={self.high}, exclusive={self.exclusive})"
+
+
+class RuleEngine:
+    """Class to compile the catalog thresholds and keep them up to date."""
+    def __init__(self, catalog_file='Catalog.json', check_interval=5, client=None):
+        self.catalog_file = catalog_file
+        self.client = client  # CatalogClient, its ETag replaces the modification time of the file
+        self.check_interval = check_interval  # seconds between two checks of the catalog file
+        self.version = 0  # incremented on every reload
+        self.last_update = None
+        self._default_rules = {}
+        self._user_rules = {}
+        self._mtime = None
+        self._last_check = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """Read the catalog and compile all rules."""
+        try:
+            if self.client:
+                catalog = self.client.catalog()
+                mtime = self.client.etag
+            else:
+                mtime = os.path.getmtime(self.catalog_file)
+                with open(self.catalog_file, 'r') as f:
+                    catalog = json.load(f)
+        except Exception as e:
+            logging.error(f"Error loading rules from catalog: {e}")
+            return False
+        self._compile(catalog)
+        self._mtime = mtime
+        return True
+
+    def refresh(self):
+        """Reload the rules if the catalog has a new lastUpdate, returns True when the rules changed."""
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return False
+        self._last_check = now
+        try:
+            if self.client:
+                catalog = self.client.catalog()
+                mtime = self.client.etag
+            else:
+                mtime = os.path.getmtime(self.catalog_file)
+            if mtime == self._mtime and mtime is not None:
+                return False
+            if not self.client:
+                with open(self.catalog_file, 'r') as f:
+                    catalog = json.load(f)
+        except Exception as e:
+            logging.error(f"Error checking catalog for new rules: {e}")
+            return False
+        self._mtime = mtime
+        if catalog.get('lastUpdate') == self.last_update:
+            return False
+        self._compile(catalog)
+        logging.info(f"Reloaded rules from catalog updated at {self.last_update}")
+        return True
+
+    def update(self, catalog):
+        """Compile the rules of a catalog received by the caller, returns True when the rules changed."""
+        if self.client:
+            self._mtime = self.client.etag
+        if catalog.get('lastUpdate') == self.last_update:
+            return False
+        self._compile(catalog)
+        logging.info(f"Reloaded rules from catalog updated at {self.last_update}")
+        return True
+
+    def _compile(self, catalog):
+        default_rules = {}
+        for device in catalog.get('devicesList', []):
+            if 'normalRange' not in device:
+                continue
+            for measure_type in device.get('measureType', []):
+                data_type = MEASURE_TYPES.get(measure_type)
+                if data_type:
+                    default_rules[data_type] = Rule(data_type, device['normalRange'],
+                                                    device.get('exclusiveRange', False))
+
+        user_rules = {}
+        for user in catalog.get('users', []):
+            overrides = user.get('normalRanges')
+            if not overrides:
+                continue
+            rules = dict(default_rules)
+            for data_type, normal_range in overrides.items():
+                default = default_rules.get(data_type)
+                rules[data_type] = Rule(data_type, normal_range, default.exclusive if default else False)
+            user_rules[user['userID']] = rules
+
+        with self._lock:
+            self._default_rules = default_rules
+            self._user_rules = user_rules
+            self.last_update = catalog.get('lastUpdate')
+            self.version += 1
+
+    def rules_for(self, user_id):
+        """Return the rules of a user as a dict data type -> Rule."""
+        with self._lock:
+            return self._user_rules.get(user_id, self._default_rules)
+
+    def is_danger(self, user_id, data_type, value):
+        return self.rules_for(user_id)[data_type].is_danger(value)
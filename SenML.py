@@ -0,0 +1,45 @@
+'''
+SenML.py contains the helpers shared by publishers and subscribers to read SenML messages. A message is either a
+single measurement ({"bn": ..., "e": [{"n", "u", "t", "v"}]}, "t" being a formatted local time) or a pack of several
+measurements published on "SmartHealth/{user_id}/pack" with a base time "bt" in seconds since the epoch and a "t"
+relative to it for every entry. Subscribers should always go through records() and never read "e[0]" directly.
+The latest value of every patient and measurement is also kept by the broker as a retained single measurement on
+"SmartHealth/{user_id}/latest/{data_type}", for the subscribers that need it without waiting for a new sample.
+'''
+
+import time
+from collections import namedtuple
+
+PACK_TOPIC = "pack"  # last level of the topics carrying packs of several measurements
+LATEST_TOPIC = "latest"  # level of the retained latest values, "SmartHealth/{user_id}/latest/{data_type}"
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+Record = namedtuple('Record', ['name', 'value', 'unit', 'time'])
+
+
+def records(message):
+    """Yield every entry of a SenML message as a Record with the base values resolved."""
+    base_time = message.get('bt')
+    base_unit = message.get('bu')
+    for entry in message.get('e', []):
+        t = entry.get('t')
+        if base_time is not None:
+            t = base_time + (t or 0)
+        yield Record(entry.get('n'), entry.get('v'), entry.get('u', base_unit), t)
+
+
+def epoch_time(t):
+    # Seconds since the epoch of a record time, None without time or with an unreadable one
+    if isinstance(t, (int, float)):
+        return t
+    try:
+        return time.mktime(time.strptime(t, TIME_FORMAT))
+    except (TypeError, ValueError):
+        return None
+
+
+def format_time(t):
+    # Numeric times are seconds since the epoch, older messages already carry a formatted string
+    if isinstance(t, (int, float)):
+        return time.strftime(TIME_FORMAT, time.localtime(t))
+    return t
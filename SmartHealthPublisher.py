@@ -1,26 +1,49 @@
 '''
 SmartHealthPublisher.py is the base class based on MyMQTT class that puts the data into SenML fomat and publishes it.
+With a latest_interval it also keeps the latest value of every measurement retained on the broker
+("SmartHealth/{user_id}/latest/{data_type}"), republished at most once per interval.
 '''
 
 import pandas as pd
 import time
 import json
 import os
+import threading
+import logging
 from MyMQTT import MyMQTT
+from SenML import PACK_TOPIC, LATEST_TOPIC
 
 class Publisher:
-    def __init__(self, client_id, broker, port):
+    def __init__(self, client_id, broker, port, batch_size=None, max_latency=1.0, codec='json', latest_interval=None):
         self.client_id = client_id
         self.broker = broker
         self.port = port
-        self.client_mqtt = MyMQTT(client_id, broker, port)
+        self.client_mqtt = MyMQTT(client_id, broker, port, codec=codec)
+        # Batching mode: records of the same user are collected into one SenML pack that is flushed when it holds
+        # batch_size records or when its oldest record has waited max_latency seconds
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self._packs = {}  # pack topic -> (base time, list of entries)
+        self.latest_interval = latest_interval
+        self._latest = {}  # latest topic -> message not published yet
+        self._latest_published = 0.0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._flusher = None
 
 
     def start(self):
         self.client_mqtt.start()
+        if self.batch_size or self.latest_interval:
+            self._stop_event.clear()
+            self._flusher = threading.Thread(target=self._flush_loop, name='senml-flusher', daemon=True)
+            self._flusher.start()
 
     def publish_normal_data(self, topic, value, unit):
-        message = {
+        self.client_mqtt.myPublish(topic, self._single_message(topic, value, unit))
+
+    def _single_message(self, topic, value, unit):
+        return {
             "bn": self.client_id,
             "e": [
                 {
@@ -31,10 +54,74 @@ class Publisher:
                 }
             ]
         }
+
+    def publish_latest(self, topic, value, unit):
+        # "SmartHealth/{user_id}/heart_rate" and its danger topic go to "SmartHealth/{user_id}/latest/heart_rate"
+        levels = topic.split('/')
+        latest_topic = f"{levels[0]}/{levels[1]}/{LATEST_TOPIC}/{levels[-1]}"
+        message = self._single_message(topic, value, unit)
+        with self._lock:
+            self._latest[latest_topic] = message
+
+    def flush_latest(self):
+        with self._lock:
+            latest, self._latest = self._latest, {}
+            self._latest_published = time.monotonic()
+        for topic, message in latest.items():
+            self.client_mqtt.myPublish(topic, message, retain=True)
+
+
+    def publish_batched(self, topic, value, unit):
+        # "SmartHealth/{user_id}/heart_rate" goes into the pack of "SmartHealth/{user_id}/pack" as "heart_rate"
+        prefix, name = topic.rsplit('/', 1)
+        pack_topic = f"{prefix}/{PACK_TOPIC}"
+        now = time.time()
+        with self._lock:
+            base_time, entries = self._packs.setdefault(pack_topic, (now, []))
+            entries.append({"n": name, "u": unit, "t": round(now - base_time, 3), "v": value})
+            if len(entries) < self.batch_size:
+                return
+            del self._packs[pack_topic]
+        self._publish_pack(pack_topic, base_time, entries)
+
+    def flush(self, max_age=0):
+        """Publish every pack whose oldest record is at least max_age seconds old."""
+        now = time.time()
+        with self._lock:
+            due = [(topic, pack) for topic, pack in self._packs.items() if now - pack[0] >= max_age]
+            for topic, pack in due:
+                del self._packs[topic]
+        for topic, (base_time, entries) in due:
+            self._publish_pack(topic, base_time, entries)
+
+    def _publish_pack(self, topic, base_time, entries):
+        message = {
+            "bn": self.client_id,
+            "bt": round(base_time, 3),
+            "e": entries
+        }
         self.client_mqtt.myPublish(topic, message)
 
+    def _flush_loop(self):
+        periods = [self.max_latency / 4] if self.batch_size else []
+        if self.latest_interval:
+            periods.append(self.latest_interval / 4)
+        period = min(periods)
+        while not self._stop_event.wait(period):
+            try:
+                self.flush(self.max_latency)
+                if self.latest_interval and time.monotonic() - self._latest_published >= self.latest_interval:
+                    self.flush_latest()
+            except Exception as e:
+                logging.error(f"Failed to flush SenML packs: {e}")
 
     def stop(self):
+        if self._flusher:
+            self._stop_event.set()
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+        self.flush_latest()
         self.client_mqtt.stop()
 
 
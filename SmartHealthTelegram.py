@@ -6,52 +6,205 @@ Telegram bot is a MQTT subscriber to GPS Tracking based on ("SmartHealth/{user_i
 out of the safe area it sends alert message and html file and also, the caregiver can request data from wearable device 
 to get real-time heart rate value and blood oxygen value and it is consumer of cataloge for authorizing user name and 
 password of users.
+The bot keeps a durable MQTT session, so the danger messages published while it is down are delivered when it comes
+back, and it warms its latest values from the retained "SmartHealth/{user_id}/latest/{data_type}" messages; the
+newest sample wins, as the backlog of the session can be older than the retained value. The chats following a
+patient are kept in a small on-disk table (WATCH_FILE) and restored, with the replays of their patients, before the
+session is resumed, so these alerts reach the caregivers who were logged in, without a new login.
+The events of the catalog and of the password checks reach the handlers through post(), the MQTT messages through
+deliver() and the history is read and written through with_history(); here they all run right away on the thread of
+the event, AsyncBot.py runs the same handlers on a single asyncio event loop instead.
 '''
 
 import time
 import telepot
 from telepot.loop import MessageLoop
 from telepot.namedtuple import ReplyKeyboardMarkup, KeyboardButton
-import json
-from threading import Thread
+import sqlite3
+from threading import Thread, Lock, RLock
+from functools import partial
 from WearableDevice import WearableDevice
-from MyMQTT import MyMQTT
+from MyMQTT import MyMQTT, broker_address
+from CatalogClient import CatalogClient
+from Credentials import CredentialVerifier, VerifierBusy
+from TelegramOutbox import TelegramOutbox
+from TimeSeriesStore import TimeSeriesStore, UNITS
 from GPS_Tracker import GPSTracker
+import Metrics
+import SenML
 import logging
+import io
+from collections import deque
+
+TRACK_LENGTH = 20  # GPS positions kept per patient for the alert maps
+TOKEN = "7148598555:AAH1ZwQWtdQ2g--nOimGMz_Ufy5x0UxUnbI"  # Replace with your actual token
+WATCH_FILE = "telegram_watches.db"
+
+ALERT_LATENCY = Metrics.histogram('smarthealth_alert_latency_seconds',
+                                  "Seconds from the time of a danger sample to its alert sent to Telegram",
+                                  ('data_type',), buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120))
+
+class WatchTable:
+    """On-disk table of the chats following a patient, which survives a restart of the bot."""
+    def __init__(self, path):
+        self._lock = Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS watches (chat_id INTEGER PRIMARY KEY, user_id INTEGER)")
+
+    def all(self):
+        with self._lock:
+            return self._db.execute("SELECT chat_id, user_id FROM watches").fetchall()
+
+    def put(self, chat_id, user_id):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO watches (chat_id, user_id) VALUES (?, ?)", (chat_id, user_id))
+
+    def remove(self, chat_id):
+        with self._lock:
+            self._db.execute("DELETE FROM watches WHERE chat_id = ?", (chat_id,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
 
 class Bot:
-    def __init__(self, token, mqtt_broker, mqtt_port):
+    def __init__(self, token, mqtt_broker, mqtt_port, durable=True, watch_file=WATCH_FILE):
         self.bot = telepot.Bot(token)
-        self.users = self.load_users_from_json("catalog.json")
-        self.mqtt_client = MyMQTT("clientID", mqtt_broker, mqtt_port, self.on_mqtt_message)
-        self.mqtt_client.start()
+        # Every message goes through the outbox, the MQTT and telepot threads never wait for Telegram
+        self.outbox = TelegramOutbox(self.bot)
+        self.outbox.start()
+        self.catalog_client = CatalogClient()
+        self.verifier = CredentialVerifier()  # the password hashes are checked off the telepot thread
+        self.users = {}
+        # The state shared by the telepot, verifier, MQTT and outbox threads: the indexes for the MQTT thread, the
+        # chat contexts, the latest values and the tracks are only read and written under _index_lock
+        self._index_lock = RLock()
+        self.usernames_by_id = {}  # userID -> username
+        self.watchers = {}  # userID -> set of the chat_ids following the patient
+        self.watched_by_chat = {}  # chat_id -> userID it follows
+        self.load_users(self.catalog_client.catalog())
+        # A stable client ID, the broker resumes the session of the previous run
+        self.mqtt_client = MyMQTT("SmartHealthTelegram", mqtt_broker, mqtt_port, durable=durable)
         self.chat_contexts = {}  # To store chat specific data and contexts
         self.subscriptions = {}  # To track subscriptions
-        self.last_message_time = {}
-        self.latest_values = {}
-        self.wearable_device = WearableDevice()  # Initialize the wearable device
-        self.home_lat = self.wearable_device.home_lat
-        self.home_lon = self.wearable_device.home_lon
+        self.latest_values = {}  # "{userID}_{data_type}" -> (value, unit, formatted time, seconds since the epoch)
+        self.tracks = {}  # userID -> deque of the latest GPS positions, drawn on the alert maps
+        self.wearable_device = WearableDevice(broker=mqtt_broker, port=mqtt_port)  # Initialize the wearable device
         self.gps_tracker = GPSTracker()
+        # The chats logged in before a restart, before the durable session delivers what was published meanwhile
+        self.watch_table = WatchTable(watch_file)
+        self.restore_watches()
+        # A few wildcard subscriptions cover every patient, the handlers get user_id and data_type from the trie
+        self.mqtt_client.mySubscribe("SmartHealth/{user_id}/danger/{data_type}",
+                                     partial(self.deliver, self.on_mqtt_message, danger=True))
+        self.mqtt_client.mySubscribe("SmartHealth/{user_id}/{data_type}", partial(self.deliver, self.on_mqtt_message))
+        # The broker sends every retained latest value right after the subscription
+        self.mqtt_client.mySubscribe(f"SmartHealth/{{user_id}}/{SenML.LATEST_TOPIC}/{{data_type}}",
+                                     partial(self.deliver, self.on_latest_value))
+        # Local history of the vitals, the latest values and the history command survive a restart of the bot
+        self.history = TimeSeriesStore()
+        self.history.start()
+        self.start_mqtt()
+        # Users added, changed or removed through App.py can log in without restarting the bot
+        self.catalog_client.watch(partial(self.post, self.load_users))
 
         logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
-    def load_users_from_json(self, filename):
-        with open(filename, "r") as file:
-            data = json.load(file)
-            users = {}
-            for user in data["users"]:
-                users[user["username"]] = {"password": user["password"], "userID": user["userID"], "chat_id": None, "stage": None}
-            return users
+    def start_mqtt(self):
+        self.mqtt_client.start()
+
+    def post(self, handler, *args, **kwargs):
+        # Called by the catalog and verifier threads for every event
+        handler(*args, **kwargs)
+
+    def deliver(self, handler, *args, **kwargs):
+        # Called by the MQTT thread for every message, which is acknowledged and logged as processed once it returns
+        handler(*args, **kwargs)
+
+    def with_history(self, method, *args, then=None):
+        # Call a method of the history, then(result) gets its result
+        result = method(*args)
+        if then is not None:
+            then(result)
+
+    def load_users(self, catalog):
+        users = {}
+        for user in catalog["users"]:
+            known = self.users.get(user["username"], {})
+            users[user["username"]] = {"password": user["password"], "userID": user["userID"],
+                                       "chat_id": known.get("chat_id"), "stage": known.get("stage")}
+        with self._index_lock:
+            self.users = users
+            self.usernames_by_id = {user["userID"]: username for username, user in users.items()}
+
+    def restore_watches(self):
+        patients = set()
+        for chat_id, user_id in self.watch_table.all():
+            username = self.usernames_by_id.get(user_id)
+            if username is None:
+                # The patient was removed from the catalog while the bot was down
+                self.watch_table.remove(chat_id)
+                continue
+            with self._index_lock:
+                self.watchers.setdefault(user_id, set()).add(chat_id)
+                self.watched_by_chat[chat_id] = user_id
+                self.chat_contexts[chat_id] = {"username": username, "stage": "logged_in", "userID": user_id}
+                self.users[username]["chat_id"] = chat_id
+            self.subscribe_all(user_id)
+            patients.add(username)
+        logging.info(f"Restored {len(self.watched_by_chat)} chat(s) following a patient")
+        # The wearable devices of these patients were replayed for the logins of the previous run
+        for username in patients:
+            self.post(self.start_replay, username)
+
+    def watch(self, chat_id, user_id):
+        # Route the alerts of user_id to chat_id, a chat follows one patient at a time
+        with self._index_lock:
+            self.unwatch(chat_id)
+            self.watchers.setdefault(user_id, set()).add(chat_id)
+            self.watched_by_chat[chat_id] = user_id
+            self.watch_table.put(chat_id, user_id)
+
+    def unwatch(self, chat_id):
+        with self._index_lock:
+            user_id = self.watched_by_chat.pop(chat_id, None)
+            if user_id is None:
+                return
+            self.watch_table.remove(chat_id)
+            chats = self.watchers.get(user_id)
+            if chats:
+                chats.discard(chat_id)
+                if not chats:
+                    del self.watchers[user_id]
+
+    def chats_watching(self, user_id):
+        with self._index_lock:
+            return list(self.watchers.get(user_id, ()))
+
+    def context_of(self, chat_id):
+        # A copy, the verifier thread changes the context of a chat while its password is checked
+        with self._index_lock:
+            return dict(self.chat_contexts.get(chat_id, {}))
+
+    def set_context(self, chat_id, context):
+        with self._index_lock:
+            self.chat_contexts[chat_id] = context
+
+    def username_of(self, user_id):
+        with self._index_lock:
+            return self.usernames_by_id.get(user_id, "User")
 
     def subscribe_all(self, user_id):
         all_topics = [f"SmartHealth/{user_id}/danger/heart_rate",
                       f"SmartHealth/{user_id}/danger/blood_oxygen",
                       f"SmartHealth/{user_id}/danger/gps",
                       f"SmartHealth/{user_id}/heart_rate",
-                      f"SmartHealth/{user_id}/blood_oxygen"]
+                      f"SmartHealth/{user_id}/blood_oxygen",
+                      f"SmartHealth/{user_id}/{SenML.PACK_TOPIC}"]
+        # The wildcard subscriptions already deliver these topics, only remember that the user is followed
         for topic in all_topics:
-            self.mqtt_client.mySubscribe(topic)
             self.track_subscription(user_id, topic)
 
     def on_chat_message(self, msg):
@@ -60,55 +213,94 @@ class Bot:
             return  # ignore non-text messages
         text = msg['text']
         if text == "/start":
-            self.bot.sendMessage(chat_id, "Please enter your username:", reply_markup=self.make_start_keyboard())
-            self.chat_contexts[chat_id] = {"stage": "username"}
+            self.outbox.send(chat_id, "Please enter your username:", reply_markup=self.make_start_keyboard())
+            self.unwatch(chat_id)
+            self.set_context(chat_id, {"stage": "username"})
         elif text == "/stop":
             self.stop_updates(chat_id)
         else:
-            user_data = self.chat_contexts.get(chat_id, {})
+            user_data = self.context_of(chat_id)
             if user_data.get("stage") == "username":
                 if text in self.users:
-                    self.chat_contexts[chat_id] = {"username": text, "stage": "password"}
-                    self.bot.sendMessage(chat_id, "Please enter your password:")
+                    self.set_context(chat_id, {"username": text, "stage": "password"})
+                    self.outbox.send(chat_id, "Please enter your password:")
                 else:
-                    self.bot.sendMessage(chat_id, "Invalid username. Please try again or use /start to begin.")
+                    self.outbox.send(chat_id, "Invalid username. Please try again or use /start to begin.")
             elif user_data.get("stage") == "password":
                 username = user_data.get("username")
-                if text == self.users[username]["password"]:
-                    self.bot.sendMessage(chat_id, "Login successful! If your blood oxygen or heart rate goes into a dangerous range, we will notify you.")
-                    self.bot.sendMessage(chat_id, "Select an option:", reply_markup=self.make_main_keyboard())
-                    self.chat_contexts[chat_id]["stage"] = "logged_in"
-                    self.chat_contexts[chat_id]["userID"] = self.users[username]["userID"]
-                    self.users[username]["chat_id"] = chat_id  # Save chat_id for notifications
-                    self.subscribe_all(self.users[username]['userID'])
-                    Thread(target=self.wearable_device.process_user_file, args=(username,)).start()
-                else:
-                    self.bot.sendMessage(chat_id, "Incorrect password. Please try again.")
-                    self.bot.sendMessage(chat_id, "Please enter your password:")
+                # The user may have been removed from the catalog since the username was entered
+                user = self.users.get(username)
+                if user is None:
+                    self.outbox.send(chat_id, "Invalid username. Please try again or use /start to begin.")
+                    return
+                try:
+                    check = self.verifier.submit(chat_id, username, text, user["password"])
+                except VerifierBusy as e:
+                    self.outbox.send(chat_id, str(e))
+                    return
+                # Ignore new passwords until this one is checked
+                self.set_context(chat_id, dict(user_data, stage="checking"))
+                check.add_done_callback(partial(self.post, self.complete_login, chat_id, username))
             elif user_data.get("stage") == "logged_in":
                 if text == "Get Heart Rate":
                     self.send_latest_value(chat_id, user_data["userID"], 'heart_rate')
                 elif text == "Get Blood Oxygen":
                     self.send_latest_value(chat_id, user_data["userID"], 'blood_oxygen')
+                elif text in ("Get History", "/history"):
+                    self.send_history(chat_id, user_data["userID"])
                 elif text == "Stop Updates":
                     self.stop_updates(chat_id)
                 elif text == "Update":
-                    self.bot.sendMessage(chat_id, "Restarting with new user ID...")
+                    self.outbox.send(chat_id, "Restarting with new user ID...")
                     self.start_new_login(chat_id)
                 elif text == "Continue":
-                    self.bot.sendMessage(chat_id, "Continuing with the current subscriptions...")
-                    self.bot.sendMessage(chat_id, "Select an option:", reply_markup=self.make_main_keyboard())
+                    self.outbox.send(chat_id, "Continuing with the current subscriptions...")
+                    self.outbox.send(chat_id, "Select an option:", reply_markup=self.make_main_keyboard())
                 elif text == "Finish":
                     self.finish_subscriptions(chat_id)
 
+    def complete_login(self, chat_id, username, check):
+        # Posted by the worker pool of the verifier once the password hash is checked
+        try:
+            valid = check.result()
+        except Exception as e:
+            logging.error(f"Error checking the password of {username}: {e}")
+            valid = False
+        with self._index_lock:
+            # Checked and changed at once, the telepot thread may start the chat over meanwhile
+            context = self.chat_contexts.get(chat_id)
+            if not context or context.get("stage") != "checking" or context.get("username") != username:
+                return  # the chat started over while the password was checked
+            user = self.users.get(username)
+            logged_in = bool(valid and user)
+            if logged_in:
+                context["stage"] = "logged_in"
+                context["userID"] = user["userID"]
+                user["chat_id"] = chat_id  # Save chat_id for notifications
+                self.watch(chat_id, user["userID"])
+            else:
+                context["stage"] = "password"
+        if logged_in:
+            self.outbox.send(chat_id, "Login successful! If your blood oxygen or heart rate goes into a dangerous range, we will notify you.")
+            self.outbox.send(chat_id, "Select an option:", reply_markup=self.make_main_keyboard())
+            self.subscribe_all(user['userID'])
+            self.start_replay(username)
+        else:
+            self.outbox.send(chat_id, "Incorrect password. Please try again.")
+            self.outbox.send(chat_id, "Please enter your password:")
+
+    def start_replay(self, username):
+        # The wearable device of the patient starts publishing on the shared timeline, the file is read off this thread
+        Thread(target=self.wearable_device.add_replay, args=(username,), daemon=True).start()
+
     def stop_updates(self, chat_id):
-        if chat_id in self.chat_contexts:
+        if self.context_of(chat_id):
             keyboard = ReplyKeyboardMarkup(keyboard=[
                 [KeyboardButton(text="Update")],
                 [KeyboardButton(text="Continue")],
                 [KeyboardButton(text="Finish")]
             ], one_time_keyboard=True)
-            self.bot.sendMessage(chat_id, "What would you like to do?", reply_markup=keyboard)
+            self.outbox.send(chat_id, "What would you like to do?", reply_markup=keyboard)
 
     def make_start_keyboard(self):
         keyboard = ReplyKeyboardMarkup(keyboard=[
@@ -120,107 +312,226 @@ class Bot:
         keyboard = ReplyKeyboardMarkup(keyboard=[
             [KeyboardButton(text="Get Heart Rate")],
             [KeyboardButton(text="Get Blood Oxygen")],
+            [KeyboardButton(text="Get History")],
             [KeyboardButton(text="Stop Updates")]
         ], one_time_keyboard=True)
         return keyboard
 
     def on_callback_msg(self, msg):
         query_id, from_id, query_data = telepot.glance(msg, flavor='callback_query')
-        chat_context = self.chat_contexts.get(from_id, {})
+        chat_context = self.context_of(from_id)
         userID = chat_context.get("userID")
         if query_data == 'get_heart_rate':
             self.send_latest_value(from_id, userID, 'heart_rate')
         elif query_data == 'get_blood_oxygen':
             self.send_latest_value(from_id, userID, 'blood_oxygen')
+        elif query_data == 'get_history':
+            self.send_history(from_id, userID)
         elif query_data == 'stop_updates':
             self.stop_updates(from_id)
         elif query_data == 'update':
-            self.bot.sendMessage(from_id, "Restarting with new user ID...")
+            self.outbox.send(from_id, "Restarting with new user ID...")
             self.start_new_login(from_id)
         elif query_data == 'continue':
-            self.bot.sendMessage(from_id, "Continuing with the current subscriptions...")
-            self.bot.sendMessage(from_id, "Select an option:", reply_markup=self.make_main_keyboard())
+            self.outbox.send(from_id, "Continuing with the current subscriptions...")
+            self.outbox.send(from_id, "Select an option:", reply_markup=self.make_main_keyboard())
         elif query_data == 'finish':
             self.finish_subscriptions(from_id)
-        self.bot.answerCallbackQuery(query_id, text=f"{query_data.title()} option selected.")
+        self.answer_callback(query_id, f"{query_data.title()} option selected.")
+
+    def answer_callback(self, query_id, text):
+        self.bot.answerCallbackQuery(query_id, text=text)
 
     def send_latest_value(self, from_id, user_id, data_type):
         message_key = f"{user_id}_{data_type}"
-        if message_key in self.latest_values:
-            value, unit, timestamp = self.latest_values[message_key]
-            user_name = next((u for u in self.users if self.users[u]["userID"] == int(user_id)), "User")
+        with self._index_lock:
+            latest = self.latest_values.get(message_key)
+        if latest is not None:
+            value, unit, timestamp, _ = latest
+            user_name = self.username_of(int(user_id))
             friendly_message = f"The latest {data_type.replace('_', ' ').title()} for {user_name} is {value} {unit} at {timestamp}."
-            self.bot.sendMessage(from_id, friendly_message)
+            self.outbox.send(from_id, friendly_message)
+            return
+        # Nothing received since the bot started, the local history still has it
+        self.with_history(self.history.latest, user_id, data_type,
+                          then=partial(self.send_stored_value, from_id, user_id, data_type))
+
+    def send_stored_value(self, from_id, user_id, data_type, latest):
+        if latest:
+            t, value = latest
+            user_name = self.username_of(int(user_id))
+            friendly_message = (f"The latest {data_type.replace('_', ' ').title()} for {user_name} is "
+                                f"{round(value, 2)} {UNITS[data_type]} at {SenML.format_time(t)}.")
+            self.outbox.send(from_id, friendly_message)
         else:
-            self.bot.sendMessage(from_id, "No data available yet.")
+            self.outbox.send(from_id, "No data available yet.")
+
+    def send_history(self, from_id, user_id, hours=1):
+        self.with_history(self.history_summary, user_id, hours, then=partial(self.outbox.send, from_id))
+
+    def history_summary(self, user_id, hours):
+        # Summary of the last hours from the 15 minutes rollups of the local history
+        user_name = self.username_of(int(user_id))
+        lines = [f"History of {user_name} over the last {hours} hour(s):"]
+        for data_type in ('heart_rate', 'blood_oxygen'):
+            buckets = self.history.query(user_id, data_type, time.time() - hours * 3600, resolution='15m')
+            if not len(buckets):
+                continue
+            unit = UNITS[data_type]
+            lines.append(f"{data_type.replace('_', ' ').title()}:")
+            for bucket in buckets:
+                lines.append(f"  {time.strftime('%H:%M', time.localtime(bucket['t']))}  mean {bucket['mean']:.1f} "
+                             f"{unit}, min {bucket['min']:.1f}, max {bucket['max']:.1f} ({bucket['count']} samples)")
+        if len(lines) == 1:
+            lines.append("No data available yet.")
+        return "\n".join(lines)
 
     def finish_subscriptions(self, chat_id):
-        if chat_id in self.chat_contexts:
-            userID = self.chat_contexts[chat_id].get("userID")
-            if userID:
-                if userID in self.subscriptions:
-                    for topic in self.subscriptions[userID]:
-                        self.mqtt_client.unsubscribe(topic)
-                    del self.subscriptions[userID]
-            del self.chat_contexts[chat_id]
-            self.bot.sendMessage(chat_id, "You have been unsubscribed from updates.")
+        with self._index_lock:
+            context = self.chat_contexts.pop(chat_id, None)
+            if context is not None:
+                userID = context.get("userID")
+                if userID:
+                    self.subscriptions.pop(userID, None)
+        if context is not None:
+            self.unwatch(chat_id)
+            self.verifier.forget(chat_id)
+            self.outbox.send(chat_id, "You have been unsubscribed from updates.")
 
     def start_new_login(self, chat_id):
         # Clear any existing context and start fresh
-        self.chat_contexts[chat_id] = {"stage": "username"}
-        self.bot.sendMessage(chat_id, "Please enter your username:")
+        self.unwatch(chat_id)
+        self.set_context(chat_id, {"stage": "username"})
+        self.outbox.send(chat_id, "Please enter your username:")
 
     def track_subscription(self, userID, topic):
-        if userID not in self.subscriptions:
-            self.subscriptions[userID] = []
-        if topic not in self.subscriptions[userID]:
-            self.subscriptions[userID].append(topic)
-
-    def on_mqtt_message(self, topic, payload):
-        topic_parts = topic.split('/')
-        user_id = topic_parts[1]
-        data_type = topic_parts[3] if 'danger' in topic_parts else topic_parts[2]
-        payload = json.loads(payload)
-        value = payload['e'][0]['v']
-        timestamp = payload['e'][0]['t']
-        unit = payload['e'][0]['u']
+        with self._index_lock:
+            if userID not in self.subscriptions:
+                self.subscriptions[userID] = []
+            if topic not in self.subscriptions[userID]:
+                self.subscriptions[userID].append(topic)
+
+    def on_mqtt_message(self, topic, payload, params, danger=False):
+        # payload is already decoded by MyMQTT, whatever codec the publisher used
+        user_id = params['user_id']
+        data_type = params['data_type']
+        is_pack = data_type == SenML.PACK_TOPIC
+        for record in SenML.records(payload):
+            if is_pack:
+                data_type = record.name
+            self.with_history(self.history.append, user_id, data_type, record.time, record.value)
+            self.handle_record(user_id, data_type, record.value, record.unit, SenML.format_time(record.time), danger,
+                               SenML.epoch_time(record.time))
+
+    def on_latest_value(self, topic, payload, params):
+        for record in SenML.records(payload):
+            self.update_latest(params['user_id'], params['data_type'], record.value, record.unit,
+                               SenML.format_time(record.time), SenML.epoch_time(record.time))
+
+    def update_latest(self, user_id, data_type, value, unit, timestamp, sample_time):
+        # Keeps the newest sample: the backlog of the durable session and the retained value arrive in any order
         message_key = f"{user_id}_{data_type}"
-        current_time = time.time()
-        debounce_period = 1  # seconds
-        self.latest_values[message_key] = (value, unit, timestamp)
-        # Check if the message should be processed now
-        if message_key not in self.last_message_time or (
-                current_time - self.last_message_time[message_key] > debounce_period):
-            self.last_message_time[message_key] = current_time
-            user_name = next((u for u in self.users if self.users[u]["userID"] == int(user_id)), "User")
-            for chat_id, context in self.chat_contexts.items():
-                if context.get("userID") == int(user_id):
-                    if 'danger' in topic_parts:
-                        self.handle_danger_message(topic_parts, user_name, chat_id, value, unit, user_id, data_type)
-
-    def handle_danger_message(self, topic_parts, user_name, chat_id, value, unit, user_id, data_type):
-        if 'gps' in topic_parts:
-            html_file_path = self.gps_tracker.create_html_map(value.split(",")[0], value.split(",")[1], user_id)
-            with open(html_file_path, 'rb') as f:
-                self.bot.sendDocument(chat_id, f, "Warning! Your patient is out of zone! Here is the current location of your patient.")
-        elif 'heart_rate' in topic_parts or 'blood_oxygen' in topic_parts:
-            friendly_message = f"Warning! {user_name}'s {data_type.replace('_', ' ').title()} is at a dangerous level: {value}{unit}."
-            self.bot.sendMessage(chat_id, friendly_message)
+        with self._index_lock:
+            known = self.latest_values.get(message_key)
+            if known is not None and known[3] is not None and sample_time is not None and sample_time < known[3]:
+                return
+            self.latest_values[message_key] = (value, unit, timestamp, sample_time)
+
+    def handle_record(self, user_id, data_type, value, unit, timestamp, danger, sample_time=None):
+        self.update_latest(user_id, data_type, value, unit, timestamp, sample_time)
+        if data_type == 'gps':
+            # Read by the outbox worker drawing the maps
+            with self._index_lock:
+                self.tracks.setdefault(int(user_id), deque(maxlen=TRACK_LENGTH)).append(value.split(","))
+        if not danger:
+            return
+        # Only the chats following this patient, found through the index; the outbox merges the bursts
+        chats = self.chats_watching(int(user_id))
+        if chats:
+            user_name = self.username_of(int(user_id))
+            for chat_id in chats:
+                self.handle_danger_message(user_name, chat_id, value, unit, user_id, data_type, sample_time)
+
+    def handle_danger_message(self, user_name, chat_id, value, unit, user_id, data_type, sample_time=None):
+        if data_type == 'gps':
+            def build(summary):
+                # The map of the latest position is drawn by the outbox worker, when the alert is sent
+                latitude, longitude = summary["latest"].split(",")
+                caption = "Warning! Your patient is out of zone! Here is the current location of your patient."
+                if summary["count"] > 1:
+                    caption = (f"Warning! Your patient was out of zone {summary['count']} times in the last "
+                               f"{summary['since']}s! Here is the current location of your patient.")
+
+                def send(bot):
+                    page = self.render_location(user_id, latitude, longitude)
+                    bot.sendDocument(chat_id, (f"map_{user_id}.html", io.BytesIO(page)), caption)
+                    self.observe_alert(data_type, sample_time)
+                return send
+        elif data_type in ('heart_rate', 'blood_oxygen'):
+            title = data_type.replace('_', ' ').title()
+
+            def build(summary):
+                if summary["count"] == 1:
+                    friendly_message = f"Warning! {user_name}'s {title} is at a dangerous level: {summary['latest']}{unit}."
+                else:
+                    friendly_message = (f"Warning! {user_name}'s {title} was out of range {summary['count']} times "
+                                        f"in the last {summary['since']}s, min {summary['min']}{unit}, "
+                                        f"max {summary['max']}{unit}, latest {summary['latest']}{unit}.")
+
+                def send(bot):
+                    bot.sendMessage(chat_id, friendly_message)
+                    self.observe_alert(data_type, sample_time)
+                return send
+        else:
+            return
+        self.outbox.alert(chat_id, (user_id, data_type), value, build)
+
+    def observe_alert(self, data_type, sample_time):
+        # End to end latency of an alert, from the first danger sample of its group to the Telegram call.
+        # The single measurements carry their time to the second, the packs to the millisecond.
+        if sample_time is not None:
+            ALERT_LATENCY.labels(data_type).observe(max(time.time() - sample_time, 0))
+
+    def render_location(self, user_id, latitude, longitude):
+        # Map of the patient with the home, the safe zone of the rules and the recent track, as HTML bytes
+        user = self.catalog_client.user_by_id(user_id) or {}
+        home = (user['latitude'], user['longitude']) if 'latitude' in user and 'longitude' in user else None
+        rule = self.wearable_device.rules.rules_for(int(user_id)).get('gps')
+        with self._index_lock:
+            track = list(self.tracks.get(int(user_id), ()))
+        return self.gps_tracker.render_map(latitude, longitude, user_id, home, rule.high if rule else None, track)
 
     def handle_regular_message(self, user_name, data_type, value, unit, timestamp, chat_id):
         friendly_message = f"The latest {data_type.replace('_', ' ').title()} for {user_name} is {value} {unit} at {timestamp}."
-        self.bot.sendMessage(chat_id, friendly_message)
+        self.outbox.send(chat_id, friendly_message)
 
     def run(self):
         MessageLoop(self.bot, {'chat': self.on_chat_message, 'callback_query': self.on_callback_msg}).run_as_thread()
         print('Bot is listening ...')
 
-        while 1:
-            time.sleep(1)
+        try:
+            while 1:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        # The sources of events first, then what they feed
+        self.catalog_client.stop()
+        self.mqtt_client.stop()
+        self.wearable_device.stop_publisher()
+        self.verifier.stop()
+        self.stop_history()
+        self.outbox.stop()
+        self.watch_table.close()
+
+    def stop_history(self):
+        self.history.stop()
 
 if __name__ == "__main__":
-    token = "7148598555:AAH1ZwQWtdQ2g--nOimGMz_Ufy5x0UxUnbI"  # Replace with your actual token
-    mqtt_broker = 'mqtt.eclipseprojects.io'
-    mqtt_port = 1883
-    bot = Bot(token, mqtt_broker, mqtt_port)
+    mqtt_broker, mqtt_port = broker_address()
+    bot = Bot(TOKEN, mqtt_broker, mqtt_port)
+    Metrics.TextfileExporter('telegram_bot').start()
     bot.run()
@@ -0,0 +1,201 @@
+'''
+TelegramOutbox.py is the outbound queue of the Telegram bot. The MQTT and telepot callbacks only queue their messages
+and a few worker threads send them, so a slow Telegram API never holds up the MQTT intake. The workers follow the
+limits of the Bot API (about one message per second in a chat and 30 per second overall), the alerts go before the
+routine replies, and a burst of alerts about the same patient and measurement is coalesced: the first alert is sent
+at once, the next ones of the coalescing window are merged into a single summary sent when the window ends.
+The messages sent, the failures and the queue depth are recorded in the metrics of the process.
+'''
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from ThingSpeakUploader import TokenBucket
+import Metrics
+
+ALERT = 0
+ROUTINE = 1
+PRIORITY_NAMES = {ALERT: 'alert', ROUTINE: 'routine'}
+
+SENT = Metrics.counter('smarthealth_telegram_sent_total', "Telegram messages sent", ('priority',))
+FAILURES = Metrics.counter('smarthealth_telegram_failures_total', "Failed Telegram calls", ('priority',))
+QUEUE_DEPTH = Metrics.gauge('smarthealth_telegram_queue_depth', "Telegram messages waiting in the outbox")
+
+
+class TelegramOutbox:
+    """Class to send the bot messages from worker threads with rate limits, priorities and alert coalescing."""
+    def __init__(self, bot, workers=2, chat_interval=1.0, global_rate=30, coalesce_window=30, max_attempts=3):
+        self.bot = bot  # telepot.Bot or any object with the same sendMessage / sendDocument methods
+        self.workers = workers
+        self.chat_interval = chat_interval  # seconds between two messages in the same chat
+        self.coalesce_window = coalesce_window  # seconds during which the alerts of a key are merged
+        self.max_attempts = max_attempts
+        self._bucket = TokenBucket(global_rate, global_rate)
+        self._heap = []  # (priority, sequence, message)
+        self._sequence = itertools.count()
+        self._chat_ready = {}  # chat_id -> monotonic time of its next allowed message
+        self._busy_chats = set()  # chats with a message being sent, their messages stay in order
+        self._held_chats = {}  # chat_id -> heap entry of a failed message, the chat waits for its retry
+        self._groups = {}  # coalescing key -> group of alerts waiting in the queue
+        self._last_alert = {}  # coalescing key -> monotonic time its last alert was sent
+        self._cond = threading.Condition()
+        self._running = False
+        self._threads = []
+        QUEUE_DEPTH.set_function(self.queue_depth)
+
+    def start(self):
+        self._running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'telegram-outbox-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def send(self, chat_id, text, reply_markup=None, priority=ROUTINE):
+        """Queue a text message."""
+        if reply_markup is None:
+            action = lambda bot: bot.sendMessage(chat_id, text)
+        else:
+            action = lambda bot: bot.sendMessage(chat_id, text, reply_markup=reply_markup)
+        self._push({"chat_id": chat_id, "priority": priority, "not_before": 0, "action": action, "attempts": 0})
+
+    def alert(self, chat_id, key, value, build):
+        """Queue an alert, merged with the other alerts of the same key in the coalescing window.
+
+        build(summary) returns the function sending the message, summary has the count, min, max and latest value
+        of the merged alerts and since, the seconds they span.
+        """
+        now = time.monotonic()
+        key = (chat_id, key)
+        with self._cond:
+            group = self._groups.get(key)
+            if group:
+                group["count"] += 1
+                group["latest"] = value
+                if isinstance(value, (int, float)):
+                    group["min"] = value if group["min"] is None else min(group["min"], value)
+                    group["max"] = value if group["max"] is None else max(group["max"], value)
+                return
+            numeric = isinstance(value, (int, float))
+            group = self._groups[key] = {
+                "count": 1, "latest": value, "first": now,
+                "min": value if numeric else None, "max": value if numeric else None
+            }
+            # Right away for the first alert of a burst, at the end of the window for the next ones
+            not_before = self._last_alert.get(key, -self.coalesce_window) + self.coalesce_window
+            message = {"chat_id": chat_id, "priority": ALERT, "not_before": not_before, "attempts": 0,
+                       "key": key, "group": group, "build": build}
+            self._push_locked(message)
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _push(self, message):
+        with self._cond:
+            self._push_locked(message)
+
+    def _push_locked(self, message):
+        self._push_entry((message["priority"], next(self._sequence), message))
+
+    def _push_entry(self, entry):
+        heapq.heappush(self._heap, entry)
+        self._cond.notify()
+
+    def _next_message(self):
+        # Called with the lock held: pop the first message that can be sent now, or return the time to wait
+        now = time.monotonic()
+        deferred = []
+        found = None
+        wait = None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            message = entry[2]
+            chat_id = message["chat_id"]
+            held = self._held_chats.get(chat_id)
+            if chat_id in self._busy_chats or (held is not None and held is not entry):
+                # The other messages of the chat wait for the one being sent or retried
+                deferred.append(entry)
+                continue
+            ready = max(message["not_before"], self._chat_ready.get(chat_id, 0))
+            if ready > now:
+                deferred.append(entry)
+                wait = ready - now if wait is None else min(wait, ready - now)
+                continue
+            found = entry
+            break
+        for entry in deferred:
+            heapq.heappush(self._heap, entry)
+        if found:
+            delay = self._bucket.delay()
+            if delay > 0:
+                # Back with its own sequence, it keeps its place among the messages of its chat
+                heapq.heappush(self._heap, found)
+                return None, delay
+            self._bucket.take()
+            self._held_chats.pop(found[2]["chat_id"], None)
+            return found, wait
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                entry, wait = self._next_message()
+                if entry is None:
+                    self._cond.wait(wait)
+                    continue
+                message = entry[2]
+                self._busy_chats.add(message["chat_id"])
+                if "group" in message:
+                    # Alerts arriving from now on start a new group
+                    if self._groups.get(message["key"]) is message["group"]:
+                        del self._groups[message["key"]]
+                    self._last_alert[message["key"]] = time.monotonic()
+            self._deliver(entry)
+
+    def _deliver(self, entry):
+        message = entry[2]
+        chat_id = message["chat_id"]
+        retry_after = None
+        failed = False
+        try:
+            if "group" in message:
+                group = message["group"]
+                summary = dict(group, since=round(time.monotonic() - group["first"]))
+                message["action"] = message["build"](summary)
+                del message["group"], message["build"]
+            message["action"](self.bot)
+            SENT.labels(PRIORITY_NAMES[message["priority"]]).inc()
+        except Exception as e:
+            failed = True
+            FAILURES.labels(PRIORITY_NAMES[message["priority"]]).inc()
+            message["attempts"] += 1
+            # telepot raises TooManyRequestsError with the wait asked by Telegram in json['parameters']
+            parameters = getattr(e, 'json', None) or {}
+            retry_after = (parameters.get('parameters') or {}).get('retry_after')
+            if message["attempts"] < self.max_attempts:
+                logging.warning(f"Failed to send to chat {chat_id}, will retry: {e}")
+            else:
+                logging.error(f"Giving up on a message for chat {chat_id}: {e}")
+                message = None
+        with self._cond:
+            self._busy_chats.discard(chat_id)
+            now = time.monotonic()
+            self._chat_ready[chat_id] = now + max(self.chat_interval, retry_after or 0)
+            if failed and message:
+                message["not_before"] = now + (retry_after or self.chat_interval * 2 ** message["attempts"])
+                # Same entry and sequence, the next messages of the chat are held until the retry is sent
+                self._held_chats[chat_id] = entry
+                self._push_entry(entry)
+            self._cond.notify_all()
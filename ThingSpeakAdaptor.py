@@ -3,106 +3,181 @@ ThingSpeakAdaptor.py is an MQTT subscriber that receives measurements on heart r
 on Thinkspeak through REST Web Services. Thingspeak Adaptor is a REST consumer of catalog for reading configuration. 
 It also has a MQTT commiunication and subscriber of ("SmartHealth/{user_id}/heart_rate"), 
 ("SmartHealth/{user_id}/blood_oxygen") to get processed data of heart rate and blood oxygen through message broker.
+The adaptor can run as several workers ("--workers N"), each with its own client ID. Every worker owns the channels
+given to it by ThingSpeakRoutes.owner and subscribes to the exact topics of their users, with any broker: the
+messages of a user stay in one worker and in order, and the updates of a channel share the rate limit of one worker.
+The MQTT session of every worker is durable: the measurements published while a worker restarts are uploaded when it
+is back, and the ones it had already processed are not uploaded twice. A message is acknowledged once its measurements
+are in the on-disk store of the uploader, so the ones received and not uploaded yet at a crash are uploaded by the
+next start.
 '''
 
-import json
-import requests
+import argparse
+import multiprocessing
 import time
 import logging
-from MyMQTT import MyMQTT
+from MyMQTT import MyMQTT, broker_address
+from ThingSpeakUploader import ThingSpeakUploader
+from ThingSpeakRoutes import ThingSpeakRoutes, owner, partition_key
+from CatalogClient import CatalogClient
+import Metrics
+import SenML
 
 # Setup basic logging configuration
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+UPLOADED_DATA_TYPES = ('heart_rate', 'blood_oxygen')
+
+ENQUEUED = Metrics.counter('smarthealth_thingspeak_enqueued_total', "Measurements queued for ThingSpeak")
+UNROUTED = Metrics.counter('smarthealth_thingspeak_unrouted_total', "Messages of users without ThingSpeak route")
+QUEUE_DEPTH = Metrics.gauge('smarthealth_thingspeak_queue_depth', "Channel updates waiting for their upload")
+
 class ThingSpeakSubscriber:
     """Class to handle subscription and posting data to ThingSpeak."""
-    def __init__(self):
+    def __init__(self, base_url='https://api.thingspeak.com', bulk=False, catalog_url=None, broker=None, port=None,
+                 worker=0, workers=1, durable=True):
+        if not 0 <= worker < workers:
+            raise ValueError(f"Worker {worker} is not one of the {workers} worker(s)")
+        self.worker = worker
+        self.workers = workers
+        # A single worker routes everyone
+        self.partitioned = workers > 1
+        owns = (lambda user: owner(partition_key(user), workers) == worker) if self.partitioned else None
+        self.routes = ThingSpeakRoutes(UPLOADED_DATA_TYPES, owns)
+        self.catalog_client = CatalogClient(catalog_url) if catalog_url else CatalogClient()
         self.load_catalog()
-        self.broker = 'mqtt.eclipseprojects.io'
-        self.port = 1883
-        self.client_id = 'ThingSpeakAdaptor'
-        self.client_mqtt = MyMQTT(self.client_id, self.broker, self.port, self.on_message)
-        self.user_field_maps = self.define_field_mappings()
+        self.broker, self.port = broker_address(broker, port)
+        # Workers sharing a client ID would disconnect each other
+        self.client_id = 'ThingSpeakAdaptor' if workers == 1 else f'ThingSpeakAdaptor-{worker}'
+        self.client_mqtt = MyMQTT(self.client_id, self.broker, self.port, self.on_message, durable=durable)
+        # The MQTT callback only enqueues, the uploader posts from its own thread. A durable worker keeps the
+        # measurements it acknowledged and did not upload yet on disk
+        store_file = f"thingspeak_pending_{self.client_id}.db" if durable else None
+        self.uploader = ThingSpeakUploader(base_url, bulk=bulk, store_file=store_file)
+        QUEUE_DEPTH.set_function(self.uploader.queue_depth)
 
     def start(self):
+        self.uploader.start()
         self.client_mqtt.start()
         self.subscribe_to_topics()
+        # Users added or removed through App.py are routed without restarting the adaptor
+        self.catalog_client.watch(self.on_catalog_change)
 
     def subscribe_to_topics(self):
-        for topic in self.topics:
-            self.client_mqtt.mySubscribe(topic)
+        if self.partitioned:
+            # The topics of the users owned by this worker only
+            for topic in self.routes.topics():
+                self.client_mqtt.mySubscribe(topic)
+            return
+        # One wildcard subscription per measurement covers every user, the routing table filters the users
+        for data_type in UPLOADED_DATA_TYPES + (SenML.PACK_TOPIC,):
+            self.client_mqtt.mySubscribe(f"SmartHealth/+/{data_type}")
 
     def load_catalog(self):
-        # Load catalog data to determine which topics to subscribe to and map user-specific API keys
+        # Load catalog data to update the routing table, returns the routed topics added and removed
         try:
-            with open('Catalog.json', 'r') as f:
-                catalog = json.load(f)
-                self.topics = []
-                self.user_api_keys = {}
-                for user in catalog['users']:
-                    user_id = user['userID']
-                    #api_key = user['thingSpeakWriteAPIKey']
-                    #self.user_api_keys[user_id] = api_key
-                    self.topics.append(f"SmartHealth/{user_id}/heart_rate")
-                    self.topics.append(f"SmartHealth/{user_id}/blood_oxygen")
+            return self.routes.sync(self.catalog_client.users())
         except Exception as e:
             logging.error(f"Error loading catalog: {e}")
+            return [], []
 
-    def define_field_mappings(self):
-        # Define field mappings based on user ID
-        return {
-            1: {'heart_rate': 'field1', 'blood_oxygen': 'field2'},
-            2: {'heart_rate': 'field3', 'blood_oxygen': 'field4'},
-            3: {'heart_rate': 'field5', 'blood_oxygen': 'field6'},
-            4: {'heart_rate': 'field7', 'blood_oxygen': 'field8'}
-        }
+    def on_catalog_change(self, catalog):
+        added, removed = self.routes.sync(catalog['users'])
+        if self.partitioned:
+            for topic in added:
+                self.client_mqtt.mySubscribe(topic)
+            for topic in removed:
+                self.client_mqtt.unsubscribe(topic)
+        if added or removed:
+            logging.info(f"Catalog changed: {len(added)} topic(s) added, {len(removed)} removed")
 
-    def on_message(self, topic, payload):
+    def on_message(self, topic, msg):
+        # msg is already decoded by MyMQTT, whatever codec the publisher used
         try:
-            msg = json.loads(payload)
-            user_id = int(topic.split('/')[1])
-            data_type = topic.split('/')[-1]
-            value = msg['e'][0]['v']
-            self.post_to_thingspeak(user_id, data_type, value)
-        except json.JSONDecodeError:
-            logging.error(f"Error decoding JSON payload from topic {topic}")
+            routes = self.routes.lookup(topic)
+            if routes is None:
+                # A user that is not (or no longer) in the catalog
+                UNROUTED.inc()
+                return
+            for record in SenML.records(msg):
+                # Packs also carry GPS records, which have no route
+                route = routes.get(record.name)
+                if route:
+                    self.post_to_thingspeak(route, record.value)
         except Exception as e:
             logging.error(f"Failed to process message from topic {topic}: {e}")
 
-    def post_to_thingspeak(self, user_id, data_type, value):
+    def post_to_thingspeak(self, route, value):
         try:
-            #api_key = self.user_api_keys.get(user_id)
-            api_key = "L2ENIY2E42E4AT5J"
-            if not api_key:
-                logging.error(f"API key for user {user_id} not found.")
-                return
-
-            field = self.user_field_maps[user_id].get(data_type)
-            if not field:
-                logging.error(f"Invalid data type {data_type} for user {user_id}")
-                return
-
-            url = f"https://api.thingspeak.com/update"
-            payload = {
-                'api_key': api_key,
-                field: value
-            }
-            response = requests.post(url, data=payload)
-            if response.status_code == 200:
-                logging.info(f"Successfully posted {data_type} data to ThingSpeak for user {user_id}")
-            else:
-                logging.error(f"Failed to post data to ThingSpeak: {response.status_code}, {response.text}")
+            # Only enqueue here, this runs on the network thread of paho
+            self.uploader.enqueue(route.channel_id, route.api_key, route.field, value)
+            ENQUEUED.inc()
         except Exception as e:
-            logging.error(f"Exception while posting to ThingSpeak: {e}")
+            logging.error(f"Exception while queueing data for ThingSpeak: {e}")
 
     def stop(self):
+        self.catalog_client.stop()
         self.client_mqtt.stop()
+        self.uploader.stop()
 
-if __name__ == "__main__":
-    subscriber = ThingSpeakSubscriber()
+def run_worker(worker, workers, bulk):
+    subscriber = ThingSpeakSubscriber(bulk=bulk, worker=worker, workers=workers)
     subscriber.start()
+    service = 'thingspeak_adaptor' if workers == 1 else f'thingspeak_adaptor_{worker}'
+    exporter = Metrics.TextfileExporter(service).start()
     try:
         while True:
             time.sleep(1)  # Keep the subscriber running
     except KeyboardInterrupt:
+        pass
+    finally:
         subscriber.stop()
+        exporter.stop()
+
+
+def supervise(workers, bulk):
+    """Run the workers in their own processes and restart the ones that die."""
+    context = multiprocessing.get_context('spawn')
+
+    def spawn(worker):
+        process = context.Process(target=run_worker, args=(worker, workers, bulk),
+                                  name=f'thingspeak-adaptor-{worker}')
+        process.start()
+        return process
+
+    processes = [spawn(worker) for worker in range(workers)]
+    try:
+        while True:
+            time.sleep(1)
+            for worker, process in enumerate(processes):
+                if not process.is_alive():
+                    logging.warning(f"ThingSpeak adaptor worker {worker} exited with code {process.exitcode}, "
+                                    f"restarting it")
+                    processes[worker] = spawn(worker)
+    except KeyboardInterrupt:
+        # The workers got the Ctrl-C of the terminal too
+        for process in processes:
+            process.join(10)
+            if process.is_alive():
+                process.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upload the measurements of the users to ThingSpeak.")
+    parser.add_argument('--workers', type=int, default=1, help="number of adaptor processes")
+    parser.add_argument('--worker', type=int, default=None,
+                        help="run only this worker (0 to workers-1), e.g. one per host, instead of all of them")
+    parser.add_argument('--bulk', action='store_true', help="use the bulk update endpoint of ThingSpeak")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.worker is not None:
+        # A lone worker would quietly route every channel under the client ID of an unpartitioned adaptor
+        if args.workers < 2:
+            parser.error("--worker needs --workers 2 or more")
+        if not 0 <= args.worker < args.workers:
+            parser.error(f"--worker must be between 0 and {args.workers - 1}")
+    if args.worker is not None or args.workers == 1:
+        run_worker(args.worker or 0, args.workers, args.bulk)
+    else:
+        supervise(args.workers, args.bulk)
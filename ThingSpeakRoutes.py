@@ -0,0 +1,125 @@
+'''
+ThingSpeakRoutes.py builds the routing table of the ThingSpeak Adaptor from the users of the catalog. Every
+(user, measurement) pair is mapped to a (channel, field, write API key) route. The users with an explicit
+"thingSpeakFields" entry get these fields, a field asked for by two users stays with the lower userID; the free fields
+of the channel then go to the other users in the order of their IDs (field1 and field2 for the first one, and so on).
+The fields only depend on the catalog, so every worker and every restart of the adaptor agree on them; removing a
+user moves the fields of the next users of its channel, give them explicit fields to keep their fields for good.
+The table is keyed by the full topic string, so a received message is routed with a single dictionary lookup, and
+only the topics of the users whose routes changed are updated when the catalog changes.
+When the adaptor runs as several workers, every worker keeps only the users of the channels it owns: a channel
+belongs to one worker (rendezvous hashing, see owner), so its fields and its rate limit are handled in one place.
+'''
+
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+import SenML
+
+FIELDS_PER_CHANNEL = 8  # a ThingSpeak channel has field1 to field8
+
+Route = namedtuple('Route', ['channel_id', 'field', 'api_key'])
+
+
+def owner(key, workers):
+    """The worker in range(workers) owning key, only the keys of a removed worker move when workers changes."""
+    # md5 rather than hash(), which changes from one process to another
+    return max(range(workers), key=lambda worker: hashlib.md5(f"{key}/{worker}".encode()).digest())
+
+
+def partition_key(user):
+    # The users of a channel share its fields, they go to the same worker
+    return user.get('thingSpeakChannelID') or user['userID']
+
+
+class ThingSpeakRoutes:
+    """Class to map the topics of every user to their ThingSpeak channel fields."""
+    def __init__(self, data_types=('heart_rate', 'blood_oxygen'), owns=None):
+        self.data_types = data_types
+        self.owns = owns  # optional predicate on a catalog user, the users it rejects are not routed
+        # topic -> {data type: Route}, a pack topic holds the routes of all the data types of its user.
+        # Readers use it without lock, writers only replace or delete single keys.
+        self.routes = {}
+        self._users = {}  # user ID -> {data type: Route}
+        self._lock = threading.Lock()
+
+    def lookup(self, topic):
+        return self.routes.get(topic)
+
+    def topics(self):
+        return list(self.routes)
+
+    def sync(self, users):
+        """Update the table to the given catalog users, returns the (added, removed) topics."""
+        users = {user['userID']: user for user in users if self.owns is None or self.owns(user)}
+        assigned = self._assign(users)
+        added, removed = [], []
+        with self._lock:
+            for user_id in [user_id for user_id, routes in self._users.items() if assigned.get(user_id) != routes]:
+                removed += self._remove_user(user_id)
+            for user_id in sorted(assigned):
+                if user_id not in self._users:
+                    added += self._add_user(user_id, assigned[user_id])
+        # A topic both removed and added belongs to a user whose route changed, it stays subscribed
+        return [topic for topic in added if topic not in removed], [topic for topic in removed if topic not in added]
+
+    def _assign(self, users):
+        # user ID -> {data type: Route}, computed from the whole catalog so that it never depends on its history
+        channels = {}  # channel ID -> users of the channel in the order of their IDs
+        for user_id in sorted(users):
+            user = users[user_id]
+            if not user.get('thingSpeakChannelID') or not user.get('thingSpeakWriteAPIKey'):
+                logging.error(f"User {user_id} has no ThingSpeak channel or write API key")
+                continue
+            channels.setdefault(user['thingSpeakChannelID'], []).append(user)
+        assigned = {}
+        for channel_id, members in channels.items():
+            used = set()
+            numbers = {}  # user ID -> {data type: field number}
+            for user in members:
+                explicit = user.get('thingSpeakFields') or {}
+                fields = {data_type: int(str(explicit[data_type]).replace('field', ''))
+                          for data_type in self.data_types if explicit.get(data_type)}
+                taken = [n for n in fields.values() if n in used or not 1 <= n <= FIELDS_PER_CHANNEL]
+                if taken or len(set(fields.values())) < len(fields):
+                    logging.error(f"User {user['userID']} asks for fields {explicit} of ThingSpeak channel "
+                                  f"{channel_id} that are taken or invalid, its measurements are not uploaded")
+                    continue
+                used.update(fields.values())
+                numbers[user['userID']] = fields
+            free = iter([n for n in range(1, FIELDS_PER_CHANNEL + 1) if n not in used])
+            for user in members:
+                fields = numbers.get(user['userID'])
+                if fields is None:
+                    continue
+                for data_type in self.data_types:
+                    if data_type not in fields:
+                        fields[data_type] = next(free, None)
+                if None in fields.values():
+                    logging.error(f"No free field left in ThingSpeak channel {channel_id} for user {user['userID']}")
+                    continue
+                api_key = user['thingSpeakWriteAPIKey']
+                assigned[user['userID']] = {data_type: Route(channel_id, f"field{fields[data_type]}", api_key)
+                                            for data_type in self.data_types}
+        return assigned
+
+    def _add_user(self, user_id, routes):
+        self._users[user_id] = routes
+        topics = []
+        for data_type, route in routes.items():
+            topic = f"SmartHealth/{user_id}/{data_type}"
+            self.routes[topic] = {data_type: route}
+            topics.append(topic)
+        pack_topic = f"SmartHealth/{user_id}/{SenML.PACK_TOPIC}"
+        self.routes[pack_topic] = dict(routes)
+        topics.append(pack_topic)
+        return topics
+
+    def _remove_user(self, user_id):
+        routes = self._users.pop(user_id)
+        topics = [f"SmartHealth/{user_id}/{data_type}" for data_type in routes]
+        topics.append(f"SmartHealth/{user_id}/{SenML.PACK_TOPIC}")
+        for topic in topics:
+            self.routes.pop(topic, None)
+        return topics
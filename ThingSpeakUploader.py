@@ -0,0 +1,267 @@
+'''
+ThingSpeakUploader.py is the upload pipeline of the ThingSpeak Adaptor. The MQTT callback only enqueues the
+measurements, and a worker thread merges them per channel: the latest value of every field becomes one multi-field
+update, or, in bulk mode, the updates are collected and sent together through the bulk-write JSON endpoint.
+The requests go through one pooled keep-alive session, every channel is limited by a token bucket (ThingSpeak
+accepts one update every 15 seconds per channel on a free account) and failed uploads are retried with an
+exponential backoff. The base URL can point to a local stub server for testing. The latency and outcome of the
+requests are recorded in the metrics of the process. On stop the measurements still waiting are uploaded, within the
+rate limits, for up to drain_timeout seconds.
+With a store file every measurement is written to a small on-disk table before enqueue() returns, and removed once
+its update is uploaded (or given up): the measurements left at a crash or at the end of the drain are uploaded by the
+next start, so the MQTT message can be acknowledged as soon as it is enqueued.
+'''
+
+import logging
+import sqlite3
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import Metrics
+
+HTTP_LATENCY = Metrics.histogram('smarthealth_thingspeak_request_seconds', "Seconds of the requests to ThingSpeak",
+                                 ('endpoint',))
+UPLOADS = Metrics.counter('smarthealth_thingspeak_uploads_total', "Uploads to ThingSpeak by outcome", ('outcome',))
+
+
+class TokenBucket:
+    """Token bucket allowing rate updates per second with bursts of capacity updates."""
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    def delay(self):
+        # Seconds to wait before a token is available, 0 if one is available now
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class PendingStore:
+    """On-disk table of the measurements enqueued and not uploaded yet, in their order of arrival."""
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                         "channel_id TEXT, api_key TEXT, field TEXT, value)")
+
+    def add(self, channel_id, api_key, field, value):
+        # Returns the row ID of the measurement
+        with self._lock:
+            return self._db.execute("INSERT INTO pending (channel_id, api_key, field, value) VALUES (?, ?, ?, ?)",
+                                    (str(channel_id), api_key, field, value)).lastrowid
+
+    def remove(self, row_ids):
+        with self._lock:
+            self._db.executemany("DELETE FROM pending WHERE id = ?", [(row_id,) for row_id in row_ids])
+
+    def rows(self):
+        with self._lock:
+            return self._db.execute("SELECT id, channel_id, api_key, field, value FROM pending "
+                                    "ORDER BY id").fetchall()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ThingSpeakUploader:
+    """Class to merge measurements per channel and upload them to ThingSpeak from a worker thread."""
+    def __init__(self, base_url='https://api.thingspeak.com', rate=1 / 15, burst=1, bulk=False, max_retries=5,
+                 backoff=1.0, timeout=10, drain_timeout=20, store_file=None):
+        self.base_url = base_url.rstrip('/')
+        self.rate = rate  # updates per second and per channel
+        self.burst = burst
+        self.bulk = bulk
+        self.max_retries = max_retries
+        self.backoff = backoff  # seconds before the first retry, doubled at every failure
+        self.timeout = timeout
+        self.drain_timeout = drain_timeout  # seconds stop() waits for the pending updates, above the 15 s rate limit
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        self.session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+        self._channels = {}  # write API key -> pending data of the channel
+        self._cond = threading.Condition()
+        self._running = False
+        self._deadline = None  # monotonic time after which a stopping worker drops (or stores) what is left
+        self._thread = None
+        self._log = Metrics.ThrottledLog(60)
+        self._store = None
+        if store_file:
+            self._store = PendingStore(store_file)
+            # The measurements of the previous run that were not uploaded go first
+            rows = self._store.rows()
+            for row_id, channel_id, api_key, field, value in rows:
+                self._add(channel_id, api_key, field, value, row_id)
+            if rows:
+                logging.info(f"Resuming {len(rows)} measurement(s) not uploaded to ThingSpeak before the last stop")
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='thingspeak-uploader', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._deadline = time.monotonic() + self.drain_timeout
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        self.session.close()
+        if self._store is not None:
+            self._store.close()
+
+    def enqueue(self, channel_id, api_key, field, value):
+        """Add a measurement to the next update of its channel, never blocks on the network."""
+        with self._cond:
+            # Written under the lock, so the rows of the store keep the order of the updates
+            row_id = self._store.add(channel_id, api_key, field, value) if self._store is not None else None
+            self._add(channel_id, api_key, field, value, row_id)
+            self._cond.notify()
+
+    def _add(self, channel_id, api_key, field, value, row_id):
+        # Called with the lock held, or before the worker starts
+        channel = self._channels.get(api_key)
+        if channel is None:
+            channel = self._channels[api_key] = {
+                "channel_id": channel_id,
+                "fields": {},  # latest value of every field, merged into a single update
+                "updates": [],  # bulk mode: complete updates waiting for the bulk request
+                "bucket": TokenBucket(self.rate, self.burst),
+                "retry_at": 0,
+                "attempts": 0,
+                "rows": []  # row IDs in the store of the pending measurements
+            }
+        if self.bulk and field in channel["fields"]:
+            # The field already has a value in the current update, start a new one to keep both
+            self._close_update(channel)
+        channel["fields"][field] = value
+        if row_id is not None:
+            channel["rows"].append(row_id)
+
+    def queue_depth(self):
+        with self._cond:
+            return sum(len(channel["updates"]) + bool(channel["fields"]) for channel in self._channels.values())
+
+    def _close_update(self, channel):
+        update = dict(channel["fields"])
+        update["created_at"] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        channel["updates"].append(update)
+        channel["fields"] = {}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                ready, wait = self._ready_channels()
+                if not self._running:
+                    # Stopping: upload what is left as the rate limits allow, until the deadline
+                    pending = self.queue_depth()
+                    remaining = self._deadline - time.monotonic()
+                    if not pending:
+                        return
+                    if remaining <= 0:
+                        if self._store is not None:
+                            logging.warning(f"Leaving {pending} ThingSpeak update(s) to the next start")
+                        else:
+                            logging.warning(f"Dropping {pending} ThingSpeak update(s) not uploaded before the "
+                                            f"shutdown")
+                        return
+                    wait = remaining if wait is None else min(wait, remaining)
+                if not ready:
+                    self._cond.wait(wait)
+                    continue
+                batches = [(api_key, self._take_batch(self._channels[api_key])) for api_key in ready]
+            for api_key, batch in batches:
+                self._upload(api_key, batch)
+
+    def _ready_channels(self):
+        # Called with the lock held, returns the channels that can be uploaded now and the time to wait otherwise
+        now = time.monotonic()
+        ready = []
+        wait = None
+        for api_key, channel in self._channels.items():
+            if not channel["fields"] and not channel["updates"]:
+                continue
+            delay = max(channel["retry_at"] - now, channel["bucket"].delay())
+            if delay <= 0:
+                ready.append(api_key)
+            elif wait is None or delay < wait:
+                wait = delay
+        return ready, wait
+
+    def _take_batch(self, channel):
+        # Called with the lock held, a batch always takes every pending measurement of the channel
+        channel["bucket"].take()
+        rows = channel["rows"]
+        channel["rows"] = []
+        if self.bulk:
+            if channel["fields"]:
+                self._close_update(channel)
+            batch = channel["updates"]
+            channel["updates"] = []
+        else:
+            batch = channel["fields"]
+            channel["fields"] = {}
+        return channel["channel_id"], batch, rows
+
+    def _upload(self, api_key, batch):
+        channel_id, data, rows = batch
+        start = time.perf_counter()
+        try:
+            if self.bulk:
+                response = self.session.post(f"{self.base_url}/channels/{channel_id}/bulk_update.json",
+                                             json={"write_api_key": api_key, "updates": data},
+                                             timeout=self.timeout)
+                success = response.status_code in (200, 202)
+            else:
+                response = self.session.post(f"{self.base_url}/update", data={"api_key": api_key, **data},
+                                             timeout=self.timeout)
+                # ThingSpeak answers 200 with entry id 0 when the update is rejected, e.g. for the rate limit
+                success = response.status_code == 200 and response.text.strip() != "0"
+            HTTP_LATENCY.labels('bulk_update' if self.bulk else 'update').observe(time.perf_counter() - start)
+            if success:
+                self._log.log('posted', f"Successfully posted {len(data)} {'updates' if self.bulk else 'fields'} "
+                                        f"to ThingSpeak channel {channel_id}")
+            else:
+                logging.error(f"Failed to post data to ThingSpeak: {response.status_code}, {response.text}")
+        except Exception as e:
+            logging.error(f"Exception while posting to ThingSpeak: {e}")
+            success = False
+        UPLOADS.labels('success' if success else 'failure').inc()
+        with self._cond:
+            channel = self._channels[api_key]
+            if success:
+                channel["attempts"] = 0
+                self._forget(rows)
+                return
+            channel["attempts"] += 1
+            if channel["attempts"] > self.max_retries:
+                logging.error(f"Giving up on {len(data)} items for ThingSpeak channel {channel_id} "
+                              f"after {self.max_retries} retries")
+                channel["attempts"] = 0
+                self._forget(rows)
+                return
+            channel["retry_at"] = time.monotonic() + self.backoff * 2 ** (channel["attempts"] - 1)
+            # Put the data back in front of what arrived meanwhile, newer field values win
+            if self.bulk:
+                channel["updates"] = data + channel["updates"]
+            else:
+                channel["fields"] = {**data, **channel["fields"]}
+            channel["rows"] = rows + channel["rows"]
+
+    def _forget(self, rows):
+        if rows and self._store is not None:
+            self._store.remove(rows)
@@ -0,0 +1,319 @@
+'''
+TimeSeriesStore.py keeps the history of the vitals on the local disk, so that the platform does not have to read
+ThingSpeak back and the latest values survive a restart. Every (patient, measurement) series is columnar: segment
+files of int64 timestamps in milliseconds and of float32 values ("history/{user_id}/{data_type}.{first}.ts" and
+".val"), appended in time order and read through memory maps, so a range query is two binary searches and a copy of
+the result. The 1 minute, 15 minutes and 1 hour rollups (count, min, max, sum per bucket) are kept along the way in
+their own files. The store can run as a service subscribed to "SmartHealth/{user_id}/..." or be fed by the Telegram
+bot, which also gets its latest values and history from it. Only one process should write a history directory.
+The samples are written to disk without holding the lock of the store: a flush takes the new samples under the lock,
+writes them without it, at the offsets the files had, and only then counts them as on disk, so the appends and the
+queries never wait for the disk and a failed write is written again by the next flush.
+'''
+
+import bisect
+import glob
+import logging
+import os
+import threading
+import time
+import numpy as np
+from MyMQTT import MyMQTT, broker_address
+import Metrics
+import SenML
+
+# Setup basic logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+STORED_DATA_TYPES = ('heart_rate', 'blood_oxygen')
+UNITS = {"heart_rate": "bpm", "blood_oxygen": "%SpO2"}
+RESOLUTIONS = {"1m": 60, "15m": 900, "1h": 3600}  # rollups kept, in seconds
+ROLLUP_DTYPE = np.dtype([('t', '<i8'), ('count', '<i4'), ('min', '<f4'), ('max', '<f4'), ('sum', '<f8')])
+
+
+def write_at(path, offset, data):
+    # Write at the offset where the last flush stopped, over the bytes of a write that failed half way
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+        f.seek(offset)
+        f.write(data)
+        f.truncate()
+
+
+class Series:
+    """Append-only columnar series of one measurement of one patient."""
+    def __init__(self, prefix, segment_size):
+        self.prefix = prefix  # path without extension, e.g. history/1/heart_rate
+        self.segment_size = segment_size  # samples per segment file
+        self.segments = []  # [first timestamp, rows] of the segment files, in time order
+        self._times = []  # samples not on disk yet, the ones being written included
+        self._values = []
+        self.last = None  # (timestamp, value) of the newest sample
+        for path in glob.glob(f"{glob.escape(prefix)}.*.ts"):
+            first = int(path[len(prefix) + 1:-len('.ts')])
+            self.segments.append([first, os.path.getsize(path) // 8])
+        self.segments.sort()
+        if self.segments:
+            first, rows = self.segments[-1]
+            if rows:
+                times, values = self._map(first, rows)
+                self.last = (int(times[-1]), float(values[-1]))
+
+    def _paths(self, first):
+        return f"{self.prefix}.{first}.ts", f"{self.prefix}.{first}.val"
+
+    def _map(self, first, rows):
+        time_path, value_path = self._paths(first)
+        return (np.memmap(time_path, dtype=np.int64, mode='r', shape=(rows,)),
+                np.memmap(value_path, dtype=np.float32, mode='r', shape=(rows,)))
+
+    def append(self, t, value):
+        self._times.append(t)
+        self._values.append(value)
+        self.last = (t, value)
+
+    def prepare(self):
+        # Called with the lock held: the writes of the new samples, (new segment, first, rows before, times, values)
+        times, values = self._times[:], self._values[:]
+        writes = []
+        first, rows = self.segments[-1] if self.segments else (None, self.segment_size)
+        start = 0
+        while start < len(times):
+            new = rows >= self.segment_size
+            if new:
+                first, rows = times[start], 0
+            count = min(self.segment_size - rows, len(times) - start)
+            writes.append((new, first, rows, times[start:start + count], values[start:start + count]))
+            rows += count
+            start += count
+        return writes
+
+    def write(self, writes):
+        for new, first, rows, times, values in writes:
+            time_path, value_path = self._paths(first)
+            write_at(time_path, rows * 8, np.asarray(times, dtype=np.int64).tobytes())
+            write_at(value_path, rows * 4, np.asarray(values, dtype=np.float32).tobytes())
+
+    def commit(self, writes):
+        # Called with the lock held once written: the samples are read from the files from now on
+        for new, first, rows, times, values in writes:
+            if new:
+                self.segments.append([first, 0])
+            self.segments[-1][1] += len(times)
+            del self._times[:len(times)], self._values[:len(values)]
+
+    def query(self, start, end):
+        """Return the timestamps and values of the samples with start <= timestamp <= end."""
+        times, values = [], []
+        firsts = [first for first, rows in self.segments]
+        for index in range(max(bisect.bisect_right(firsts, start) - 1, 0), len(self.segments)):
+            first, rows = self.segments[index]
+            if first > end:
+                break
+            if not rows:
+                continue
+            segment_times, segment_values = self._map(first, rows)
+            low = np.searchsorted(segment_times, start, side='left')
+            high = np.searchsorted(segment_times, end, side='right')
+            times.append(np.array(segment_times[low:high]))
+            values.append(np.array(segment_values[low:high]))
+        if self._times:
+            tail_times = np.asarray(self._times, dtype=np.int64)
+            low, high = np.searchsorted(tail_times, start, side='left'), np.searchsorted(tail_times, end, side='right')
+            times.append(tail_times[low:high])
+            values.append(np.asarray(self._values[low:high], dtype=np.float32))
+        if not times:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return np.concatenate(times), np.concatenate(values)
+
+
+class Rollup:
+    """Count, min, max and sum of a series per bucket of resolution seconds."""
+    def __init__(self, path, resolution, series):
+        self.path = path
+        self.resolution = resolution * 1000  # in milliseconds like the timestamps
+        self._closed = []  # buckets complete but not on disk yet, the ones being written included
+        self.rows = os.path.getsize(path) // ROLLUP_DTYPE.itemsize if os.path.exists(path) else 0
+        self.current = None  # [bucket start, count, min, max, sum] of the open bucket
+        # The open bucket was lost with the process, it is rebuilt from the samples already on disk
+        start = int(self._map()['t'][-1]) + self.resolution if self.rows else 0
+        times, values = series.query(start, np.iinfo(np.int64).max)
+        for t, value in zip(times.tolist(), values.tolist()):
+            self.add(t, value)
+
+    def _map(self):
+        return np.memmap(self.path, dtype=ROLLUP_DTYPE, mode='r', shape=(self.rows,))
+
+    def add(self, t, value):
+        bucket = t - t % self.resolution
+        current = self.current
+        if current is None or bucket > current[0]:
+            if current is not None:
+                self._closed.append(tuple(current))
+            self.current = [bucket, 1, value, value, value]
+            return
+        current[1] += 1
+        current[2] = min(current[2], value)
+        current[3] = max(current[3], value)
+        current[4] += value
+
+    def prepare(self):
+        # Called with the lock held, like Series.prepare
+        return self.rows, np.array(self._closed, dtype=ROLLUP_DTYPE) if self._closed else None
+
+    def write(self, writes):
+        rows, closed = writes
+        if closed is not None:
+            write_at(self.path, rows * ROLLUP_DTYPE.itemsize, closed.tobytes())
+
+    def commit(self, writes):
+        rows, closed = writes
+        if closed is not None:
+            self.rows += len(closed)
+            del self._closed[:len(closed)]
+
+    def query(self, start, end):
+        """Return the buckets starting between start and end, the open one included."""
+        parts = []
+        if self.rows:
+            rows = self._map()
+            low = np.searchsorted(rows['t'], start - start % self.resolution, side='left')
+            high = np.searchsorted(rows['t'], end, side='right')
+            parts.append(np.array(rows[low:high]))
+        pending = self._closed + ([tuple(self.current)] if self.current else [])
+        pending = [row for row in pending if start - start % self.resolution <= row[0] <= end]
+        if pending:
+            parts.append(np.array(pending, dtype=ROLLUP_DTYPE))
+        return np.concatenate(parts) if parts else np.empty(0, dtype=ROLLUP_DTYPE)
+
+
+class TimeSeriesStore:
+    """Class to record the vitals of the patients in local columnar files and answer range queries."""
+    def __init__(self, directory='history', segment_size=86400, flush_interval=1.0, data_types=STORED_DATA_TYPES):
+        self.directory = directory
+        self.segment_size = segment_size  # samples per segment file, a day of samples at 1 Hz
+        self.flush_interval = flush_interval  # seconds the new samples may wait in memory
+        self.data_types = data_types
+        self._series = {}  # (user ID, data type) -> (Series, {resolution name: Rollup})
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one flush at a time, the lock of the store is only held around it
+        self._stop_event = threading.Event()
+        self._flusher = None
+        self.client_mqtt = None
+
+    def start(self):
+        self._stop_event.clear()
+        self._flusher = threading.Thread(target=self._flush_loop, name='history-flusher', daemon=True)
+        self._flusher.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._flusher:
+            self._flusher.join()
+            self._flusher = None
+        if self.client_mqtt:
+            self.client_mqtt.stop()
+        self.flush()
+
+    def _open(self, user_id, data_type):
+        # Called with the lock held
+        key = (int(user_id), data_type)
+        opened = self._series.get(key)
+        if opened is None:
+            directory = os.path.join(self.directory, str(key[0]))
+            os.makedirs(directory, exist_ok=True)
+            prefix = os.path.join(directory, data_type)
+            series = Series(prefix, self.segment_size)
+            rollups = {name: Rollup(f"{prefix}.{name}.rollup", seconds, series)
+                       for name, seconds in RESOLUTIONS.items()}
+            opened = self._series[key] = (series, rollups)
+        return opened
+
+    def append(self, user_id, data_type, t, value):
+        """Record a sample, t is in seconds since the epoch, a SenML time string or None for now."""
+        if data_type not in self.data_types or not isinstance(value, (int, float)):
+            return
+        t = SenML.epoch_time(t)
+        t = int((time.time() if t is None else t) * 1000)
+        with self._lock:
+            series, rollups = self._open(user_id, data_type)
+            if series.last and t < series.last[0]:
+                # A late sample, e.g. from a pack, keeps the series sorted at the time of the newest one
+                t = series.last[0]
+            series.append(t, float(value))
+            for rollup in rollups.values():
+                rollup.add(t, float(value))
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                files = [part for series, rollups in self._series.values() for part in (series, *rollups.values())]
+                writes = [part.prepare() for part in files]
+            # The slow part, appends and queries go on meanwhile
+            for part, part_writes in zip(files, writes):
+                part.write(part_writes)
+            with self._lock:
+                for part, part_writes in zip(files, writes):
+                    part.commit(part_writes)
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Failed to flush the history: {e}")
+
+    def latest(self, user_id, data_type):
+        """Return (seconds since the epoch, value) of the newest sample, or None."""
+        with self._lock:
+            series, rollups = self._open(user_id, data_type)
+            if series.last is None:
+                return None
+            return series.last[0] / 1000, series.last[1]
+
+    def query(self, user_id, data_type, start, end=None, resolution=None):
+        """Samples of a series between two times in seconds, or its buckets of resolution "1m", "15m" or "1h".
+
+        The samples are returned as (times in seconds, values) arrays, the buckets as a structured array with the
+        fields t (bucket start in seconds), count, min, max and mean.
+        """
+        start = int(start * 1000)
+        end = int((time.time() if end is None else end) * 1000)
+        with self._lock:
+            series, rollups = self._open(user_id, data_type)
+            if resolution is None:
+                times, values = series.query(start, end)
+                return times / 1000, values
+            rows = rollups[resolution].query(start, end)
+        buckets = np.empty(len(rows), dtype=[('t', '<f8'), ('count', '<i4'), ('min', '<f4'), ('max', '<f4'),
+                                             ('mean', '<f8')])
+        buckets['t'] = rows['t'] / 1000
+        buckets['count'] = rows['count']
+        buckets['min'] = rows['min']
+        buckets['max'] = rows['max']
+        buckets['mean'] = rows['sum'] / np.maximum(rows['count'], 1)
+        return buckets
+
+    def attach(self, client_mqtt):
+        """Record every vital received by an MQTT client, routine, danger and packs."""
+        self.client_mqtt = client_mqtt
+        client_mqtt.mySubscribe("SmartHealth/{user_id}/{data_type}", self.on_message)
+        client_mqtt.mySubscribe("SmartHealth/{user_id}/danger/{data_type}", self.on_message)
+
+    def on_message(self, topic, payload, params):
+        is_pack = params['data_type'] == SenML.PACK_TOPIC
+        for record in SenML.records(payload):
+            self.append(params['user_id'], record.name if is_pack else params['data_type'], record.time,
+                        record.value)
+
+if __name__ == "__main__":
+    store = TimeSeriesStore()
+    store.start()
+    store.attach(MyMQTT('TimeSeriesStore', *broker_address()))
+    store.client_mqtt.start()
+    exporter = Metrics.TextfileExporter('time_series_store').start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        store.stop()
+        exporter.stop()
@@ -0,0 +1,247 @@
+'''
+VitalsAnalytics.py is a stream processor subscribed to the heart rate and blood oxygen of every patient
+("SmartHealth/{user_id}/{data_type}", its danger topics and the SenML packs). For every patient and measurement it keeps
+ring buffers of the latest samples and updates in O(1) per sample the rolling mean, minimum, maximum, standard
+deviation, exponentially weighted moving average and trend (slope of a least squares line, per minute) of each
+window. A single sample out of range is not an anomaly here: a "sustained" anomaly starts when at least N of the last
+M samples are out of the normal range of the catalog and ends when few of them still are.
+The statistics are published every few samples on "SmartHealth/{user_id}/stats/{data_type}" and the anomalies on
+"SmartHealth/{user_id}/stats/{data_type}/sustained", both in SenML.
+The normal ranges are reloaded from the change feed of the catalog, in the thread of the CatalogClient: the handler
+of the messages, on the network thread of paho, never waits for an HTTP request.
+'''
+
+import time
+import logging
+from collections import deque
+from MyMQTT import MyMQTT, broker_address
+from RuleEngine import RuleEngine
+from CatalogClient import CatalogClient
+import Metrics
+import SenML
+
+# Setup basic logging configuration
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+ANALYZED_DATA_TYPES = ('heart_rate', 'blood_oxygen')
+
+
+class RollingWindow:
+    """Ring buffer of the last size samples with their rolling statistics, every update is O(1)."""
+    __slots__ = ('size', 'alpha', 'values', 'times', 'position', 'count', 'added', 'origin', 'sum', 'sum_squares',
+                 'sum_t', 'sum_tt', 'sum_ty', 'minima', 'maxima', 'ewma')
+
+    def __init__(self, size, alpha=0.1):
+        self.size = size
+        self.alpha = alpha  # weight of the newest sample in the EWMA
+        self.values = [0.0] * size
+        self.times = [0.0] * size
+        self.position = 0  # next slot of the ring
+        self.count = 0
+        self.added = 0  # samples since the sums were last recomputed
+        self.origin = None  # time origin of the regression, keeps the sums of t small
+        self.sum = self.sum_squares = self.sum_t = self.sum_tt = self.sum_ty = 0.0
+        # Monotonic queues of (sample number, value), their first item is the minimum / maximum of the window
+        self.minima = deque()
+        self.maxima = deque()
+        self.ewma = None
+
+    def add(self, t, value):
+        if self.origin is None:
+            self.origin = t
+        t -= self.origin
+        if self.count == self.size:
+            old_t, old_value = self.times[self.position], self.values[self.position]
+            self.sum -= old_value
+            self.sum_squares -= old_value * old_value
+            self.sum_t -= old_t
+            self.sum_tt -= old_t * old_t
+            self.sum_ty -= old_t * old_value
+        else:
+            self.count += 1
+        self.times[self.position] = t
+        self.values[self.position] = value
+        self.position = (self.position + 1) % self.size
+        self.sum += value
+        self.sum_squares += value * value
+        self.sum_t += t
+        self.sum_tt += t * t
+        self.sum_ty += t * value
+
+        number = self.added = self.added + 1
+        while self.minima and self.minima[-1][1] >= value:
+            self.minima.pop()
+        self.minima.append((number, value))
+        while self.maxima and self.maxima[-1][1] <= value:
+            self.maxima.pop()
+        self.maxima.append((number, value))
+        oldest = number - self.count
+        while self.minima[0][0] <= oldest:
+            self.minima.popleft()
+        while self.maxima[0][0] <= oldest:
+            self.maxima.popleft()
+
+        self.ewma = value if self.ewma is None else self.ewma + self.alpha * (value - self.ewma)
+        if number >= 1000 * self.size:
+            self._recompute()
+
+    def _recompute(self):
+        # The running sums drift with the floating point errors, start them again from the ring now and then
+        start = (self.position - self.count) % self.size
+        order = [(start + i) % self.size for i in range(self.count)]
+        shift = self.times[order[0]]
+        self.origin += shift
+        for i in order:
+            self.times[i] -= shift
+        self.sum = sum(self.values[i] for i in order)
+        self.sum_squares = sum(self.values[i] ** 2 for i in order)
+        self.sum_t = sum(self.times[i] for i in order)
+        self.sum_tt = sum(self.times[i] ** 2 for i in order)
+        self.sum_ty = sum(self.times[i] * self.values[i] for i in order)
+        # Number the queued samples from 1 again, keeping their distance to the newest one
+        offset = self.added - self.count
+        self.minima = deque((number - offset, value) for number, value in self.minima)
+        self.maxima = deque((number - offset, value) for number, value in self.maxima)
+        self.added = self.count
+
+    def stats(self):
+        n = self.count
+        mean = self.sum / n
+        variance = max(self.sum_squares / n - mean * mean, 0.0)
+        denominator = n * self.sum_tt - self.sum_t * self.sum_t
+        slope = (n * self.sum_ty - self.sum_t * self.sum) / denominator * 60 if denominator > 1e-9 else 0.0
+        return {"mean": mean, "min": self.minima[0][1], "max": self.maxima[0][1], "std": variance ** 0.5,
+                "ewma": self.ewma, "slope": slope}
+
+
+class SustainedDetector:
+    """Detects at least n out of range samples among the last m, ending when at most clear of them are left."""
+    __slots__ = ('n', 'm', 'clear', 'flags', 'position', 'out', 'active')
+
+    def __init__(self, n, m, clear=None):
+        self.n = n
+        self.m = m
+        self.clear = n // 2 if clear is None else clear
+        self.flags = [False] * m
+        self.position = 0
+        self.out = 0  # out of range samples among the last m
+        self.active = False
+
+    def add(self, out_of_range):
+        """Return "start" or "end" when the anomaly starts or ends with this sample, None otherwise."""
+        self.out += out_of_range - self.flags[self.position]
+        self.flags[self.position] = out_of_range
+        self.position = (self.position + 1) % self.m
+        if not self.active and self.out >= self.n:
+            self.active = True
+            return "start"
+        if self.active and self.out <= self.clear:
+            self.active = False
+            return "end"
+        return None
+
+
+class VitalsAnalytics:
+    """Class to compute rolling statistics and sustained anomalies of the vitals of every patient."""
+    def __init__(self, windows=(60, 300), alpha=0.1, sustained=(5, 10), publish_every=10,
+                 broker=None, port=None, rules=None):
+        self.windows = windows  # window sizes, in samples
+        self.alpha = alpha
+        self.sustained = sustained  # (N, M): N out of range samples among the last M
+        self.publish_every = publish_every  # samples between two publications of the statistics
+        self.client_id = 'VitalsAnalytics'
+        self.catalog_client = CatalogClient()
+        self.rules = rules or RuleEngine(client=self.catalog_client)
+        self._streams = {}  # (user ID, data type) -> stream state
+        self.client_mqtt = MyMQTT(self.client_id, *broker_address(broker, port))
+
+    def start(self):
+        self.client_mqtt.start()
+        self.client_mqtt.mySubscribe("SmartHealth/{user_id}/{data_type}", self.on_message)
+        self.client_mqtt.mySubscribe("SmartHealth/{user_id}/danger/{data_type}", self.on_message)
+        self.catalog_client.watch(self.on_catalog_change)
+
+    def stop(self):
+        self.catalog_client.stop()
+        self.client_mqtt.stop()
+
+    def on_catalog_change(self, catalog):
+        # In the thread of the change feed, the new rules apply from the next sample on
+        self.rules.update(catalog)
+
+    def on_message(self, topic, payload, params):
+        # A sample comes either on its routine or on its danger topic, the thresholds are applied again here
+        try:
+            user_id = int(params['user_id'])
+        except ValueError:
+            return
+        is_pack = params['data_type'] == SenML.PACK_TOPIC
+        for record in SenML.records(payload):
+            data_type = record.name if is_pack else params['data_type']
+            if data_type not in ANALYZED_DATA_TYPES or not isinstance(record.value, (int, float)):
+                continue
+            t = record.time if isinstance(record.time, (int, float)) else time.time()
+            self.process(user_id, data_type, record.value, record.unit, t)
+
+    def _stream(self, user_id, data_type, unit):
+        key = (user_id, data_type)
+        stream = self._streams.get(key)
+        if stream is None:
+            stream = self._streams[key] = {
+                "windows": [RollingWindow(size, self.alpha) for size in self.windows],
+                "detector": SustainedDetector(*self.sustained),
+                "unit": unit,
+                "samples": 0
+            }
+        return stream
+
+    def process(self, user_id, data_type, value, unit, t):
+        """Add a sample to the windows of its patient, publish the statistics when due and the anomalies."""
+        stream = self._stream(user_id, data_type, unit)
+        value = float(value)
+        for window in stream["windows"]:
+            window.add(t, value)
+        stream["samples"] += 1
+        transition = stream["detector"].add(self.rules.is_danger(user_id, data_type, value))
+        if transition:
+            self.publish_anomaly(user_id, data_type, transition, stream, value, t)
+        if stream["samples"] % self.publish_every == 0:
+            self.publish_stats(user_id, data_type, stream, t)
+        return transition
+
+    def publish_stats(self, user_id, data_type, stream, t):
+        unit = stream["unit"]
+        entries = []
+        for window in stream["windows"]:
+            for name, value in window.stats().items():
+                entries.append({"n": f"{name}_{window.size}", "u": f"{unit}/min" if name == "slope" else unit,
+                                "v": round(value, 3)})
+        message = {"bn": self.client_id, "bt": round(t, 3), "e": entries}
+        self.client_mqtt.myPublish(f"SmartHealth/{user_id}/stats/{data_type}", message)
+
+    def publish_anomaly(self, user_id, data_type, transition, stream, value, t):
+        detector = stream["detector"]
+        logging.info(f"Sustained {data_type} anomaly of user {user_id}: {transition} "
+                     f"({detector.out} of the last {detector.m} samples out of range)")
+        message = {
+            "bn": self.client_id,
+            "bt": round(t, 3),
+            "e": [
+                {"n": "sustained", "vs": transition},
+                {"n": "out_of_range", "v": detector.out},
+                {"n": "samples", "v": detector.m},
+                {"n": data_type, "u": stream["unit"], "v": value}
+            ]
+        }
+        self.client_mqtt.myPublish(f"SmartHealth/{user_id}/stats/{data_type}/sustained", message)
+
+if __name__ == "__main__":
+    analytics = VitalsAnalytics()
+    analytics.start()
+    exporter = Metrics.TextfileExporter('vitals_analytics').start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        analytics.stop()
+        exporter.stop()
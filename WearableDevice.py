@@ -23,119 +23,276 @@ between 90% and 100%.
 '''
 
 import os
-import json
-import pandas as pd
-import time
+import threading
+import numpy as np
 import logging
+import argparse
+from collections import namedtuple
 from SmartHealthPublisher import Publisher
+from MyMQTT import broker_address
 from GPS_Tracker import GPSTracker
+from ReplayScheduler import ReplayScheduler
+from RuleEngine import RuleEngine
+from CatalogClient import CatalogClient
+from FleetGenerator import FleetGenerator
+import Metrics
+import PatientData
 
 # Setup basic logging configuration
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+PLAN_CHUNK_ROWS = 60  # rows classified at once, the rules are checked for updates between two chunks
+LATEST_INTERVAL = 5  # seconds between two updates of the retained latest values of a patient
+REQUIRED_COLUMNS = ['Heart Rate', 'Blood Oxygen', 'Latitude', 'Longitude']
+DANGER_UNITS = {
+    "blood_oxygen": "%",
+    "heart_rate": "bpm",
+    "gps": "coords"
+}
+
+# One message of the publish plan, computed a chunk of rows ahead of the replay
+PublishRecord = namedtuple('PublishRecord', ['topic', 'value', 'unit', 'is_danger'])
+
 class WearableDevice:
     """Class to handle wearable device data publishing."""
-    def __init__(self):
-        self.broker = 'mqtt.eclipseprojects.io'
-        self.port = 1883
+    def __init__(self, speedup=1.0, workers=4, batch_size=None, max_latency=1.0, codec='json', broker=None, port=None):
+        self.broker, self.port = broker_address(broker, port)
+        self.speedup = speedup  # 1 is real time, 60 replays a minute per second, 0 as fast as possible
+        self.workers = workers
+        self.batch_size = batch_size  # records per SenML pack, None publishes every value in its own message
+        self.max_latency = max_latency
+        self.codec = codec  # payload codec of the publisher: json, msgpack or cbor
+        self.schedulers = set()  # replays currently running, process_user_file may be called from many threads
+        self.live = None  # shared timeline of add_replay(), started with the first patient added
+        self._live_users = set()
+        self._live_lock = threading.Lock()
+        self._publish_log = Metrics.ThrottledLog(10)  # a line per topic every 10 seconds, not per message
         self.publisher = self.initialize_publisher()
         self.gps_tracker = GPSTracker()
-        # Load user catalog
+        self.catalog_client = CatalogClient()
+        # normal ranges of the catalog, reloaded when the catalog changes
+        self.rules = RuleEngine(client=self.catalog_client)
+
+    @property
+    def users(self):
+        # Read through the cache of the catalog client, so users added through App.py can be replayed
         try:
-            with open('Catalog.json', 'r') as f:
-                self.catalog = json.load(f)
-                self.users = {user['username']: user for user in self.catalog['users']}
-                self.home_lat = None
-                self.home_lon = None
+            return {user['username']: user for user in self.catalog_client.users()}
         except Exception as e:
             logging.error(f"Error loading catalog: {e}")
+            return {}
 
     def initialize_publisher(self):
         client_id = "wearable_device_publisher"
-        publisher = Publisher(client_id, self.broker, self.port)
+        publisher = Publisher(client_id, self.broker, self.port, self.batch_size, self.max_latency, self.codec,
+                              latest_interval=LATEST_INTERVAL)
         publisher.start()
         return publisher
 
     def start(self):
         """Start the publishing process for all users in the catalog."""
         try:
-            for username in self.users:
-                self.process_user_file(username)
+            self.replay(list(self.users))
         except Exception as e:
             logging.error(f"Error starting the publishing process: {e}")
 
+    def replay(self, usernames):
+        """Replay the files of the given users concurrently and block until all of them are published."""
+        scheduler = ReplayScheduler(speedup=self.speedup, workers=self.workers)
+        users = self.users
+        for username in usernames:
+            user = users.get(username)
+            if user is None:
+                logging.warning(f"User {username} is not in the catalog.")
+                continue
+            rows = self.read_user_rows(user)
+            if rows is not None:
+                scheduler.add_source(username, rows, self.publish_records)
+        self.run_scheduler(scheduler)
+
+    def replay_fleet(self, fleet):
+        """Replay the patients of a FleetGenerator, generated on the fly instead of read from files.
+
+        The n-th block of patients joins the timeline at tick n and is only generated then: the first rows are
+        published once the first block is ready, and the rest of the fleet follows one block per tick.
+        """
+        scheduler = ReplayScheduler(speedup=self.speedup, workers=self.workers)
+        for tick, block in enumerate(fleet.lazy_blocks()):
+            for index in range(block.first, block.first + block.count):
+                username = fleet.user(index)['username']
+                scheduler.add_source(username, self.fleet_plan(block, index), self.publish_records, start=tick)
+        self.run_scheduler(scheduler)
+
+    def fleet_plan(self, block, index):
+        # A generator, the block is generated at the first row asked for
+        user, data = block.patient(index)
+        yield from self.build_publish_plan(user, data)
+
+    def run_scheduler(self, scheduler, keep_running=False):
+        self.schedulers.add(scheduler)
+        try:
+            scheduler.run(keep_running)
+        finally:
+            self.schedulers.discard(scheduler)
+
     def process_user_file(self, username):
         try:
-            user = self.users.get(username)
-            self.home_lat = user['latitude']
-            self.home_lon = user['longitude']
-            filename = f"{username}.csv"
-            if not os.path.exists(filename):
-                logging.warning(f"File {filename} does not exist for user {username}.")
-                return
-            df = pd.read_csv(filename)
-            user_id = user['userID']
-            for index, row in df.iterrows():
-                self.publish_sensor_data(user_id, row, username)
-                time.sleep(1)  # Simulate real-time data publishing
-            logging.info(f"Successfully processed and published data from {filename}")
+            self.replay([username])
+        except Exception as e:
+            logging.error(f"Failed to process file for user {username}: {e}")
+
+    def add_replay(self, username):
+        """Replay the file of a patient on the shared live timeline, unless it is being replayed already.
+
+        The patients added join the timeline at its next tick and share the workers of one scheduler, so the number
+        of patients replayed at once costs no thread.
+        """
+        try:
+            with self._live_lock:
+                if username in self._live_users:
+                    return
+                user = self.users.get(username)
+                if user is None:
+                    logging.warning(f"User {username} is not in the catalog.")
+                    return
+                rows = self.read_user_rows(user)
+                if rows is None:
+                    return
+                self._live_users.add(username)
+                if self.live is None:
+                    self.live = ReplayScheduler(speedup=self.speedup, workers=self.workers)
+                    self.schedulers.add(self.live)
+                    threading.Thread(target=self.run_scheduler, args=(self.live, True), name='live-replay',
+                                     daemon=True).start()
+            self.live.add_source(username, self.live_rows(username, rows), self.publish_records)
         except Exception as e:
             logging.error(f"Failed to process file for user {username}: {e}")
 
-    def publish_sensor_data(self, user_id, row, username):
-        required_keys = ['Heart Rate', 'Blood Oxygen', 'Latitude', 'Longitude', 'Time']
-        if not all(key in row for key in required_keys):
+    def live_rows(self, username, rows):
+        # The patient can be added again once its file is replayed
+        try:
+            yield from rows
+        finally:
+            with self._live_lock:
+                self._live_users.discard(username)
+
+    def read_user_rows(self, user):
+        filename = f"{user['username']}.csv"
+        if not os.path.exists(filename) and os.path.isdir(user['username'] + PatientData.DIRECTORY_SUFFIX):
+            # A patient of a generated fleet, written already normalized (see FleetGenerator)
+            filename = user['username'] + PatientData.DIRECTORY_SUFFIX
+        if not os.path.exists(filename):
+            logging.warning(f"File {filename} does not exist for user {user['username']}.")
+            return None
+        try:
+            # Normalized once into a memory mapped cache, later replays start without parsing the CSV
+            data = PatientData.load(filename)
+        except ValueError as e:
+            logging.warning(f"Missing data in input: {e}")
+            return None
+        return self.build_publish_plan(user, data)
+
+    def build_publish_plan(self, user, data):
+        """Yield, for every row of a patient file, the records to publish.
+
+        data is a PatientFile, or a DataFrame of the CSV file. The rows are classified with NumPy one chunk at a
+        time, so a change of the catalog thresholds applies from the next chunk on while the replay is running, and
+        only the chunk being classified is read from a memory mapped file.
+        """
+        if not all(key in data for key in REQUIRED_COLUMNS):
             logging.warning("Missing data in input.")
             return
 
-        self.publish_heart_rate(user_id, row["Heart Rate"], username)
-        self.publish_blood_oxygen(user_id, row["Blood Oxygen"], username)
-
-        if not pd.isna(row["Latitude"]) and not pd.isna(row["Longitude"]):
-            self.publish_gps(user_id, row["Latitude"], row["Longitude"], username)
+        heart_rate = np.asarray(data["Heart Rate"], dtype=float)
+        # The CSV heart rates are whole numbers and are published as such
+        integer_heart_rate = "Heart Rate" in getattr(data, 'integer_columns', ()) or (
+            hasattr(data, 'dtypes') and np.issubdtype(data["Heart Rate"].dtype, np.integer))
+        blood_oxygen = np.asarray(data["Blood Oxygen"], dtype=float)
+        latitude = np.asarray(data["Latitude"], dtype=float)
+        longitude = np.asarray(data["Longitude"], dtype=float)
+        gps_state = {}  # in or out of zone, carried from chunk to chunk for the hysteresis of the geofences
+        zones_version = None
+        for start in range(0, len(data), PLAN_CHUNK_ROWS):
+            chunk = slice(start, start + PLAN_CHUNK_ROWS)
+            self.rules.refresh()
+            if zones_version != self.rules.version:
+                # The radius of the home zone is the GPS normal range of the catalog
+                zones_version = self.rules.version
+                self.gps_tracker.geofences.set_zones(user['userID'], self.gps_tracker.geofences.zones_of(
+                    user, self.rules.rules_for(user['userID'])["gps"].high))
+            heart_rate_values = (heart_rate[chunk].astype(np.int64) if integer_heart_rate else heart_rate[chunk]).tolist()
+            yield from self.classify(user, heart_rate[chunk], heart_rate_values,
+                                     blood_oxygen[chunk] * 100,  # Convert blood oxygen to percentage
+                                     latitude[chunk], longitude[chunk], gps_state)
 
-    def publish_heart_rate(self, user_id, heart_rate, username):
-        topic = f"SmartHealth/{user_id}/heart_rate"
-        if 60 < heart_rate < 100:
-            self.publish_data(topic, heart_rate, unit='bpm')
+    def classify(self, user, heart_rate, heart_rate_values, blood_oxygen, latitude, longitude, gps_state=None):
+        user_id = user['userID']
+        rules = self.rules.rules_for(user_id)
+        heart_rate_danger = rules["heart_rate"].danger_mask(heart_rate)
+        blood_oxygen_danger = rules["blood_oxygen"].danger_mask(blood_oxygen)
+        has_gps = ~(np.isnan(latitude) | np.isnan(longitude))
+        if gps_state is not None and self.gps_tracker.geofences.has_zones(user_id):
+            # All the safe zones of the patient, with hysteresis at their boundaries
+            out_of_zone, transitions = self.gps_tracker.geofences.evaluate(user_id, latitude, longitude, gps_state)
+            for index, transition, distance in transitions:
+                logging.info(f"User {user_id} {'left' if transition == 'exit' else 'entered'} the safe zones")
+            gps_danger = has_gps & out_of_zone
         else:
-            self.publish_danger_data(user_id, "heart_rate", heart_rate, username)
+            distance = self.gps_tracker.distances(user['latitude'], user['longitude'], latitude, longitude)
+            gps_danger = has_gps & rules["gps"].danger_mask(distance)
 
-    def publish_blood_oxygen(self, user_id, blood_oxygen, username):
-        topic = f"SmartHealth/{user_id}/blood_oxygen"
-        blood_oxygen *= 100  # Convert blood oxygen to percentage if it is in decimal form
-        if blood_oxygen < 90:
-            self.publish_danger_data(user_id, "blood_oxygen", blood_oxygen, username)
-        else:
-            self.publish_data(topic, blood_oxygen, '%SpO2')
+        heart_rate_records = [
+            PublishRecord(topic, value, unit, danger) for topic, value, unit, danger in zip(
+                np.where(heart_rate_danger, f"SmartHealth/{user_id}/danger/heart_rate",
+                         f"SmartHealth/{user_id}/heart_rate").tolist(),
+                heart_rate_values,
+                np.where(heart_rate_danger, DANGER_UNITS["heart_rate"], 'bpm').tolist(),
+                heart_rate_danger.tolist())]
+        blood_oxygen_records = [
+            PublishRecord(topic, value, unit, danger) for topic, value, unit, danger in zip(
+                np.where(blood_oxygen_danger, f"SmartHealth/{user_id}/danger/blood_oxygen",
+                         f"SmartHealth/{user_id}/blood_oxygen").tolist(),
+                blood_oxygen.tolist(),
+                np.where(blood_oxygen_danger, DANGER_UNITS["blood_oxygen"], '%SpO2').tolist(),
+                blood_oxygen_danger.tolist())]
+        # GPS is only present on a few rows, the other rows get no GPS record at all
+        gps_records = [None] * len(heart_rate_records)
+        gps_topic = f"SmartHealth/{user_id}/gps"
+        gps_danger_topic = f"SmartHealth/{user_id}/danger/gps"
+        for index, lat, lon, danger in zip(np.flatnonzero(has_gps).tolist(), latitude[has_gps].tolist(),
+                                           longitude[has_gps].tolist(), gps_danger[has_gps].tolist()):
+            gps_records[index] = PublishRecord(gps_danger_topic if danger else gps_topic, f"{lat},{lon}",
+                                               DANGER_UNITS["gps"], danger)
 
-    def publish_gps(self, user_id, lat, lon, username):
-        topic = f"SmartHealth/{user_id}/gps"
-        distance = self.gps_tracker.distance(self.home_lat, self.home_lon, lat, lon)
-        if distance > 500:
-            self.publish_danger_data(user_id, "gps", f"{lat},{lon}", username)
-        else:
-            self.publish_data(topic, f"{lat},{lon}", 'coords')
+        return [[record for record in tick if record is not None]
+                for tick in zip(heart_rate_records, blood_oxygen_records, gps_records)]
+
+    def publish_records(self, records):
+        for record in records:
+            if record.is_danger:
+                self.publish_danger_data(record.topic, record.value, record.unit)
+            else:
+                self.publish_data(record.topic, record.value, record.unit)
 
     def publish_data(self, topic, value, unit):
         try:
-            self.publisher.publish_normal_data(topic, value, unit)
-            logging.info(f"Published data to {topic} successfully")
+            if self.batch_size:
+                self.publisher.publish_batched(topic, value, unit)
+            else:
+                self.publisher.publish_normal_data(topic, value, unit)
+            self.publisher.publish_latest(topic, value, unit)
+            self._publish_log.log(topic, f"Published data to {topic} successfully")
         except Exception as e:
             logging.error(f"Failed to publish data to {topic}: {e}")
 
-    def publish_danger_data(self, user_id, data_type, value, username):
-        unit_mapping = {
-            "blood_oxygen": "%",
-            "heart_rate": "bpm",
-            "gps": "coords"
-        }
-        unit = unit_mapping.get(data_type, "")
-        topic = f"SmartHealth/{user_id}/danger/{data_type}"
+    def publish_danger_data(self, topic, value, unit):
         self.publisher.publish_normal_data(topic, value, unit)
-        logging.info(f"Published danger data to {topic} successfully")
+        self.publisher.publish_latest(topic, value, unit)
+        self._publish_log.log(topic, f"Published danger data to {topic} successfully")
 
     def stop_publisher(self):
+        for scheduler in list(self.schedulers):
+            scheduler.stop()
         if self.publisher:
             self.publisher.stop()
 
@@ -143,3 +300,30 @@ class WearableDevice:
         self.stop_publisher()  # Ensure the publisher is stopped properly
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay the patient files of the catalog through MQTT.")
+    parser.add_argument('--speedup', type=float, default=1.0, help="timeline speed-up, 0 for as fast as possible")
+    parser.add_argument('--workers', type=int, default=4, help="number of replay threads")
+    parser.add_argument('--batch-size', type=int, default=None, help="records per SenML pack, off by default")
+    parser.add_argument('--max-latency', type=float, default=1.0, help="seconds a record may wait in a pack")
+    parser.add_argument('--codec', choices=['json', 'msgpack', 'cbor'], default='json', help="payload codec")
+    parser.add_argument('--broker', default=None, help="MQTT broker host, SMARTHEALTH_MQTT_BROKER by default")
+    parser.add_argument('--port', type=int, default=None, help="MQTT broker port, SMARTHEALTH_MQTT_PORT by default")
+    parser.add_argument('--fleet', type=int, default=None,
+                        help="replay this many synthetic patients generated on the fly instead of the catalog")
+    parser.add_argument('--fleet-hours', type=float, default=24, help="hours of data per synthetic patient")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic fleet")
+    args = parser.parse_args()
+    device = WearableDevice(speedup=args.speedup, workers=args.workers, batch_size=args.batch_size,
+                            max_latency=args.max_latency, codec=args.codec, broker=args.broker, port=args.port)
+    exporter = Metrics.TextfileExporter('wearable_device').start()
+    try:
+        if args.fleet:
+            device.replay_fleet(FleetGenerator(args.fleet, args.fleet_hours, args.seed))
+        else:
+            device.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        device.stop_publisher()
+        exporter.stop()
@@ -0,0 +1,58 @@
+'''
+codec_benchmark.py compares the payload codecs of MyMQTT on the messages of the platform: a single measurement as
+published by Publisher.publish_normal_data and SenML packs of several ticks as published in batching mode.
+For every codec it reports the bytes on the wire and the encode and decode time per message.
+
+    python benchmarks/codec_benchmark.py [--repeat 20000]
+'''
+
+import argparse
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from MyMQTT import CODECS
+
+
+def single_message():
+    return {
+        "bn": "wearable_device_publisher",
+        "e": [{"n": "heart_rate", "u": "bpm", "t": time.strftime('%Y-%m-%d %H:%M:%S'), "v": 72}]
+    }
+
+
+def pack_message(ticks):
+    entries = []
+    for tick in range(ticks):
+        entries.append({"n": "heart_rate", "u": "bpm", "t": float(tick), "v": 70 + tick % 20})
+        entries.append({"n": "blood_oxygen", "u": "%SpO2", "t": float(tick), "v": 95.0 + tick % 4})
+    entries.append({"n": "gps", "u": "coords", "t": 0.0, "v": "45.06702781,7.656557681"})
+    return {"bn": "wearable_device_publisher", "bt": round(time.time(), 3), "e": entries}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the payload codecs of MyMQTT.")
+    parser.add_argument('--repeat', type=int, default=20000, help="encodes and decodes per measurement")
+    args = parser.parse_args()
+
+    messages = [("single", single_message()), ("pack 1 tick", pack_message(1)), ("pack 10 ticks", pack_message(10))]
+    print(f"{'codec':<8} {'message':<14} {'bytes':>6} {'encode us':>10} {'decode us':>10}")
+    for name, codec_class in CODECS.items():
+        try:
+            codec = codec_class()
+        except RuntimeError as e:
+            print(f"{name:<8} skipped: {e}")
+            continue
+        for label, message in messages:
+            payload = codec.encode(message)
+            size = len(payload.encode() if isinstance(payload, str) else payload)
+            encode = timeit.timeit(lambda: codec.encode(message), number=args.repeat) / args.repeat * 1e6
+            decode = timeit.timeit(lambda: codec.decode(payload), number=args.repeat) / args.repeat * 1e6
+            print(f"{name:<8} {label:<14} {size:>6} {encode:>10.2f} {decode:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+'''
+map_benchmark.py compares the two ways of making the location map of a GPS alert: the folium map of
+GPSTracker.create_html_map, written to map_{user_id}.html and read back for the upload as the bot used to do, and the
+precompiled template of MapRenderer, with new positions every time (cache misses) and with repeated positions
+(cache hits). As in the bot, the recent track gets a new GPS sample before every map, the hits included.
+It reports the time per map and the size of the page.
+
+    python benchmarks/map_benchmark.py [--repeat 200]
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from GPS_Tracker import GPSTracker
+
+HOME = (45.07458503351405, 7.701482095436164)
+
+
+def positions(count):
+    # A walk away from home, every position different
+    return [(HOME[0] + 0.0001 * i, HOME[1] + 0.00015 * i) for i in range(count)]
+
+
+def alerts(points, track_length=20):
+    # (position, recent track) of every map, the track ending with the samples received since the previous alert
+    return [(point, points[max(i - track_length, 0):i + 1]) for i, point in enumerate(points)]
+
+
+def folium_map(tracker, latitude, longitude):
+    path = tracker.create_html_map(latitude, longitude, 1)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the folium maps with the precompiled map template.")
+    parser.add_argument('--repeat', type=int, default=200, help="maps rendered per case")
+    args = parser.parse_args()
+
+    tracker = GPSTracker()
+    points = positions(args.repeat)
+    walk = alerts(points)
+    # A patient staying at the same place out of zone, the track keeps moving with the samples before the alert
+    standing = [(points[0], track) for point, track in walk]
+    render = lambda alert: tracker.render_map(*alert[0], 1, HOME, 500, alert[1])
+    cases = [
+        ("folium + file", lambda alert: folium_map(tracker, *alert[0]), walk),
+        ("template, miss", render, walk),
+        ("template, hit", render, standing),
+    ]
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)  # create_html_map writes in the working directory
+        try:
+            print(f"{'case':<16} {'ms per map':>11} {'bytes':>7}")
+            for label, render, inputs in cases:
+                start = time.perf_counter()
+                for alert in inputs:
+                    page = render(alert)
+                elapsed = (time.perf_counter() - start) / len(inputs) * 1e3
+                print(f"{label:<16} {elapsed:>11.3f} {len(page):>7}")
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == "__main__":
+    main()
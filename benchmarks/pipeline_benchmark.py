@@ -0,0 +1,373 @@
+'''
+pipeline_benchmark.py measures the whole MQTT pipeline offline. It starts a LocalBroker, a stub of the ThingSpeak
+API, the ThingSpeak Adaptor, the Telegram bot with a stub Telegram client and a latency probe, every component in its
+own process, then drives N synthetic wearables through Publisher for the given time. The vitals are published as
+SenML packs (batch size 1 by default, one message per sample) whose base time is the publish time, and a small share
+of them also on the danger topics to make the bot send alerts.
+It reports the messages per second published and consumed, the publish-to-consume latency (p50, p99, max) seen by
+the probe, and the CPU time and peak RSS of every component, on the console and as a JSON report to keep over time.
+
+    python benchmarks/pipeline_benchmark.py [--wearables 20] [--rate 10] [--duration 10] [--output report.json]
+'''
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows, the peak RSS is not reported
+
+USER_OFFSET = 1000  # IDs of the synthetic patients
+USERS_PER_CHANNEL = 4
+
+
+def usage():
+    """CPU seconds and peak RSS in MB of the current process."""
+    if resource is None:
+        return {"cpu_seconds": round(time.process_time(), 3), "max_rss_mb": None}
+    rusage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = rusage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return {"cpu_seconds": round(rusage.ru_utime + rusage.ru_stime, 3), "max_rss_mb": round(rss, 1)}
+
+
+def synthetic_catalog(count):
+    users = []
+    for index in range(count):
+        user_id = USER_OFFSET + index
+        users.append({
+            "userID": user_id, "name": f"Patient{index}", "surname": "Benchmark", "username": f"patient{index}",
+            "password": "benchmark", "latitude": 45.0745, "longitude": 7.7014, "csvFile": "Hesam20.csv",
+            "thingSpeakChannelID": str(900000 + index // USERS_PER_CHANNEL),
+            "thingSpeakWriteAPIKey": f"KEY{index // USERS_PER_CHANNEL:05d}"
+        })
+    return {"users": users, "devices": []}
+
+
+def run_component(name, setup, config, ready, stop, results):
+    # Entry point of every component process
+    os.chdir(config["directory"])
+    os.environ["SMARTHEALTH_MQTT_BROKER"] = "127.0.0.1"
+    if config.get("broker_port"):
+        os.environ["SMARTHEALTH_MQTT_PORT"] = str(config["broker_port"])
+    os.environ["SMARTHEALTH_CATALOG_URL"] = "http://127.0.0.1:9"  # nothing listens, Catalog.json is read
+    # Only the errors, the services print their connections and the catalog feed is down on purpose
+    sys.stdout = open(os.devnull, 'w')
+    logging.basicConfig(level=logging.ERROR, format=f'%(asctime)s - {name} - %(levelname)s - %(message)s')
+    try:
+        handle = setup(config)
+    except Exception as e:
+        ready.put((name, None, f"{type(e).__name__}: {e}"))
+        return
+    ready.put((name, handle.get("port"), None))
+    if "run" in handle:
+        handle["run"]()
+        ready.put((name, "done", None))
+    stop.wait()
+    stats = handle["stop"]()
+    results.put(dict(usage(), component=name, **stats))
+
+
+def setup_broker(config):
+    from LocalBroker import LocalBroker
+    broker = LocalBroker('127.0.0.1', 0)
+    broker.start()
+
+    def stop():
+        stats = dict(broker.stats)
+        broker.stop()
+        return stats
+    return {"port": broker.port, "stop": stop}
+
+
+def setup_thingspeak_stub(config):
+    counts = {"requests": 0, "updates": 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            bulk = self.path.endswith('bulk_update.json')
+            with lock:
+                counts["requests"] += 1
+                counts["updates"] += len(json.loads(body).get('updates', [])) if bulk else 1
+            reply = b'{"success": true}' if bulk else b'1'
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(reply)))
+            self.end_headers()
+            self.wfile.write(reply)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def stop():
+        server.shutdown()
+        return dict(counts)
+    return {"port": server.server_address[1], "stop": stop}
+
+
+def setup_adaptor(config):
+    from ThingSpeakAdaptor import ThingSpeakSubscriber
+    subscriber = ThingSpeakSubscriber(base_url=f"http://127.0.0.1:{config['thingspeak_port']}",
+                                      bulk=config["bulk"])
+    # The stub stops at the same time, what is left at the end is reported as upload_queue instead of uploaded
+    subscriber.uploader.drain_timeout = 0
+    subscriber.start()
+
+    def stop():
+        depth = subscriber.uploader.queue_depth()
+        subscriber.stop()
+        return {"routes": len(subscriber.routes.topics()), "upload_queue": depth}
+    return {"stop": stop}
+
+
+class StubTelegram:
+    """Records the messages instead of calling the Telegram API, with the delay of a round trip."""
+    def __init__(self, delay):
+        self.delay = delay
+        self.counts = {"messages": 0, "documents": 0}
+        self._lock = threading.Lock()
+
+    def _call(self, kind):
+        time.sleep(self.delay)
+        with self._lock:
+            self.counts[kind] += 1
+
+    def sendMessage(self, chat_id, text, **kwargs):
+        self._call("messages")
+
+    def sendDocument(self, chat_id, document, caption=None, **kwargs):
+        self._call("documents")
+
+    def answerCallbackQuery(self, query_id, **kwargs):
+        pass
+
+
+def setup_bot(config):
+    from SmartHealthTelegram import Bot, ALERT_LATENCY
+    from MyMQTT import broker_address
+    bot = Bot("0:benchmark", *broker_address())
+    stub = StubTelegram(config["telegram_delay"])
+    bot.bot = bot.outbox.bot = stub
+    for index in range(config["wearables"]):
+        # One caregiver chat logged in for every patient
+        bot.watch(500000 + index, USER_OFFSET + index)
+
+    def stop():
+        depth = bot.outbox.queue_depth()
+        bot.outbox.stop()
+        bot.mqtt_client.stop()
+        bot.history.stop()
+        bot.catalog_client.stop()
+        bot.wearable_device.stop_publisher()
+        # Sample time to Telegram call of the alerts, see the metrics of the bot
+        counts, total = ALERT_LATENCY.labels('heart_rate').snapshot()
+        alerts = sum(counts)
+        return dict(stub.counts, outbox_queue=depth,
+                    alert_latency_avg_s=round(total / alerts, 3) if alerts else None)
+    return {"stop": stop}
+
+
+def setup_probe(config):
+    from MyMQTT import MyMQTT, broker_address
+    import SenML
+    latencies = []
+    first_last = []
+
+    def on_pack(topic, message, params):
+        now = time.time()
+        sent = max(record.time for record in SenML.records(message))
+        latencies.append(now - sent)
+        if not first_last:
+            first_last.append(now)
+        first_last[1:] = [now]
+
+    client = MyMQTT('pipeline-probe', *broker_address())
+    client.mySubscribe("SmartHealth/{user_id}/pack", on_pack)
+    client.start()
+
+    def stop():
+        client.stop()
+        if not latencies:
+            return {"received": 0}
+        values = np.array(latencies) * 1000
+        span = first_last[-1] - first_last[0]
+        return {"received": len(latencies), "messages_per_second": round(len(latencies) / span, 1) if span else None,
+                "latency_ms": {"p50": round(float(np.percentile(values, 50)), 3),
+                               "p99": round(float(np.percentile(values, 99)), 3),
+                               "max": round(float(values.max()), 3)}}
+    return {"stop": stop}
+
+
+def setup_wearables(config):
+    from SmartHealthPublisher import Publisher
+    from MyMQTT import broker_address
+    publishers = []
+    for index in range(config["wearables"]):
+        publisher = Publisher(f"bench_wearable_{index}", *broker_address(), batch_size=config["batch_size"],
+                              max_latency=config["max_latency"])
+        publisher.start()
+        publishers.append(publisher)
+    counts = {"published": 0, "danger": 0}
+    generator = random.Random(config["seed"])
+
+    def run():
+        time.sleep(1)  # connections
+        interval = 1 / config["rate"]
+        start = time.monotonic()
+        tick = 0
+        while time.monotonic() - start < config["duration"]:
+            for index, publisher in enumerate(publishers):
+                user_id = USER_OFFSET + index
+                heart_rate = int(generator.gauss(75, 12))
+                publisher.publish_batched(f"SmartHealth/{user_id}/heart_rate", heart_rate, "bpm")
+                publisher.publish_batched(f"SmartHealth/{user_id}/blood_oxygen",
+                                          round(generator.uniform(0.9, 0.99) * 100, 1), "%SpO2")
+                counts["published"] += 2
+                if generator.random() < config["danger_ratio"]:
+                    publisher.publish_normal_data(f"SmartHealth/{user_id}/danger/heart_rate", heart_rate + 60, "bpm")
+                    counts["danger"] += 1
+            tick += 1
+            # Ticks keep their schedule, a late tick is not made up by a burst
+            delay = start + tick * interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        for publisher in publishers:
+            publisher.flush()
+        counts["seconds"] = round(time.monotonic() - start, 3)
+
+    def stop():
+        stats = [publisher.client_mqtt.publish_stats() for publisher in publishers]
+        for publisher in publishers:
+            publisher.stop()
+        acked = sum(s["acked"] for s in stats)
+        seconds = counts.get("seconds")
+        return dict(counts, messages=sum(s["published"] for s in stats), acked=acked,
+                    queued=sum(s["queued"] for s in stats),
+                    ack_latency_ms=round(sum(s["ack_latency_sum"] for s in stats) / acked * 1000, 3) if acked else None,
+                    samples_per_second=round(counts["published"] / seconds, 1) if seconds else None)
+    return {"run": run, "stop": stop}
+
+
+def start_component(context, name, setup, config, ready, stop, results, processes):
+    process = context.Process(target=run_component, args=(name, setup, config, ready, stop, results), name=name)
+    process.start()
+    processes.append(process)
+    component, port, error = ready.get(timeout=60)
+    if error:
+        raise RuntimeError(f"{component} failed to start: {error}")
+    return port
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              timeout=10).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the MQTT pipeline against a local broker and stubs.")
+    parser.add_argument('--wearables', type=int, default=20, help="synthetic wearables, one MQTT client each")
+    parser.add_argument('--rate', type=float, default=10, help="samples per second of every wearable")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load")
+    parser.add_argument('--batch-size', type=int, default=1, help="records per SenML pack")
+    parser.add_argument('--max-latency', type=float, default=1.0, help="seconds a record may wait in a pack")
+    parser.add_argument('--danger-ratio', type=float, default=0.01, help="share of the ticks with a danger alert")
+    parser.add_argument('--telegram-delay', type=float, default=0.05, help="seconds of a stub Telegram call")
+    parser.add_argument('--bulk', action='store_true', help="bulk uploads to ThingSpeak")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='pipeline_report.json', help="JSON report file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='pipeline_benchmark_')
+    with open(os.path.join(directory, 'Catalog.json'), 'w') as f:
+        json.dump(synthetic_catalog(args.wearables), f)
+    config = {"directory": directory, "wearables": args.wearables, "rate": args.rate, "duration": args.duration,
+              "batch_size": args.batch_size, "max_latency": args.max_latency, "danger_ratio": args.danger_ratio,
+              "telegram_delay": args.telegram_delay, "bulk": args.bulk, "seed": args.seed}
+    # spawn on every platform, the components must not inherit the threads of another one
+    context = multiprocessing.get_context('spawn')
+    ready, results, stop = context.Queue(), context.Queue(), context.Event()
+    processes = []
+    components = {}
+    try:
+        config["broker_port"] = start_component(context, "broker", setup_broker, config, ready, stop, results,
+                                                processes)
+        config["thingspeak_port"] = start_component(context, "thingspeak_stub", setup_thingspeak_stub, config,
+                                                    ready, stop, results, processes)
+        for name, setup in (("adaptor", setup_adaptor), ("bot", setup_bot), ("probe", setup_probe)):
+            start_component(context, name, setup, config, ready, stop, results, processes)
+        time.sleep(1)  # subscriptions
+        print(f"Driving {args.wearables} wearables at {args.rate} samples/s for {args.duration}s ...")
+        start_component(context, "wearables", setup_wearables, config, ready, stop, results, processes)
+        name, status, error = ready.get(timeout=args.duration + 120)
+        time.sleep(2)  # messages still on their way
+        stop.set()
+        for _ in processes:
+            result = results.get(timeout=60)
+            components[result.pop("component")] = result
+    finally:
+        stop.set()
+        for process in processes:
+            process.join(30)
+            if process.is_alive():
+                process.terminate()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    wearables, probe = components.get("wearables", {}), components.get("probe", {})
+    report = {
+        "benchmark": "pipeline",
+        "timestamp": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in config.items() if key not in ("directory", "broker_port",
+                                                                               "thingspeak_port")},
+        "throughput": {
+            "samples_published_per_second": wearables.get("samples_per_second"),
+            "messages_published": wearables.get("messages"),
+            "messages_consumed": probe.get("received"),
+            "messages_consumed_per_second": probe.get("messages_per_second"),
+        },
+        "latency_ms": probe.get("latency_ms"),
+        "components": components
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    print(f"{'component':<16} {'cpu s':>8} {'peak RSS MB':>12}")
+    for name, stats in components.items():
+        print(f"{name:<16} {stats['cpu_seconds']:>8.2f} {stats['max_rss_mb'] if stats['max_rss_mb'] else '-':>12}")
+    print(f"published {report['throughput']['messages_published']} messages, consumed "
+          f"{report['throughput']['messages_consumed']} ({report['throughput']['messages_consumed_per_second']}/s)")
+    print(f"latency ms: {report['latency_ms']}")
+    print(f"report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
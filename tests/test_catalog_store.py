@@ -0,0 +1,65 @@
+'''
+test_catalog_store.py checks that the CatalogStore starts again after a crash between the snapshot replacing
+Catalog.json and the new journal, when the old journal is replayed over a snapshot that already has its changes.
+
+    python -m pytest tests
+'''
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from CatalogStore import CatalogStore
+
+PATIENT = {"username": "Sara", "password": "secret", "latitude": 45.06, "longitude": 7.66}
+
+
+class CatalogReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'Catalog.json')
+        with open(self.path, 'w') as f:
+            json.dump({"projectName": "SmartHealth", "users": [dict(PATIENT, username="Hesam20", userID=1)]}, f)
+
+    def crash_after_snapshot(self, changes):
+        # Run the changes, snapshot them and put the journal back as if the process died before truncating it
+        store = CatalogStore(self.path)
+        changes(store)
+        with open(store.journal_path) as f:
+            journal = f.read()
+        store.stop()
+        with open(store.journal_path, 'w') as f:
+            f.write(journal)
+        return store.journal_path
+
+    def test_replay_of_an_updated_then_deleted_user(self):
+        def changes(store):
+            store.update_user(1, {"password": "changed"})
+            store.delete_user(1)
+            store.add_user(PATIENT)
+        self.crash_after_snapshot(changes)
+        store = CatalogStore(self.path)
+        self.addCleanup(store.stop)
+        self.assertEqual([user['username'] for user in store.users()], ["Sara"])
+        self.assertIsNone(store.get_user("Hesam20"))
+
+    def test_replay_of_a_renamed_user(self):
+        def changes(store):
+            user = store.add_user(PATIENT)
+            store.update_user(user['userID'], {"username": "Sara2"})
+        self.crash_after_snapshot(changes)
+        store = CatalogStore(self.path)
+        self.addCleanup(store.stop)
+        self.assertIsNone(store.get_user("Sara"))
+        self.assertEqual(store.get_user("Sara2")["userID"], 2)
+        self.assertEqual(len(store.users()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
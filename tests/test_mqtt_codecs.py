@@ -0,0 +1,53 @@
+'''
+test_mqtt_codecs.py checks that every payload codec of MyMQTT gives back the SenML messages of the platform: single
+measurements, packs and the records carrying "vs" or "vb" values such as the sustained alerts of VitalsAnalytics.
+
+    python -m pytest tests
+'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from MyMQTT import CODECS, CBORCodec, cbor2
+
+MESSAGES = [
+    {"bn": "wearable_device_publisher", "e": [{"n": "heart_rate", "u": "bpm", "t": 1700000000, "v": 72}]},
+    {"bn": "wearable_device_publisher", "e": [{"n": "gps", "u": "coords", "t": 1700000000, "v": "45.07,7.70"}]},
+    {"bn": "vitals_analytics", "bt": 1700000000.5,
+     "e": [{"n": "heart_rate", "u": "bpm", "t": 0, "v": 131.5}, {"n": "sustained", "vs": "enter"},
+           {"n": "confirmed", "vb": True}, {"n": "raw", "vd": "AAEC"}]},
+    {"userID": 1, "status": "ok"},
+]
+
+
+class CodecRoundTripTest(unittest.TestCase):
+    def check(self, name):
+        try:
+            codec = CODECS[name]()
+        except RuntimeError as e:
+            self.skipTest(str(e))  # the optional package of the codec is not installed
+        for message in MESSAGES:
+            with self.subTest(message=message):
+                self.assertEqual(codec.decode(codec.encode(message)), message)
+
+    def test_json(self):
+        self.check('json')
+
+    def test_msgpack(self):
+        self.check('msgpack')
+
+    def test_cbor(self):
+        self.check('cbor')
+
+    @unittest.skipIf(cbor2 is None, "cbor2 is not installed")
+    def test_cbor_labels(self):
+        pack = cbor2.loads(CBORCodec().encode(MESSAGES[2]))
+        self.assertEqual([sorted(record) for record in pack[1:]],
+                         [[CBORCodec.N, CBORCodec.VS], [CBORCodec.N, CBORCodec.VB], [CBORCodec.N, CBORCodec.VD]])
+
+
+if __name__ == "__main__":
+    unittest.main()
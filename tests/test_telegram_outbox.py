@@ -0,0 +1,107 @@
+'''
+test_telegram_outbox.py checks the TelegramOutbox against a stub of the Bot API: the order of the messages in a chat,
+through the global rate limit and the retries, the alerts sent before the routine replies and the coalescing of the
+alerts of a burst.
+
+    python -m pytest tests
+'''
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from TelegramOutbox import TelegramOutbox, ALERT
+
+
+class StubBot:
+    """Class to record the messages sent instead of calling the Bot API, failing the texts listed in fail once."""
+    def __init__(self, fail=()):
+        self.sent = []
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+
+    def sendMessage(self, chat_id, text, reply_markup=None):
+        with self.lock:
+            if text in self.fail:
+                self.fail.discard(text)
+                raise RuntimeError("Bad Gateway")
+            self.sent.append((chat_id, text))
+
+    def texts(self, chat_id):
+        with self.lock:
+            return [text for chat, text in self.sent if chat == chat_id]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out")
+        time.sleep(0.01)
+
+
+class TelegramOutboxTest(unittest.TestCase):
+    def make_outbox(self, bot, **kwargs):
+        outbox = TelegramOutbox(bot, **kwargs)
+        self.addCleanup(outbox.stop)
+        return outbox
+
+    def test_chat_order_through_the_global_rate_limit(self):
+        bot = StubBot()
+        outbox = self.make_outbox(bot, workers=3, chat_interval=0, global_rate=20)
+        outbox.start()
+        texts = [f"m{i}" for i in range(30)]
+        for text in texts:
+            outbox.send(1, text)
+        wait_for(lambda: len(bot.sent) == len(texts))
+        self.assertEqual(bot.texts(1), texts)
+
+    def test_chat_order_through_a_retry(self):
+        bot = StubBot(fail={"m0"})
+        outbox = self.make_outbox(bot, workers=2, chat_interval=0.02)
+        for i in range(4):
+            outbox.send(1, f"m{i}")
+        outbox.send(2, "other")
+        outbox.start()
+        wait_for(lambda: len(bot.sent) == 5)
+        self.assertEqual(bot.texts(1), ["m0", "m1", "m2", "m3"])
+        # The retry only holds its own chat
+        self.assertLess(bot.sent.index((2, "other")), bot.sent.index((1, "m0")))
+
+    def test_alerts_before_routine_replies(self):
+        bot = StubBot()
+        outbox = self.make_outbox(bot, workers=1, chat_interval=0)
+        outbox.send(1, "routine 1")
+        outbox.send(2, "routine 2")
+        outbox.send(3, "alert", priority=ALERT)
+        outbox.start()
+        wait_for(lambda: len(bot.sent) == 3)
+        self.assertEqual(bot.sent[0], (3, "alert"))
+
+    def test_burst_of_alerts_is_coalesced(self):
+        bot = StubBot()
+        outbox = self.make_outbox(bot, workers=1, chat_interval=0, coalesce_window=0.3)
+        summaries = []
+
+        def build(summary):
+            summaries.append(summary)
+            return lambda telegram: telegram.sendMessage(7, f"heart rate {summary['latest']} x{summary['count']}")
+
+        outbox.start()
+        outbox.alert(7, ("Hesam20", "heart_rate"), 150, build)
+        wait_for(lambda: len(bot.sent) == 1)
+        for value in (160, 140, 155):
+            outbox.alert(7, ("Hesam20", "heart_rate"), value, build)
+        time.sleep(0.1)
+        self.assertEqual(len(bot.sent), 1)  # the burst waits for the end of the window
+        wait_for(lambda: len(bot.sent) == 2)
+        self.assertEqual(bot.texts(7), ["heart rate 150 x1", "heart rate 155 x3"])
+        self.assertEqual((summaries[1]["min"], summaries[1]["max"]), (140, 160))
+
+
+if __name__ == "__main__":
+    unittest.main()
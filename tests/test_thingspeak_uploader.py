@@ -0,0 +1,164 @@
+'''
+test_thingspeak_uploader.py checks the upload pipeline of the ThingSpeak Adaptor against a local stub of the
+ThingSpeak API: the measurements of a channel are merged into one update (or sent together in bulk mode), failed
+uploads are retried and then given up, stop() drains what is left within drain_timeout, and the measurements kept
+in the store file are uploaded by the next start.
+
+    python -m pytest tests
+'''
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ThingSpeakUploader import ThingSpeakUploader
+
+API_KEY = "WRITEKEY"
+
+
+class StubThingSpeak(BaseHTTPRequestHandler):
+    """Stub of the update and bulk update endpoints, answering with the responses queued by the test."""
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.path.endswith('/bulk_update.json'):
+            data = json.loads(body)
+        else:
+            data = dict(parse_qsl(body.decode()))
+        with self.server.lock:
+            self.server.requests.append((self.path, data))
+            status, text = self.server.responses.pop(0) if self.server.responses else (200, "1")
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class ThingSpeakUploaderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubThingSpeak)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.responses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def uploader(self, **options):
+        options = dict({"rate": 1000, "backoff": 0.01, "drain_timeout": 5}, **options)
+        return ThingSpeakUploader(self.url, **options)
+
+    def requests(self):
+        with self.server.lock:
+            return list(self.server.requests)
+
+    def wait_for_requests(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while len(self.requests()) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.requests()
+
+    def test_fields_are_merged_into_one_update(self):
+        uploader = self.uploader()
+        uploader.enqueue(7, API_KEY, "field1", 70)
+        uploader.enqueue(7, API_KEY, "field2", 0.97)
+        uploader.enqueue(7, API_KEY, "field1", 72)
+        self.assertEqual(uploader.queue_depth(), 1)
+        uploader.start()
+        uploader.stop()
+        self.assertEqual(self.requests(), [("/update", {"api_key": API_KEY, "field1": "72", "field2": "0.97"})])
+
+    def test_bulk_mode_keeps_every_update(self):
+        uploader = self.uploader(bulk=True)
+        uploader.enqueue(7, API_KEY, "field1", 70)
+        uploader.enqueue(7, API_KEY, "field2", 0.97)
+        uploader.enqueue(7, API_KEY, "field1", 72)
+        uploader.start()
+        uploader.stop()
+        [(path, data)] = self.requests()
+        self.assertEqual(path, "/channels/7/bulk_update.json")
+        self.assertEqual(data["write_api_key"], API_KEY)
+        self.assertEqual([{key: value for key, value in update.items() if key != "created_at"}
+                          for update in data["updates"]], [{"field1": 70, "field2": 0.97}, {"field1": 72}])
+
+    def test_failed_upload_is_retried(self):
+        # A rejected update (entry id 0) and a server error, then the upload goes through
+        self.server.responses = [(200, "0"), (500, "error")]
+        uploader = self.uploader()
+        uploader.enqueue(7, API_KEY, "field1", 70)
+        uploader.start()
+        uploader.stop()
+        requests = self.requests()
+        self.assertEqual(len(requests), 3)
+        self.assertTrue(all(data == {"api_key": API_KEY, "field1": "70"} for _, data in requests))
+        self.assertEqual(uploader.queue_depth(), 0)
+
+    def test_upload_is_given_up_after_max_retries(self):
+        self.server.responses = [(500, "error")] * 3
+        uploader = self.uploader(max_retries=2)
+        uploader.enqueue(7, API_KEY, "field1", 70)
+        uploader.start()
+        uploader.stop()
+        self.assertEqual(len(self.requests()), 3)
+        self.assertEqual(uploader.queue_depth(), 0)
+
+    def test_stop_drains_the_pending_updates(self):
+        # Two updates a second, the second one waits for the rate limit after stop()
+        uploader = self.uploader(rate=2)
+        uploader.start()
+        uploader.enqueue(7, API_KEY, "field1", 70)
+        self.wait_for_requests(1)
+        uploader.enqueue(7, API_KEY, "field1", 72)
+        uploader.stop()
+        self.assertEqual([data["field1"] for _, data in self.requests()], ["70", "72"])
+
+    def test_stop_drops_what_is_left_after_drain_timeout(self):
+        uploader = self.uploader(rate=0.01, drain_timeout=0.2)
+        uploader.start()
+        uploader.enqueue(7, API_KEY, "field1", 70)
+        self.wait_for_requests(1)
+        uploader.enqueue(7, API_KEY, "field1", 72)
+        start = time.monotonic()
+        with self.assertLogs(level='WARNING') as logs:
+            uploader.stop()
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertIn("Dropping 1 ThingSpeak update(s)", logs.output[0])
+        self.assertEqual(len(self.requests()), 1)
+
+    def test_stored_measurements_are_uploaded_by_the_next_start(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        store_file = os.path.join(directory, 'pending.db')
+        # Never started, as if the process died before the upload
+        uploader = self.uploader(store_file=store_file)
+        uploader.enqueue(7, API_KEY, "field1", 70)
+        uploader.enqueue(7, API_KEY, "field2", 0.97)
+        uploader.stop()
+        self.assertEqual(self.requests(), [])
+
+        uploader = self.uploader(store_file=store_file)
+        self.assertEqual(uploader.queue_depth(), 1)
+        uploader.start()
+        uploader.stop()
+        self.assertEqual(self.requests(), [("/update", {"api_key": API_KEY, "field1": "70", "field2": "0.97"})])
+
+        # Uploaded measurements are removed from the store
+        uploader = self.uploader(store_file=store_file)
+        self.assertEqual(uploader.queue_depth(), 0)
+        uploader.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()